@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+# Benchmark of wireowl backend: processes a capture without UI and reports
+# processing speed and memory (RSS) of the process. Rows are processed in one
+# thread without reader's queue, so RSS is taken by data of devices only.
+#
+# Without a capture file, a synthetic one is generated: many clients resolving
+# and connecting to the same set of domains (like phones on a public wifi).
+#
+#   python3 bench/bench_backend.py --clients 300 --packets 500000
+#   python3 bench/bench_backend.py capture.csv
+#   python3 bench/bench_backend.py --blocklist-size 1000000
+#   python3 bench/bench_backend.py --offline capture.csv
+#
+# This file is part of wireowl which is released under GNU GPLv2 license.
+#
+# Copyright 2021, 2022 Jiri Rozvaril <rozvara at vync dot org>
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from time import perf_counter
+from wireowl_backend import TrafficInspector, Blocklist, Packet, COLUMNS, column_mapping
+from wireowl_numpy import OfflineEngine
+
+ROUTER_MAC = 'aa:bb:cc:00:00:01'
+ROUTER_IP = '192.168.0.1'
+
+
+# synthetic capture: DNS query/answer before first connection to a domain,
+# then TCP/UDP traffic to domains already resolved by the client
+#
+def generate_capture(filename, clients, packets, domains):
+    rnd = random.Random(1)
+    devs = [(f'02:00:00:00:{i//256:02x}:{i%256:02x}', f'192.168.{1+i//250}.{2+i%250}')
+            for i in range(clients)]
+    names = [f'host{i}.example{i%97}.com' for i in range(domains)]
+    addrs = {n: f'{20+i%200}.{(i*7)%250}.{(i*13)%250}.{1+i%250}' for i, n in enumerate(names)}
+    resolved = {mac: [] for mac, _ in devs}
+    streams = {}                        # {(mac, ip, tcp):stream index}
+    tm = 1650000000.0
+
+    with open(filename, 'w') as f:
+        f.write('\t'.join(COLUMNS) + '\n')
+
+        def row(**fields):
+            f.write('\t'.join(fields.get(c.replace('.', '_'), '') for c in COLUMNS) + '\n')
+
+        for i in range(packets):
+            tm += rnd.random() * 0.002
+            mac, ip = rnd.choice(devs)
+            if not resolved[mac] or rnd.random() < 0.02:
+                name = rnd.choice(names)
+                row(frame_time_epoch=f'{tm:.6f}', eth_src=mac, eth_dst=ROUTER_MAC,
+                    ip_src=ip, ip_dst=ROUTER_IP, udp_srcport='50000', udp_dstport='53',
+                    _ws_col_Protocol='DNS', dns_flags_response='0', dns_qry_name=name,
+                    frame_len='80')
+                row(frame_time_epoch=f'{tm+0.001:.6f}', eth_src=ROUTER_MAC, eth_dst=mac,
+                    ip_src=ROUTER_IP, ip_dst=ip, udp_srcport='53', udp_dstport='50000',
+                    _ws_col_Protocol='DNS', dns_flags_response='1', dns_qry_name=name,
+                    dns_a=addrs[name], dns_resp_name=name, dns_resp_ttl='300',
+                    frame_len='120')
+                resolved[mac].append(name)
+                continue
+            dst = addrs[rnd.choice(resolved[mac])]
+            tcp = rnd.random() < 0.8
+            proto, port = ('TLSv1.2', '443') if tcp else ('QUIC', '443')
+            stream = streams.setdefault((mac, dst, tcp), str(len(streams)))
+            ports = {'tcp_srcport' if tcp else 'udp_srcport': '50000',
+                     'tcp_dstport' if tcp else 'udp_dstport': port,
+                     'tcp_stream' if tcp else 'udp_stream': stream}
+            if rnd.random() < 0.5:
+                row(frame_time_epoch=f'{tm:.6f}', eth_src=mac, eth_dst=ROUTER_MAC, ip_src=ip,
+                    ip_dst=dst, _ws_col_Protocol=proto, frame_len=str(rnd.randint(60, 1514)),
+                    **ports)
+            else:
+                row(frame_time_epoch=f'{tm:.6f}', eth_src=ROUTER_MAC, eth_dst=mac, ip_src=dst,
+                    ip_dst=ip, _ws_col_Protocol=proto, frame_len=str(rnd.randint(60, 1514)),
+                    **ports)
+
+
+# synthetic blocklist: tracking-like domains and parents of every 10th
+# example domain of synthetic capture (their hosts are listed as subdomains)
+#
+def generate_blocklist(filename, size):
+    with open(filename, 'w') as f:
+        f.write("# synthetic blocklist\n")
+        parents = [f"example{i}.com" for i in range(0, 97, 10)]
+        for name in parents:
+            f.write(f"0.0.0.0 {name}\n")
+        for i in range(size - len(parents)):
+            f.write(f"0.0.0.0 t{i}.tracker{i%1000}.net\n")
+
+
+# resident set size of this process in MB
+#
+def rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of wireowl backend.")
+    parser.add_argument(dest='filename', metavar='PATHNAME', type=str, nargs='?',
+        help="capture to process (synthetic one is generated if omitted)")
+    parser.add_argument('--clients', type=int, default=300, help="synthetic capture: clients")
+    parser.add_argument('--packets', type=int, default=300000, help="synthetic capture: packets")
+    parser.add_argument('--domains', type=int, default=3000, help="synthetic capture: domains")
+    parser.add_argument('--blocklist', type=str, help="blocklist file to match DNS answers with")
+    parser.add_argument('--blocklist-size', type=int, default=0,
+        help="synthetic blocklist: domains (generated unless --blocklist is given)")
+    parser.add_argument('--offline', action='store_true',
+        help="also processes the capture by NumPy offline engine and compares speed")
+    args = parser.parse_args()
+
+    filename = args.filename
+    if not filename:
+        fd, filename = tempfile.mkstemp(prefix='wireowl-bench-', suffix='.csv')
+        os.close(fd)
+        generate_capture(filename, args.clients, args.packets, args.domains)
+
+    blocklist = None
+    blocklist_file = args.blocklist
+    if not blocklist_file and args.blocklist_size:
+        fd, blocklist_file = tempfile.mkstemp(prefix='wireowl-bench-', suffix='.hosts')
+        os.close(fd)
+        generate_blocklist(blocklist_file, args.blocklist_size)
+    if blocklist_file:
+        rss_before = rss_mb()
+        started = time.time()
+        blocklist = Blocklist([blocklist_file])
+        built = time.time() - started
+        blocklist_rss = rss_mb() - rss_before
+        if not args.blocklist:
+            os.remove(blocklist_file)
+
+    rss_start = rss_mb()
+    worker = TrafficInspector(blocklist=blocklist)
+    pkts = dropped = 0
+    parsing = 0  # seconds of parsing rows into packets (as PacketSource.parse_row)
+    started = time.time()
+    with open(filename) as f:
+        header = f.readline().rstrip('\n').split('\t')
+        mapping = column_mapping(header)
+        for row in f:
+            tm = perf_counter()
+            cols = row.rstrip('\n').split('\t')
+            if len(cols) != len(header):
+                dropped += 1
+                continue
+            if mapping:
+                cols.append('')
+                cols = [cols[i] for i in mapping]
+            pkt = Packet(cols)
+            parsing += perf_counter() - tm
+            worker.process_packet(pkt)
+            pkts += 1
+    elapsed = time.time() - started
+
+    engine = None
+    if args.offline:
+        rss_offline = rss_mb()
+        engine = OfflineEngine(filename, blocklist)
+        engine.run()
+
+    if not args.filename:
+        os.remove(filename)
+
+    conns = sum(len(d.connections) for d in worker.devices.values())
+    print(f"packets:     {pkts} ({dropped} dropped)")
+    print(f"time:        {elapsed:.2f} s ({pkts/max(elapsed, 0.001):.0f} packets/s)")
+    print(f"per packet:  {elapsed/max(pkts, 1)*1000000:.1f} us (parsing {parsing/max(pkts, 1)*1000000:.1f} us, "
+          f"processing {(elapsed-parsing)/max(pkts, 1)*1000000:.1f} us)")
+    print(f"devices:     {len(worker.devices)} ({len(worker.clients)} clients)")
+    print(f"connections: {conns}")
+    print(f"RSS:         {rss_mb():.1f} MB ({rss_mb()-rss_start:.1f} MB for capture data)")
+    if blocklist:
+        listed = sum(len(d.listed_ips) for d in worker.devices.values())
+        print(f"blocklist:   {len(blocklist.hashes)} domains, {len(blocklist.hashes)*8/1024/1024:.1f} MB "
+              f"array ({blocklist_rss:.1f} MB RSS after build), built in {built:.2f} s")
+        print(f"lookups:     {blocklist.lookups} ({blocklist.cached} cached), "
+              f"{blocklist.cost/max(blocklist.lookups, 1)*1000000:.2f} us per lookup, "
+              f"{listed} listed IP addresses of devices")
+    if engine and engine.status == 3:
+        print("offline:     NumPy not installed")
+    elif engine and engine.status:
+        print("offline:     capture could not be processed")
+    elif engine:
+        print(f"offline:     {engine.elapsed:.2f} s ({engine.pkts/max(engine.elapsed, 0.001):.0f} packets/s, "
+              f"{elapsed/max(engine.elapsed, 0.001):.1f}x faster), {rss_mb()-rss_offline:.1f} MB RSS "
+              f"for capture data")
+
+
+if __name__ == '__main__':
+    main()
@@ -9,11 +9,22 @@
 # Copyright 2021, 2022 Jiri Rozvaril <rozvara at vync dot org>
 
 import os
+import re
 import stat
+import time
+import shlex
+import signal
 import argparse
 from datetime import datetime
 from wireowl_tui import run_ui
-from wireowl_backend import TrafficInspector, PacketReader
+from wireowl_backend import TrafficInspector, PacketReader, PreserveWriter, Blocklist, compression_of
+from wireowl_common import PROFILER
+from wireowl_metrics import MetricsServer
+from wireowl_daemon import StateServer, RemoteInspector, RemoteReader
+from wireowl_alerts import AlertEngine
+from wireowl_export import NDJSONExporter
+from wireowl_db import DatabaseWriter, load_database
+from wireowl_numpy import OfflineEngine
 
 
 def check_file_type(pathname):
@@ -21,23 +32,60 @@ def check_file_type(pathname):
         if stat.S_ISFIFO(os.stat(pathname).st_mode):
             return 'pipe'
         if os.path.isfile(pathname):
-            return 'file'
+            return compression_of(pathname) or 'file'
     except:
         pass
     return None
 
 
+# tshark arguments of a fields profile defined in fields.conf (bash syntax)
+#
+def tshark_fields(profile):
+    conf = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fields.conf')
+    try:
+        with open(conf) as f:
+            text = f.read().replace('\\\n', '')
+    except:
+        return []
+    variables = {}
+    for name, value in re.findall(r'^(\w+)="([^"]*)"', text, re.M):
+        variables[name] = re.sub(r'\$(\w+)', lambda m: variables.get(m.group(1), ''), value)
+    return shlex.split(variables.get('FIELDS_' + profile.upper(), ''))
+
+
+# tshark capturing on interface into stdout (512 bytes because of DNS queries)
+#
+def tshark_command(interface, fields, capture_filter):
+    cmd = ['tshark', '-l', '-n', '-Q', '-s', '512'] + fields + ['-i', interface]
+    if capture_filter:
+        cmd += ['-f', capture_filter]
+    return cmd
+
+
 def main():
     parser = argparse.ArgumentParser(description= \
         """Shows devices in network traffic and statistics of their connections.
-        Input file must be in a tab-delimited format exported from tshark(1).
-        It could be already exported .csv file or .pcap/realtime capture
-        with tshark's stdout redirected into a named pipe.
+        Input file must be in a tab-delimited format exported from tshark(1)
+        with header row (-E header=y), columns are mapped by field names.
+        It could be already exported .csv file (also gzip/xz/bzip2 compressed)
+        or .pcap/realtime capture with tshark's stdout redirected into a named pipe.
         If you have no .csv file ready, run shell script 'wireowl' instead.""")
 
-    parser.add_argument(dest='filename', metavar='PATHNAME', type=str,
+    parser.add_argument(dest='filename', metavar='PATHNAME', type=str, nargs='?',
         help="path name of tab delimited text file or named pipe")
 
+    parser.add_argument('-i', '--interface', dest='interfaces', metavar='IFACE',
+        type=str, action='append',
+        help="""runs and supervises tshark capturing on network interface IFACE instead
+        of reading PATHNAME; repeat for more interfaces (packets are merged in time order).""")
+
+    parser.add_argument('--fields', dest='fields', metavar='PROFILE', type=str, default='full',
+        choices=('full', 'lite', 'minimal'),
+        help="fields profile from fields.conf for tshark run with -i (default full).")
+
+    parser.add_argument('--capture-filter', dest='capture_filter', metavar='BPF', type=str,
+        help="capture filter for tshark run with -i.")
+
     parser.add_argument('-s', '--speed', dest='speed', metavar='SPEED',
         type=int, default=0,
         help="""replay speed of traffic recorded in .pcap/.csv file,
@@ -51,31 +99,246 @@ def main():
     parser.add_argument('-p', '--preserve', dest='preserve_data', action='store_true',
         help="keeps network packets data in a tab delimited text file located in /tmp folder.")
 
+    parser.add_argument('--compress', dest='compress', metavar='FORMAT', type=str,
+        choices=('gz', 'xz'),
+        help="compresses preserved data on the fly (gz or xz).")
+
+    parser.add_argument('--rotate-size', dest='rotate_size', metavar='MB', type=int, default=0,
+        help="starts a new preserved file when the current one reaches MB megabytes.")
+
+    parser.add_argument('--rotate-time', dest='rotate_time', metavar='MINUTES', type=int, default=0,
+        help="starts a new preserved file every MINUTES minutes.")
+
+    parser.add_argument('--rotate-keep', dest='rotate_keep', metavar='FILES', type=int, default=0,
+        help="keeps only the last FILES rotated files (default all).")
+
+    parser.add_argument('--alert-volume', dest='alert_volume', metavar='MB', type=int, default=100,
+        help="alerts when a connection transfers more than MB megabytes (0 disables, default 100).")
+
+    parser.add_argument('--alert-domain', dest='alert_domains', metavar='DOMAIN', type=str,
+        action='append', default=[],
+        help="alerts on DNS answers for DOMAIN or its subdomains (repeatable).")
+
+    parser.add_argument('--blocklist', dest='blocklists', metavar='FILENAME', type=str,
+        action='append', default=[],
+        help="""highlights connections to domains (and their subdomains) listed in FILENAME:
+        list of domains, hosts file or adblock '||domain^' rules (repeatable).""")
+
+    parser.add_argument('--export', dest='export', metavar='FILENAME', type=str,
+        help="""exports data of all devices into FILENAME as newline delimited JSON at exit
+        (and periodically with --export-interval, then only what has changed).""")
+
+    parser.add_argument('--export-interval', dest='export_interval', metavar='MINUTES',
+        type=int, default=0,
+        help="exports every MINUTES minutes into --export file (default only at exit).")
+
+    parser.add_argument('--db', dest='db', metavar='FILENAME', type=str,
+        help="""keeps aggregates of devices, connections (also per minute) and DNS answers
+        in SQLite database FILENAME, written in background every few seconds.""")
+
+    parser.add_argument('--load-db', dest='load_db', metavar='FILENAME', type=str,
+        help="shows data of SQLite database FILENAME written with --db, no PATHNAME needed.")
+
+    parser.add_argument('--offline', dest='offline', action='store_true',
+        help="""processes whole file PATHNAME at once by NumPy engine (about 4x faster,
+        without flows and alerts) and then shows the result.""")
+
+    parser.add_argument('--filter', dest='filter_label', metavar='TEXT', type=str, default='',
+        help="description of capture/display filter used by tshark, shown in status bar.")
+
+    parser.add_argument('--profile', dest='profile', metavar='FILENAME', type=str,
+        help="""saves latency histograms of processing stages (reading, parsing,
+        locking, processing, geolocation, content building, drawing) into a file at exit.""")
+
+    parser.add_argument('--metrics', dest='metrics', metavar='ADDRESS', type=str,
+        help="""serves counters in Prometheus text format on local HTTP port,
+        e.g. 9100 or 127.0.0.1:9100, or on Unix socket when ADDRESS is a path name.""")
+
+    parser.add_argument('--metrics-connections', dest='metrics_conns', action='store_true',
+        help="includes counters per connection (device and IP address) in metrics.")
+
+    parser.add_argument('--daemon', dest='daemon', metavar='SOCKET', type=str,
+        help="""runs without UI and serves captured data to clients attached
+        via Unix socket SOCKET (until terminated).""")
+
+    parser.add_argument('--attach', dest='attach', metavar='SOCKET', type=str,
+        help="shows data of wireowl daemon listening on Unix socket SOCKET, no PATHNAME needed.")
+
     args = parser.parse_args()
 
-    if not check_file_type(args.filename):
-        print(f"\nError: file/pipe '{args.filename}' not found.\n")
-        quit()
+    if args.offline and args.interfaces:
+        parser.error("--offline analyzes PATHNAME, it cannot capture on --interface")
+
+    if args.attach:
+        run_attached(args.attach)
+        return
+
+    if args.load_db:
+        run_loaded(args.load_db)
+        return
 
+    if args.interfaces:
+        fields = tshark_fields(args.fields)
+        if not fields:
+            print(f"\nError: fields profile '{args.fields}' not found in fields.conf.\n")
+            quit()
+        read_from = [tshark_command(i, fields, args.capture_filter) for i in args.interfaces]
+    else:
+        if not args.filename:
+            parser.error("PATHNAME or --interface is required unless attaching to daemon or loading database")
+        if not check_file_type(args.filename):
+            print(f"\nError: file/pipe '{args.filename}' not found.\n")
+            quit()
+        read_from = args.filename
+
+    if args.offline:
+        run_offline(args)
+        return
+
+    out_file = None
+    writer = None
     if args.preserve_data:
         out_file = '/tmp/wireowl-' + datetime.now().strftime('%Y%m%d-%H%M%S-%f') + '.csv'
-    else:
-        out_file = None
+        writer = PreserveWriter(out_file, args.compress, args.rotate_size*1024*1024,
+                                args.rotate_time*60, args.rotate_keep)
+
+    blocklist = None
+    if args.blocklists:
+        blocklist = Blocklist(args.blocklists)
+        if blocklist.status:
+            print(f"\nError: cannot read blocklist {', '.join(args.blocklists)}.\n")
+            quit()
+
+    alerts = AlertEngine(args.alert_volume*1024*1024, args.alert_domains)
+    worker = TrafficInspector(alerts, blocklist)
+    reader = PacketReader(read_from, worker, args.speed, args.limit, writer,
+                          args.filter_label)
+
+    metrics = None
+    if args.metrics:
+        metrics = MetricsServer(args.metrics, worker, reader, connections=args.metrics_conns)
+        if metrics.status:
+            print(f"\nError: cannot serve metrics on '{args.metrics}'.\n")
+            quit()
+
+    exporter = None
+    if args.export:
+        exporter = NDJSONExporter(args.export, worker, args.export_interval*60)
 
-    worker = TrafficInspector()
-    reader = PacketReader(args.filename, worker, args.speed, args.limit, out_file)
+    database = None
+    if args.db:
+        database = DatabaseWriter(args.db, worker, reader)
+        if database.status:
+            print(f"\nError: cannot open database '{args.db}'.\n")
+            quit()
+
+    server = None
+    if args.daemon:
+        server = StateServer(args.daemon, worker, reader)
+        if server.status:
+            print(f"\nError: cannot listen on socket '{args.daemon}'.\n")
+            quit()
 
     reader.start()
-    run_ui(worker, reader)
+    if metrics:
+        metrics.start()
+    if exporter:
+        exporter.start()
+    if database:
+        database.start()
+    if server:
+        server.start()
+        wait_for_termination(args.daemon)
+        server.stop()
+    else:
+        run_ui(worker, reader)
+    if metrics:
+        metrics.stop()
     reader.stop()
+    if exporter and not exporter.stop():
+        print(f"Could not export to {args.export}.")
+    if database and not database.stop():
+        print(f"Could not write to database {args.db}.")
+
+    if args.profile and not PROFILER.dump(args.profile):
+        print(f"Could not write profile to {args.profile}.")
 
     status = reader.get_statuses()
     if status['err']:
         print("Packet reader error: ", end='')
-        if status['err'] < 10:
-            print("not a tab delimited format/wrong number of columns/wrong columns order.")
+        if status['err'] == 4:
+            print("tshark could not capture (check interface name and permissions).")
+        elif status['err'] < 10:
+            print("not a tab delimited format with header/required columns missing.")
         elif status['err'] > 10:
-            print(f"could not write to output file {out_file}.")
+            print(f"could not write to output file {writer.filename or out_file}.")
+    elif status['fail']:
+        print("tshark could not capture on " + ', '.join(status['fail']) + '.')
+    if status['pdrop']:
+        print(f"{status['pdrop']} rows not preserved (disk too slow).")
+
+
+# daemon runs until Ctrl-C or kill
+#
+def wait_for_termination(socket_path):
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, terminate)
+    print(f"wireowl daemon is serving on {socket_path}, attach with: wireowl.py --attach {socket_path}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+
+# TUI showing data of a running daemon
+#
+def run_attached(socket_path):
+    remote = RemoteInspector(socket_path)
+    if remote.status:
+        print(f"\nError: cannot connect to wireowl daemon on '{socket_path}'.\n")
+        quit()
+    reader = RemoteReader(remote)
+    run_ui(remote, reader)
+    reader.stop()
+    if remote.status:
+        print("Connection to wireowl daemon lost.")
+
+
+# TUI showing data loaded from database
+#
+def run_loaded(pathname):
+    worker, reader = load_database(pathname)
+    if worker is None:
+        print(f"\nError: cannot read database '{pathname}'.\n")
+        quit()
+    run_ui(worker, reader)
+
+
+# TUI showing data of a file processed by offline engine
+#
+def run_offline(args):
+    if check_file_type(args.filename) == 'pipe':
+        print("\nError: offline processing needs a file, not a pipe.\n")
+        quit()
+    blocklist = None
+    if args.blocklists:
+        blocklist = Blocklist(args.blocklists)
+        if blocklist.status:
+            print(f"\nError: cannot read blocklist {', '.join(args.blocklists)}.\n")
+            quit()
+    engine = OfflineEngine(args.filename, blocklist, args.limit)
+    print(f"Processing {args.filename}...")
+    if not engine.run():
+        if engine.status == 3:
+            print("\nError: offline processing needs NumPy (pip install numpy).\n")
+        elif engine.status == 2:
+            print("\nError: not a tab delimited format with header/required columns missing.\n")
+        else:
+            print(f"\nError: cannot read '{args.filename}'.\n")
+        quit()
+    run_ui(engine.worker, engine.get_reader())
 
 
 if __name__ == '__main__':
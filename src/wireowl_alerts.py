@@ -0,0 +1,156 @@
+# -*- coding: utf8 -*-
+
+# This file is part of wireowl which is released under GNU GPLv2 license.
+#
+# Copyright 2021, 2022 Jiri Rozvaril <rozvara at vync dot org>
+
+from collections import deque
+from time import perf_counter
+
+# alerts kept in log (the oldest are dropped)
+ALERT_LOG = 1000
+# default volume of one connection (sent+received bytes) to alert on
+ALERT_VOLUME = 100*1024*1024
+
+
+class AlertEngine():
+    """
+    Rules evaluated by TrafficInspector (under its lock) when something happens: new connection
+    of a device, packet of a connection, DNS answer. Rules are grouped by event, so only rules
+    interested in the event run; raised alerts are logged and counted per device and per rule.
+    """
+    def __init__(self, volume=ALERT_VOLUME, domains=(), size=ALERT_LOG):
+        self.rules = {'conn': [], 'packet': [], 'dns': []}  # rules by event
+        self.log = deque(maxlen=size)   # (time, mac, ip, rule name, text), the oldest first
+        self.raised = 0                 # alerts raised in total
+        self.add_rule(NoDNSRule())
+        self.add_rule(NewCountryRule())
+        if volume:
+            self.add_rule(VolumeRule(volume))
+        if domains:
+            self.add_rule(DomainRule(domains))
+        self.on_packet = bool(self.rules['packet'])  # devices skip packet event if False
+
+    def add_rule(self, rule):
+        self.rules[rule.event].append(rule)
+
+    def evaluate(self, event, device, ip, tm, *args):
+        for rule in self.rules[event]:
+            started = perf_counter()
+            text = rule.check(device, ip, *args)
+            rule.cost += perf_counter() - started
+            rule.checks += 1
+            if text:
+                rule.hits += 1
+                self.raised += 1
+                device.alerts_raised += 1
+                self.log.append((tm, device.my_macaddress, ip, rule.name, text))
+
+    # events (device is MacAddrDevice, conn is IPConnection)
+    def connection(self, device, ip, conn, tm):
+        self.evaluate('conn', device, ip, tm, conn)
+
+    def packet(self, device, ip, conn, vol, tm):
+        self.evaluate('packet', device, ip, tm, conn, vol)
+
+    def dns_answer(self, device, domain, ips, tm):
+        self.evaluate('dns', device, ', '.join(sorted(ips)), tm, domain)
+
+    def forget_device(self, mac):
+        # device's statistics were cleared, rules forget what they remember of it
+        for rules in self.rules.values():
+            for rule in rules:
+                rule.forget_device(mac)
+
+    def alerts(self):
+        # newest first
+        return list(reversed(self.log))
+
+    def rules_statistics(self):
+        # (name, description, hits, checks, seconds spent)
+        return [(r.name, r.description, r.hits, r.checks, r.cost) \
+                for rules in self.rules.values() for r in rules]
+
+
+class Rule():
+    # base of rules; check() returns text of alert or None
+    event = None
+    name = ''
+    description = ''
+
+    def __init__(self):
+        self.hits = 0                   # alerts raised
+        self.checks = 0                 # times evaluated
+        self.cost = 0.0                 # seconds spent in check()
+
+    def check(self, device, ip, *args):
+        return None
+
+    def forget_device(self, mac):
+        pass
+
+
+class NoDNSRule(Rule):
+    # new global IP address without DNS answer (ALERTDOMAIN in detail view)
+    event = 'conn'
+    name = 'nodns'
+    description = "global IP address without DNS answer"
+
+    def check(self, device, ip, conn):
+        if conn.global_ip and not conn.multicast_ip and ip not in device.dns.ips:
+            return "no DNS answer for global IP address"
+
+
+class NewCountryRule(Rule):
+    # first connection of a device to a country (except the first country of device)
+    event = 'conn'
+    name = 'country'
+    description = "connection to a new country"
+
+    def __init__(self):
+        super().__init__()
+        self.countries = {}             # {mac:set(country code)}
+
+    def check(self, device, ip, conn):
+        if conn.country:
+            seen = self.countries.setdefault(device.my_macaddress, set())
+            if conn.country not in seen:
+                seen.add(conn.country)
+                if len(seen) > 1:
+                    return f"new country {conn.country}"
+
+    def forget_device(self, mac):
+        self.countries.pop(mac, None)
+
+
+class VolumeRule(Rule):
+    # connection volume crosses the limit (once per connection)
+    event = 'packet'
+    name = 'volume'
+
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit              # bytes sent+received
+        self.description = f"connection over {limit//(1024*1024)} MB"
+
+    def check(self, device, ip, conn, vol):
+        total = conn.tx_bytes + conn.rx_bytes
+        if total >= self.limit > total - vol:
+            return f"over {self.limit//(1024*1024)} MB transferred"
+
+
+class DomainRule(Rule):
+    # DNS answer for a listed domain or its subdomain
+    event = 'dns'
+    name = 'domain'
+    description = "DNS answer for listed domain"
+
+    def __init__(self, domains):
+        super().__init__()
+        self.domains = {d.lower().strip('.') for d in domains}
+
+    def check(self, device, ip, domain):
+        labels = domain.lower().split('.')
+        for i in range(len(labels)):
+            if '.'.join(labels[i:]) in self.domains:
+                return f"DNS answer for {domain}"
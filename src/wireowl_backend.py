@@ -4,23 +4,124 @@
 #
 # Copyright 2021, 2022 Jiri Rozvaril <rozvara at vync dot org>
 
+import io
+import os
 import time
+import math
+import heapq
+import bz2
+import zlib
+import gzip
+import lzma
+import shutil
 import threading
 import ipaddress
 import subprocess
-from collections import deque
+from sys import intern, getsizeof
+from array import array
+from bisect import bisect_left, bisect_right
+from time import perf_counter
+from collections import deque, OrderedDict
+from wireowl_common import PROFILER
+
+# columns of a packet as used by backend; columns exported by tshark are mapped
+# by names in header row (see fields.conf), in any order, missing ones are empty
+COLUMNS = ('frame.time_epoch', 'eth.src', 'eth.dst',
+           'ip.src', 'ip.dst', 'ipv6.src', 'ipv6.dst',
+           'tcp.srcport', 'tcp.dstport', 'tcp.stream',
+           'udp.srcport', 'udp.dstport', 'udp.stream',
+           '_ws.col.Protocol', 'dhcp.option.hostname', 'dhcp.option.dhcp',
+           'dns.flags.response', 'dns.qry.name', 'dns.cname', 'dns.a', 'dns.aaaa',
+           'dns.nsec.next_domain_name', 'dns.ptr.domain_name',
+           'dns.resp.name', 'dns.srv.name', 'dns.srv.proto',
+           'dns.srv.service', 'dns.srv.target', 'dns.txt', 'dns.resp.ttl',
+           'frame.len', 'tcp.len', '_ws.col.Info')
 
-# expected columns exported by tshark (see fields.conf)
 P_TIME, P_ETHSRC, P_ETHDST, \
 P_IPSRC, P_IPDST, P_IPV6SRC, P_IPV6DST, \
 P_TCPSRCPORT, P_TCPDSTPORT, P_TCPSTREAM, \
 P_UDPSRCPORT, P_UDPDSTPORT, P_UDPSTREAM, \
-P_PROTOCOL, P_DHCPHOSTNAME, \
-P_DNSQRYNAME, P_DNSCNAME, P_DNSA, P_DNSAAAA, \
-P_DNSNSECNEXTDOMAINNAME, P_DNSPTRDOMAINNAME, P_DNSQRYNAME, \
+P_PROTOCOL, P_DHCPHOSTNAME, P_DHCPTYPE, \
+P_DNSRESPONSE, P_DNSQRYNAME, P_DNSCNAME, P_DNSA, P_DNSAAAA, \
+P_DNSNSECNEXTDOMAINNAME, P_DNSPTRDOMAINNAME, \
 P_DNSRESPNAME, P_DNSSRVNAME, P_DNSSRVPROTO, \
-P_DNSSRVSERVICE, P_DNSSRVTARGET, P_DNSTXT, \
-P_FRAMELEN, P_TCPLEN, P_INFO, COLUMNS_EXPECTED = range(32)
+P_DNSSRVSERVICE, P_DNSSRVTARGET, P_DNSTXT, P_DNSTTL, \
+P_FRAMELEN, P_TCPLEN, P_INFO, COLUMNS_EXPECTED = range(len(COLUMNS)+1)
+
+# columns without which packets cannot be processed
+COLUMNS_REQUIRED = ('frame.time_epoch', 'eth.src', 'eth.dst', '_ws.col.Protocol', 'frame.len')
+
+# packet reader: how long to wait for a source with no packets when merging more sources (sec),
+# how often to look for its packets meanwhile (sec)
+MERGE_WAIT = 0.5
+MERGE_POLL = 0.01
+# packet reader: tshark restarts without any packet captured before giving up
+TSHARK_FAILURES = 5
+
+# DNS answers kept per device: IP addresses, domain names per IP address
+DNS_CAPACITY = 4096
+DNS_NAMES_PER_IP = 8
+
+# TCP/UDP flows: seconds of inactivity after which flow is forgotten, max. flows kept
+FLOW_IDLE = 300
+FLOW_CAPACITY = 65536
+
+# shared across devices: strings (MACs, IPs, domains, labels) kept by devices are interned,
+# so 300 phones resolving the same domains hold references to one copy of each string;
+# protocol labels and information about IP addresses are cached (up to max. entries)
+PROTOCOL_LABELS = {}                    # {(protocol, udp port, tcp port):label}
+PROTOCOL_LABELS_MAX = 4096
+IP_INFO = {}                            # {ip:(global, private, multicast, reserved, version, country)}
+IP_INFO_MAX = 65536
+GEOIPLOOKUP = {4: shutil.which('geoiplookup'), 6: shutil.which('geoiplookup6')}
+
+# traffic rates: windows of exponential moving averages (sec)
+RATE_WINDOWS = (10, 60, 300)
+RATE_ALPHAS = tuple(1 - math.exp(-1/w) for w in RATE_WINDOWS)
+
+# event history: events kept per device (the oldest quarter is dropped over it), seconds kept,
+# strings kept before the ones of dropped events are forgotten (when their number doubles)
+HISTORY_EVENTS = 16384
+HISTORY_RETENTION = 24*3600
+HISTORY_STRINGS = 1024
+# kinds of events: first packet of connection, DNS answer, volume of connection in a minute
+E_CONN, E_DNS, E_VOL = range(3)
+
+# top talkers: (device, IP address) pairs kept, seconds in which volume decays to 1/e,
+# seconds between sweeps of pairs out of top with decayed volume under TOP_FORGET bytes
+TOP_TALKERS = 100
+TOP_DECAY = 60
+TOP_SWEEP = 60
+TOP_FORGET = 1
+
+# memory accounting: min. seconds between estimates of one device (taken by packet reader's
+# monitor when device has changed, not by UI refresh), structures estimated;
+# sizes of small objects and of one entry of dict/set (averaged, tables grow in steps),
+# strings are shared by devices and not counted
+MEMORY_SAMPLE = 5
+MEMORY_STRUCTURES = ('conn', 'graph', 'dns', 'mdns', 'prot', 'hist')
+INT_SIZE = getsizeof(2**31)             # time/volume (small ints are cached by python)
+ANSWER_SIZE = getsizeof((0.0, 0)) + getsizeof(0.0)  # DNS answer (time, ttl)
+DICT_SIZE = getsizeof({})
+DICT_ENTRY = getsizeof(dict.fromkeys(range(1024))) // 1024
+SET_SIZE = getsizeof(set())
+SET_ENTRY = getsizeof(set(range(1024))) // 1024
+
+# blocklists: domain verdicts cached (cache is cleared when full)
+BLOCKLIST_CACHE = 65536
+# names in hosts files which are not blocked domains
+BLOCKLIST_IGNORED = {'localhost', 'localhost.localdomain', 'local', 'broadcasthost',
+                     'ip6-localhost', 'ip6-loopback', '0.0.0.0'}
+
+# compressed input: magic bytes and python decompressor of tools, bytes read at once
+DECOMPRESSORS = {'gzip': (b'\x1f\x8b', lambda: zlib.decompressobj(wbits=31)),
+                 'xz': (b'\xfd7zXZ\x00', lzma.LZMADecompressor),
+                 'bzip2': (b'BZh', bz2.BZ2Decompressor)}
+DECOMPRESS_CHUNK = 256*1024
+
+# preserve writer: max bytes waiting to be written, bytes written at once
+PRESERVE_BUFFER = 64*1024*1024
+PRESERVE_BATCH = 1024*1024
 
 # information to dig from mDNS (multicast) packets
 MDNS_KEYS = [('dns.qry.name',              P_DNSQRYNAME),
@@ -33,6 +134,13 @@ MDNS_KEYS = [('dns.qry.name',              P_DNSQRYNAME),
              ('dns.srv.target',            P_DNSSRVTARGET),
              ('dns.txt',                   P_DNSTXT)]
 
+# latency histograms of processing stages (shown in debug overlay);
+# reading line from file/pipe is recorded by each PacketSource into own part of 'read'
+H_PARSE = PROFILER.histogram('parse')      # splitting line into columns
+H_LOCK = PROFILER.histogram('lock')        # waiting for TrafficInspector._lock
+H_PROCESS = PROFILER.histogram('process')  # TrafficInspector.process_packet
+H_GEO = PROFILER.histogram('geo')          # geolocation of new IP address
+
 
 #    #          ######
  #    #         #     #   ##    ####  #    # ###### #    # #####
@@ -47,57 +155,100 @@ class TrafficInspector():
     """
     Inspects packets and updates data of devices and their communication
     """
-    def __init__(self):
+    def __init__(self, alerts=None, blocklist=None):
         self.devices = {}               # all devices (dict: 'macaddr':MacAddrDevice)
         self.clients = set()            # client's devices, set of keys/mac addresses
         self.last_pkt_time = 0          # time of last processed packet
+        self.flows = FlowTable()        # TCP/UDP flows by stream index
+        self.talkers = TopTalkers()     # (device, IP address) pairs by recent volume
+        self.alerts = alerts            # AlertEngine (or None), devices raise alerts into it
+        self.blocklist = blocklist      # Blocklist (or None), devices check DNS answers in it
+        self.sorted_devices = []        # sorted keys of devices (updated when device is added)
+        self.sorted_clients = []        # sorted keys of clients
+        self.memory = {'flows': 0, 'talkers': 0}  # estimates of shared structures
         self._lock = threading.Lock()
 
     def process_packet(self, pkt):
+        tm = perf_counter()
         with self._lock:
-            self.last_pkt_time = float(pkt[P_TIME])
+            locked = perf_counter()
+            H_LOCK.add(locked - tm)
+            self.last_pkt_time = pkt.time
             self.mac_addresses_update(pkt)
             # always update src
-            self.devices[pkt[P_ETHSRC]].inspect_packet_and_update(pkt)
+            ipaddr = self.devices[pkt.eth_src].inspect_packet_and_update(pkt)
+            if ipaddr:
+                self.talkers.add(pkt.eth_src, ipaddr, pkt.time, pkt.length)
             # update dst when recognized
-            if pkt[P_ETHDST] in self.devices:
-                self.devices[pkt[P_ETHDST]].inspect_packet_and_update(pkt)
+            if pkt.eth_dst in self.devices:
+                ipaddr = self.devices[pkt.eth_dst].inspect_packet_and_update(pkt)
+                if ipaddr:
+                    self.talkers.add(pkt.eth_dst, ipaddr, pkt.time, pkt.length)
+            self.flows.update(pkt)
+            H_PROCESS.add(perf_counter() - locked)
 
     def mac_addresses_update(self, pkt):
         # Checks and adds new devices and/or new clients
-        if not pkt[P_ETHSRC] in self.devices:
-            self.devices[pkt[P_ETHSRC]] = MacAddrDevice(pkt[P_ETHSRC])
+        if not pkt.eth_src in self.devices:
+            macaddr = intern(pkt.eth_src)
+            self.devices[macaddr] = MacAddrDevice(macaddr, self.alerts, self.blocklist)
+            self.sorted_devices = sorted(self.devices.keys())
         # uncoment if interested in all ethdst (eg. broadcasts)
-        ##### if not pkt[P_ETHDST] in self.devices:
-        #####     self.devices[pkt[P_ETHDST]] = MacAddrDevice(pkt[P_ETHDST])
-
-        # check/add clients (based on dhcp or dns requests)
-        if pkt[P_PROTOCOL] == 'DNS' and pkt[P_INFO].startswith('Standard query 0x'):
-            self.clients.add(pkt[P_ETHSRC])
-        elif pkt[P_PROTOCOL] == 'DHCP' and pkt[P_INFO].startswith('DHCP ACK') and \
-            pkt[P_IPDST] != '255.255.255.255':
-            self.clients.add(pkt[P_ETHDST])
+        ##### if not pkt.eth_dst in self.devices:
+        #####     self.devices[pkt.eth_dst] = MacAddrDevice(pkt.eth_dst)
+
+        # check/add clients (based on dhcp or dns requests);
+        # Info column is used only for captures exported without dns/dhcp flags
+        cols = pkt.cols
+        if pkt.protocol == 'DNS':
+            if cols[P_DNSRESPONSE] in ('0', 'False') or \
+                (not cols[P_DNSRESPONSE] and cols[P_INFO].startswith('Standard query 0x')):
+                self.client_update(pkt.eth_src)
+        elif pkt.protocol == 'DHCP' and cols[P_IPDST] != '255.255.255.255':
+            if cols[P_DHCPTYPE] == '5' or \
+                (not cols[P_DHCPTYPE] and cols[P_INFO].startswith('DHCP ACK')):  # 5=ACK
+                self.client_update(pkt.eth_dst)
+
+    def client_update(self, macaddr):
+        if macaddr not in self.clients:
+            self.clients.add(intern(macaddr))
+            self.sorted_clients = sorted(self.clients)
 
     def get_devices(self):
-        with self._lock:
-            ret = list(self.devices.keys())
-        ret.sort()
-        return ret
+        return list(self.sorted_devices)
 
     def get_clients(self):
+        return list(self.sorted_clients)
+
+    def get_devices_summary(self, ui_time):
+        # statistics of all devices for list view at once, tuples of
+        # (mac, fa, la, rx, tx, dnsq, dnsd, conn, pkts, ip, rate, alerts)
         with self._lock:
-            ret = list(self.clients)
-        ret.sort()
+            ret = [d.device_summary(ui_time, self.last_pkt_time) for d in self.devices.values()]
         return ret
 
     def get_device_statistics(self, macaddr, ui_time):
         with self._lock:
-            ret = self.devices[macaddr].device_statistics(ui_time)
+            ret = self.devices[macaddr].device_statistics(ui_time, self.last_pkt_time)
         return ret
 
-    def get_device_connections(self, macaddr, ui_time):
+    def get_all_device_statistics(self, ui_time):
+        # statistics of all devices at once {mac:stats} (one lock for all)
         with self._lock:
-            ret = self.devices[macaddr].connections_list(ui_time)
+            ret = {mac: d.device_statistics(ui_time, self.last_pkt_time)
+                   for mac, d in self.devices.items()}
+        return ret
+
+    def get_device_connections(self, macaddr, ui_time, names=False):
+        # {ip:statistics} of device's connections, with names of IP addresses ('name' and
+        # 'rname' by recent DNS answers) when asked for
+        with self._lock:
+            dev = self.devices[macaddr]
+            ret = dev.connections_list(ui_time, self.last_pkt_time)
+            if names:
+                for ip, dct in ret.items():
+                    dct['name'] = dev.ip_name(ip)
+                    dct['rname'] = dev.ip_name(ip, True)
         return ret
 
     def get_device_dnsreplies(self, macaddr):
@@ -120,8 +271,81 @@ class TrafficInspector():
             ret = self.devices[macaddr].mdns_list()
         return ret
 
-    def get_device_ip_name(self, macaddr, ip):
-        ret = self.devices[macaddr].ip_name(ip)
+    def get_device_ip_name(self, macaddr, ip, recent=False):
+        with self._lock:
+            ret = self.devices[macaddr].ip_name(ip, recent)
+        return ret
+
+    def get_device_flows(self, macaddr, ui_time):
+        # {ip:[flow statistics...]} of device's connections
+        with self._lock:
+            connections = self.devices[macaddr].connections
+            ret = {ip: [flow.flow_statistics(macaddr, ui_time) for flow in flows] \
+                    for ip, flows in self.flows.device_flows(macaddr).items() if ip in connections}
+        return ret
+
+    def get_top_talkers(self, ui_time):
+        # (mac, ip, recent volume, name, tx, rx, la) of pairs with most traffic recently
+        with self._lock:
+            ret = []
+            for mac, ip, recent in self.talkers.top(self.last_pkt_time):
+                conn = self.devices[mac].connections[ip]
+                ret.append((mac, ip, recent, self.devices[mac].ip_name(ip, True),
+                            conn.tx_bytes, conn.rx_bytes, conn.last_touch - ui_time))
+        return ret
+
+    def get_alerts(self):
+        # (time, mac, ip, rule, text), newest first
+        with self._lock:
+            ret = self.alerts.alerts() if self.alerts else []
+        return ret
+
+    def get_alert_rules(self):
+        # (rule, description, hits, checks, seconds spent)
+        with self._lock:
+            ret = self.alerts.rules_statistics() if self.alerts else []
+        return ret
+
+    def get_device_history(self, macaddr, start, end):
+        # connections of device between start and end (from event history)
+        with self._lock:
+            ret = self.devices[macaddr].history.summary(start, end)
+        return ret
+
+    def get_memory_usage(self):
+        # approximate bytes by structure of all devices ({'conn', 'graph'...}), of flows and
+        # top talkers, and number of devices; the last estimates taken are only summed
+        # (estimates are replaced, not changed, so they are referenced under lock only)
+        with self._lock:
+            estimates = [dev.memory for dev in self.devices.values()]
+            shared = self.memory
+        ret = dict.fromkeys(MEMORY_STRUCTURES, 0)
+        for memory in estimates:
+            if memory:  # none taken yet
+                for key, value in memory.items():
+                    ret[key] += value
+        ret.update(shared)
+        ret['devices'] = len(estimates)
+        return ret
+
+    def update_memory_estimates(self):
+        # estimates of devices changed since their last one, lock is taken per device
+        # (called every second by packet reader's monitor, and once when data are loaded)
+        now = time.monotonic()
+        for mac in self.get_devices():
+            with self._lock:
+                dev = self.devices.get(mac)
+                if dev and dev.memory_outdated(now):
+                    dev.update_memory()
+        with self._lock:
+            self.memory = {'flows': self.flows.memory_estimate(),
+                           'talkers': self.talkers.memory_estimate()}
+
+    def get_device_search(self, macaddr, query):
+        # IP addresses of device's connections with name, address, country
+        # or protocol containing query
+        with self._lock:
+            ret = sorted(self.devices[macaddr].search(query))
         return ret
 
     def get_device_ip_tx_min_graph(self, macaddr, ip, ui_time):
@@ -144,36 +368,93 @@ class TrafficInspector():
             ret = self.devices[macaddr].connections[ip].rx_sec_graph_data(ui_time)
         return ret
 
+    def get_metrics_snapshot(self):
+        # only references are copied under the lock (microseconds even for thousands
+        # of devices); counters are read afterwards without it, each value is consistent
+        # on its own which is all what metrics need
+        with self._lock:
+            devices = list(self.devices.values())
+            clients = self.clients.copy()
+        ret = []
+        for dev in devices:
+            conns = [(ip, c.tx_bytes, c.rx_bytes, c.tx_pkts, c.rx_pkts) \
+                        for ip, c in list(dev.connections.items())]
+            ret.append((dev.my_macaddress, dev.my_macaddress in clients,
+                        dev.tx_bytes, dev.rx_bytes, dev.tx_pkts, dev.rx_pkts,
+                        dev.dns_queries, dev.dns_replies, conns))
+        return ret
+
     def clear_device_stats(self, macaddr):
         with self._lock:
             self.devices[macaddr].clear_statistics()
+            self.flows.forget_device(macaddr)
+            self.talkers.forget_device(macaddr)
+            if self.alerts:
+                self.alerts.forget_device(macaddr)
 
     def clear_device_all(self, macaddr):
         with self._lock:
-            self.devices[macaddr] = MacAddrDevice(macaddr)
+            self.devices[macaddr] = MacAddrDevice(macaddr, self.alerts, self.blocklist)
+            self.flows.forget_device(macaddr)
+            self.talkers.forget_device(macaddr)
+            if self.alerts:
+                self.alerts.forget_device(macaddr)
 
     def export_device(self, macaddr, ui_time):
+        # text is made under the lock, file is written without it
         with self._lock:
-            try:
-                wf = open(f"/tmp/wireowl-export-{macaddr.replace(':','')}-{int(ui_time)}.txt", 'w')
-                wf.write(f"DEVICE {macaddr} @ {ui_time}\n")
-                wf.write(f"{self.devices[macaddr].device_statistics(ui_time)}\n\n")
-                wf.write("CONNECTIONS LIST\n")
-                wf.write(f"{self.devices[macaddr].connections_list(ui_time)}\n\n")
-                wf.write("IP->DOMAINS\n")
-                wf.write(f"{self.devices[macaddr].dns_reply_list()}\n\n")
-                wf.write("DOMAIN->IPs\n")
-                wf.write(f"{self.devices[macaddr].domain_ips_list()}\n\n")
-                wf.write("CNAMES\n")
-                wf.write(f"{self.devices[macaddr].dns_cnames_list()}\n\n")
-                wf.write("SRV TARGETS\n")
-                wf.write(f"{self.devices[macaddr].srvtargets}\n\n")
-                wf.write("MDNS\n")
-                wf.write(f"{self.devices[macaddr].mdns_list()}\n\n")
-                wf.close()
-            except:
-                return False
-            return True
+            dev = self.devices[macaddr]
+            txt = f"DEVICE {macaddr} @ {ui_time}\n" \
+                + f"{dev.device_statistics(ui_time, self.last_pkt_time)}\n\n" \
+                + "CONNECTIONS LIST\n" \
+                + f"{dev.connections_list(ui_time, self.last_pkt_time)}\n\n" \
+                + "IP->DOMAINS\n" \
+                + f"{dev.dns_reply_list()}\n\n" \
+                + "DOMAIN->IPs\n" \
+                + f"{dev.domain_ips_list()}\n\n" \
+                + "CNAMES\n" \
+                + f"{dev.dns_cnames_list()}\n\n" \
+                + "SRV TARGETS\n" \
+                + f"{dict(dev.dns.srvtargets)}\n\n" \
+                + "MDNS\n" \
+                + f"{dev.mdns_list()}\n\n"
+        try:
+            with open(f"/tmp/wireowl-export-{macaddr.replace(':','')}-{int(ui_time)}.txt", 'w') as wf:
+                wf.write(txt)
+        except:
+            return False
+        return True
+
+    def get_device_export(self, macaddr, state, since, volumes=False):
+        # records of device for NDJSON export/database and state of device to compare with
+        # next time; with state of previous export, only what changed (since: its capture time)
+        with self._lock:
+            dev = self.devices.get(macaddr)
+            if dev is None:
+                return [], state
+            ret = dev.export_records(state, since, macaddr in self.clients, volumes)
+        return ret
+
+    def get_network_export(self, states, since):
+        # records of all devices and capture time of their counters, {mac:(records, state)}
+        # as get_device_export returns them; counters of all devices and connections are
+        # copied under one lock (totals are of one moment), names, DNS answers and mDNS
+        # (descriptions, not counted) are added device by device
+        with self._lock:
+            now = self.last_pkt_time
+            counters = {mac: dev.export_counters(states.get(mac), since) \
+                        for mac, dev in self.devices.items()}
+            clients = self.clients.copy()
+        ret = {}
+        for mac, cnt in counters.items():
+            ret[mac] = [], states.get(mac)
+            if cnt is not None:
+                with self._lock:
+                    dev = self.devices.get(mac)
+                    if dev is not None:
+                        ret[mac] = dev.export_records(states.get(mac), since, mac in clients,
+                                                      counters=cnt)
+        return now, ret
 
 
 #    #          ######
@@ -189,86 +470,90 @@ class MacAddrDevice():
     """
     Statistics for one device, which is every seen MAC addresses in network capture
     """
-    def __init__(self, macaddr):
+    def __init__(self, macaddr, alerts=None, blocklist=None):
         self.my_macaddress = macaddr    # device's mac address
+        self.alerts = alerts            # AlertEngine (or None)
+        self.blocklist = blocklist      # Blocklist (or None)
+        self.listed_ips = set()         # IP addresses answered for blocklisted domains
+        self.alerts_raised = 0          # no. of alerts raised by device's traffic
         self.first_pkt_time = 0         # time of first received packet
         self.last_pkt_time = 0          # time of last sent packet
         self.packets_count = 0          # total packets processed
         self.my_ips = set()             # all device's seen IP addresses
+        self.my_ips_text = ''           # sorted IP addresses as text
         self.my_hostname = set()        # hostname advertised to dhcp service
         self.tx_protocols = set()       # outgoing protocols
         self.connections = {}           # IP connections from/to device dict: 'ip':IPConnection
         self.longest_conn = 10          # length of longest IP address in connection for formatting
-        self.ip2domains = {}            # DNS queries dict: 'ip':set(domain,domain,domain...)
-        self.domain2ips = {}            # DNS queries dict: 'domain':set(ip,ip,ip...)
+        self.dns = DNSMappings()        # DNS answers (IP<->domains, CNAMEs, SRV targets)
+        self.index = None               # SearchIndex of connections (built on first search)
+        self.history = EventHistory()   # time ordered events of connections and DNS answers
         self.blockeddomains = set()     # DNS queries blocked by DNS server
-        self.cnames = {}                # CNAMES of requested domains
-        self.srvtargets = {}            # SRV records  # TODO: do I understand SRV records PROPERLY?
         self.mdns = {}                  # mDSN info transmitting from device
         self.tx_bytes = 0               # transmitted bytes
         self.rx_bytes = 0               # received bytes
         self.tx_pkts = 0                # transmitted packets
         self.rx_pkts = 0                # received packets
+        self.tx_rate = RateMeter()      # transmitted bytes per second
+        self.rx_rate = RateMeter()      # received bytes per second
         self.dns_queries = 0            # no. of DNS queries
         self.dns_replies = 0            # no. of DNS replies
+        self.memory = None              # {structure:bytes} estimated at memory_time
+        self.memory_time = 0            # monotonic time of the estimate
+        self.memory_pkts = -1           # packets_count at the estimate
 
-    # inspect packet from device's point of view (both sender and receiver)
+    # inspect packet from device's point of view (both sender and receiver),
+    # returns IP address of updated connection (if any)
     def inspect_packet_and_update(self, pkt):
 
         # process DNS replies to know who is who (IP->domains)
-        if pkt[P_PROTOCOL] == 'DNS':
-            if self.my_macaddress == pkt[P_ETHDST]:
+        if pkt.protocol == 'DNS':
+            if self.my_macaddress == pkt.eth_dst:
                 self.dns_replies += 1
                 self.update_dns_ips(pkt)
             else:
                 self.dns_queries += 1
 
         # what is device telling to network (Bonjour, Avahi etc)
-        elif pkt[P_PROTOCOL] == 'MDNS':
-            if self.my_macaddress == pkt[P_ETHSRC]:
+        elif pkt.protocol == 'MDNS':
+            if self.my_macaddress == pkt.eth_src:
                 self.update_mdns(pkt)
 
-        elif pkt[P_PROTOCOL] == 'DHCP':
-            if self.my_macaddress == pkt[P_ETHSRC] and pkt[P_DHCPHOSTNAME]:
-                self.my_hostname.update([pkt[P_DHCPHOSTNAME]])
-
-        def ip_address(direction, pkt):
-            if direction == 'src':
-                ipaddr = pkt[P_IPSRC] if pkt[P_IPSRC] else pkt[P_IPV6SRC]
-            else:
-                ipaddr = pkt[P_IPDST] if pkt[P_IPDST] else pkt[P_IPV6DST]
-            # work around: tshark sometimes exports both ipdst and ipsrc in one field
-            if '|' in ipaddr:
-                ipaddr = ipaddr.split('|')[0]
-            return ipaddr
+        elif pkt.protocol == 'DHCP':
+            if self.my_macaddress == pkt.eth_src and pkt.cols[P_DHCPHOSTNAME]:
+                self.my_hostname.add(intern(pkt.cols[P_DHCPHOSTNAME]))
 
         # update device stats AND IP connection stats
         ipaddr = None
-        if self.my_macaddress == pkt[P_ETHSRC]:  # when the device is source...
-            self.tx_protocols.add(packet_protocol(pkt))
-            self.tx_bytes += int(pkt[P_FRAMELEN])
+        if self.my_macaddress == pkt.eth_src:  # when the device is source...
+            self.tx_protocols.add(pkt.label)
+            self.tx_bytes += pkt.length
             self.tx_pkts += 1
-            ipaddr = ip_address('src', pkt)  # device's own IP address
+            self.tx_rate.add(pkt.time, pkt.length)
+            ipaddr = pkt.ip_src  # device's own IP address
             if ipaddr:
                 # local network addresses should be address of the device
                 # (if many, than it's a router)
                 if ipaddr not in ['0.0.0.0', '::']:
-                    if ipaddress.ip_address(ipaddr).is_private:
-                        self.my_ips.add(ipaddr)
+                    if ipaddr not in self.my_ips and ip_info(ipaddr)[1]:
+                        self.my_ips.add(intern(ipaddr))
+                        self.my_ips_text = ', '.join(sorted(self.my_ips))
 
             # update last activity time, if device transmits
-            self.update_activity_time(float(pkt[P_TIME]))
-            ipaddr = ip_address('dst', pkt)           # ...update destination connection
+            self.update_activity_time(pkt.time)
+            ipaddr = pkt.ip_dst                       # ...update destination connection
 
-        elif self.my_macaddress == pkt[P_ETHDST]:  # when the device is destination...
-            self.rx_bytes += int(pkt[P_FRAMELEN])
+        elif self.my_macaddress == pkt.eth_dst:  # when the device is destination...
+            self.rx_bytes += pkt.length
             self.rx_pkts += 1
-            ipaddr = ip_address('src', pkt)           # ...update source connection
+            self.rx_rate.add(pkt.time, pkt.length)
+            ipaddr = pkt.ip_src                       # ...update source connection
 
         if ipaddr:
-            self.update_ip_connection(ipaddr, pkt)
+            ipaddr = self.update_ip_connection(ipaddr, pkt)
 
         self.packets_count += 1
+        return ipaddr
 
     def update_activity_time(self, epochtime):
         self.last_pkt_time = epochtime
@@ -277,76 +562,97 @@ class MacAddrDevice():
 
     def update_ip_connection(self, ipaddr, pkt):
         # check/add connection
-        if not ipaddr in self.connections:
+        is_new = ipaddr not in self.connections
+        if is_new:
+            ipaddr = intern(ipaddr)
             self.connections[ipaddr] = IPConnection(ipaddr)
             self.longest_conn = max(self.longest_conn, len(ipaddr))
+            if self.index is not None:
+                self.index_connection(ipaddr)
         # update
-        self.connections[ipaddr].inspect_packet_and_update(self.my_macaddress, pkt)
+        conn = self.connections[ipaddr]
+        conn.inspect_packet_and_update(self.my_macaddress, pkt)
+        if is_new:
+            self.history.connection(ipaddr, pkt.time)
+        self.history.volume(ipaddr, pkt.time, pkt.length)
+        if self.alerts:
+            if is_new:
+                self.alerts.connection(self, ipaddr, conn, pkt.time)
+            if self.alerts.on_packet:
+                self.alerts.packet(self, ipaddr, conn, pkt.length, pkt.time)
+        if self.index is not None and self.my_macaddress == pkt.eth_src:
+            self.index.add(ipaddr, pkt.label)
+        return ipaddr
 
     def update_dns_ips(self, pkt):
+        cols = pkt.cols
         # SRV response
-        if pkt[P_DNSSRVNAME] and pkt[P_DNSSRVTARGET]:
-            if pkt[P_DNSSRVTARGET] != '<Root>':
-                self.srvtargets[pkt[P_DNSSRVTARGET]] = pkt[P_DNSSRVNAME]
-                if pkt[P_DNSSRVNAME] not in self.cnames:
-                    self.cnames[pkt[P_DNSSRVNAME]] = set()
-                self.cnames[pkt[P_DNSSRVNAME]].update([pkt[P_DNSSRVTARGET]])
+        if cols[P_DNSSRVNAME] and cols[P_DNSSRVTARGET]:
+            if cols[P_DNSSRVTARGET] != '<Root>':
+                self.dns.add_srv(cols[P_DNSSRVNAME], cols[P_DNSSRVTARGET], pkt.time)
 
         # A/AAAA response (linked to previous SRV target, if any; otherwise normal)
-        if pkt[P_DNSA] or pkt[P_DNSAAAA]:
-            ips = set(pkt[P_DNSA].split('|') + pkt[P_DNSAAAA].split('|'))
+        if cols[P_DNSA] or cols[P_DNSAAAA]:
+            ips = set(cols[P_DNSA].split('|') + cols[P_DNSAAAA].split('|'))
             if '' in ips: ips.remove('')
 
-            if pkt[P_DNSQRYNAME] in self.srvtargets:
-                qryname = self.srvtargets[pkt[P_DNSQRYNAME]]
-            else:
-                qryname = pkt[P_DNSQRYNAME]
-
-            for ip in ips:
-                if ip not in self.ip2domains:
-                    self.ip2domains[ip] = set()
-                self.ip2domains[ip].update([qryname])
+            qryname = self.dns.srvtargets.get(cols[P_DNSQRYNAME], cols[P_DNSQRYNAME])
 
-            if qryname not in self.domain2ips:
-                self.domain2ips[qryname] = set()
-            self.domain2ips[qryname].update(ips)
+            # answer is valid for the shortest TTL in it (0 if not exported)
+            ttls = [int(ttl) for ttl in cols[P_DNSTTL].split('|') if ttl.isdigit()]
+            self.dns.add(qryname, ips, pkt.time, min(ttls) if ttls else 0)
+            self.history.dns(qryname, ips, pkt.time)
+            if self.alerts:
+                self.alerts.dns_answer(self, qryname, ips, pkt.time)
+            if self.index is not None:
+                for ip in ips:
+                    if ip in self.connections:
+                        self.index.add(ip, qryname)
 
             # CNAMES
-            domains = set(pkt[P_DNSRESPNAME].split('|') + pkt[P_DNSCNAME].split('|'))
+            domains = set(cols[P_DNSRESPNAME].split('|') + cols[P_DNSCNAME].split('|'))
             if '' in domains: domains.remove('')
             if '<Root>' in domains: domains.remove('<Root>')
-            if pkt[P_DNSQRYNAME] in domains: domains.remove(pkt[P_DNSQRYNAME])
+            if cols[P_DNSQRYNAME] in domains: domains.remove(cols[P_DNSQRYNAME])
             if domains:
-                if pkt[P_DNSQRYNAME] not in self.cnames:
-                    self.cnames[pkt[P_DNSQRYNAME]] = set()
-                self.cnames[pkt[P_DNSQRYNAME]].update(domains)
+                self.dns.add_cnames(cols[P_DNSQRYNAME], domains, pkt.time)
+
+            # blocklisted domain, also when hidden behind CNAME
+            if self.blocklist:
+                if self.blocklist.listed(cols[P_DNSQRYNAME]) or \
+                    any(self.blocklist.listed(d) for d in domains):
+                    self.listed_ips.update(intern(ip) for ip in ips)
 
     def update_mdns(self, pkt):
+        cols = pkt.cols
         for key, idx in MDNS_KEYS:
-            if pkt[idx]:
-                values = pkt[idx].split('|')
+            if cols[idx]:
+                values = cols[idx].split('|')
                 if key not in self.mdns:
                     self.mdns[key] = set()
-                self.mdns[key].update(values)
+                self.mdns[key].update(intern(v) for v in values)
 
     def dns_reply_list(self):
-        return self.ip2domains
+        return self.dns.ip2domains()
 
     def domain_ips_list(self):
-        return self.domain2ips
+        return self.dns.domain2ips()
 
     def unique_domains_requested(self):
-        return len(self.domain2ips)
+        return len(self.dns.domains)
 
     def dns_cnames_list(self):
-        return self.cnames
+        return self.dns.domain2cnames()
 
     def mdns_list(self):
         return self.mdns
 
-    def ip_name(self, ip):
-        if ip in self.ip2domains:
-            txt = ', '.join(self.ip2domains[ip])
+    def ip_name(self, ip, recent=False):
+        # all names answered for IP address, or only names valid
+        # at time of last activity of the connection (recent)
+        if ip in self.dns.ips:
+            when = self.connections[ip].last_touch if recent else None
+            txt = ', '.join(self.dns.names(ip, when))
             if self.connections[ip].private_ip:
                 txt += " (local)"
         else:
@@ -361,7 +667,7 @@ class MacAddrDevice():
             txt +=  " address"
         return txt
 
-    def device_statistics(self, now):
+    def device_statistics(self, now, rate_time):
         dct = {}
         dct['rx'] = self.rx_bytes
         dct['tx'] = self.tx_bytes
@@ -376,41 +682,760 @@ class MacAddrDevice():
         dct['fa'] = self.first_pkt_time
         dct['la'] = self.last_pkt_time - now    # 0 first, older minus (time unseen)
         dct['prot'] = self.tx_protocols
-        ips = list(self.my_ips)
-        ips.sort()
-        dct['ip'] = ', '.join(ips) if ips else ''
+        dct['ip'] = self.my_ips_text
         dct['hn'] = ', '.join(list(self.my_hostname)) if self.my_hostname else ''
+        dct['alrt'] = self.alerts_raised
+        dct['mem'] = sum(self.memory_usage().values())
+        dct['txr'] = self.tx_rate.rates(rate_time)  # bytes/sec (10s, 1m, 5m)
+        dct['rxr'] = self.rx_rate.rates(rate_time)
         return dct
 
+    def search(self, query):
+        # IP addresses of connections matching query; index is built on first search
+        # and then kept up to date as packets arrive
+        if self.index is None:
+            self.index = SearchIndex()
+            for ip in self.connections:
+                self.index_connection(ip)
+        return self.index.search(query)
+
+    def index_connection(self, ip):
+        conn = self.connections[ip]
+        self.index.add(ip, ip)
+        if conn.country:
+            self.index.add(ip, conn.country)
+        for name in self.dns.ips.get(ip, ()):
+            self.index.add(ip, name)
+        for label in conn.tx_protocols:
+            self.index.add(ip, label)
+
+    def device_summary(self, now, rate_time):
+        return (self.my_macaddress, self.first_pkt_time, self.last_pkt_time - now,
+                self.rx_bytes, self.tx_bytes, self.dns_queries, len(self.dns.domains),
+                len(self.connections), self.packets_count, self.my_ips_text,
+                self.tx_rate.rates(rate_time)[0] + self.rx_rate.rates(rate_time)[0],
+                self.alerts_raised, sum(self.memory_usage().values()))
+
+    def memory_usage(self):
+        # the last estimate (zeros until the first one is taken)
+        return self.memory or dict.fromkeys(MEMORY_STRUCTURES, 0)
+
+    def memory_outdated(self, now):
+        return self.packets_count != self.memory_pkts and now - self.memory_time >= MEMORY_SAMPLE
+
+    def update_memory(self):
+        self.memory = self.memory_estimate()
+        self.memory_time = time.monotonic()
+        self.memory_pkts = self.packets_count
+
+    def memory_estimate(self):
+        # approximate bytes of device's containers and objects (not shared strings)
+        # by structure: connections (with rate meters and search index), graphs,
+        # DNS answers (with CNAMEs), mDNS, protocols, event history; sizes of containers
+        # are taken from their lengths, so the estimate costs a few operations per connection
+        conn = getsizeof(self) + getsizeof(self.__dict__) + dict_size(len(self.connections))
+        graph = 0
+        prot = set_size(len(self.tx_protocols))
+        if self.connections:
+            # objects of the same class have the same size
+            c = next(iter(self.connections.values()))
+            conn += len(self.connections) * (getsizeof(c) + getsizeof(c.__dict__) \
+                + getsizeof(c.tx_rate) + getsizeof(c.tx_rate.averages) \
+                + getsizeof(c.rx_rate) + getsizeof(c.rx_rate.averages))
+            graph_size = getsizeof(c.tx_min_graph) + getsizeof(c.tx_min_graph.__dict__) \
+                + DICT_SIZE if c.tx_min_graph else 0
+            labels = entries = 0
+            for c in self.connections.values():
+                labels += len(c.tx_protocols)
+                if c.tx_sec_graph:
+                    entries += len(c.tx_sec_graph.gr) + len(c.tx_min_graph.gr) \
+                        + len(c.rx_sec_graph.gr) + len(c.rx_min_graph.gr)
+            prot += len(self.connections)*SET_SIZE + labels*SET_ENTRY
+            graph = 4*graph_size*len(self.connections) + entries*(DICT_ENTRY + 2*INT_SIZE)
+        if self.index:
+            conn += dict_size(len(self.index.texts)) + dict_size(len(self.index.grams)) \
+                + sum(set_size(len(v)) for v in self.index.texts.values()) \
+                + sum(set_size(len(v)) for v in self.index.grams.values())
+        answers = sum(map(len, self.dns.ips.values()))
+        dns = dict_size(len(self.dns.ips))*2 + dict_size(len(self.dns.domains)) \
+            + len(self.dns.ips)*DICT_SIZE + answers*(DICT_ENTRY + ANSWER_SIZE) \
+            + len(self.dns.domains)*SET_SIZE + answers*SET_ENTRY \
+            + dict_size(len(self.dns.cnames)) + len(self.dns.cnames)*DICT_SIZE \
+            + sum(map(len, self.dns.cnames.values()))*(DICT_ENTRY + INT_SIZE) \
+            + dict_size(len(self.dns.srvtargets))*2 + set_size(len(self.listed_ips))
+        mdns = dict_size(len(self.mdns)) + sum(set_size(len(v)) for v in self.mdns.values())
+        h = self.history
+        hist = getsizeof(h.times) + getsizeof(h.kinds) + getsizeof(h.refs) + getsizeof(h.values) \
+            + getsizeof(h.strings) + dict_size(len(h.string_ids)) \
+            + dict_size(len(h.minutes))*2 + len(h.minutes)*(getsizeof((0, 0)) + 2*INT_SIZE)
+        return {'conn': conn, 'graph': graph, 'dns': dns, 'mdns': mdns, 'prot': prot, 'hist': hist}
+
+    def export_counters(self, state, since):
+        # new state, counters of device and of its connections active since (plain values,
+        # cheap to copy for all devices at once); None when nothing changed since state
+        new = (self.packets_count, self.dns_replies, sum(len(v) for v in self.mdns.values()))
+        if state == new:
+            return None
+        if state and new[0] < state[0]:
+            since = None  # statistics cleared, export all again
+        device = (self.first_pkt_time, self.last_pkt_time, self.tx_bytes, self.rx_bytes,
+                  self.tx_pkts, self.rx_pkts, self.dns_queries, self.dns_replies,
+                  len(self.connections), self.packets_count, self.alerts_raised)
+        conns = [(ip, conn.first_touch, conn.last_touch, conn.tx_bytes, conn.rx_bytes,
+                  conn.tx_pkts, conn.rx_pkts) for ip, conn in self.connections.items() \
+                 if since is None or conn.last_touch >= since]
+        return new, since, device, conns
+
+    def export_records(self, state, since, is_client, volumes=False, counters=None):
+        # plain records (no sets) of device, its connections (active since), DNS answers,
+        # CNAMEs and mDNS (when changed); with volumes, connections have also
+        # [(minute, tx, rx)] of minutes since (the last one may be incomplete);
+        # numbers are taken from counters when they were copied before (export_counters)
+        if counters is None:
+            counters = self.export_counters(state, since)
+            if counters is None:
+                return [], state
+        new, since, device, conns = counters
+        if since is None:
+            state = None
+        first, last, tx, rx, tp, rp, dnsq, dnsr, connections, packets, alerts = device
+        mac = self.my_macaddress
+        records = [{'type': 'device', 'mac': mac, 'client': is_client,
+                    'ips': sorted(self.my_ips), 'hostnames': sorted(self.my_hostname),
+                    'first': first, 'last': last, 'tx': tx, 'rx': rx, 'tp': tp, 'rp': rp,
+                    'dnsq': dnsq, 'dnsr': dnsr,
+                    'domains': len(self.dns.domains), 'connections': connections,
+                    'packets': packets, 'protocols': sorted(self.tx_protocols),
+                    'alerts': alerts}]
+        for ip, first, last, tx, rx, tp, rp in conns:
+            conn = self.connections.get(ip)
+            if conn is None:
+                continue  # cleared since counters were copied
+            records.append({'type': 'connection', 'mac': mac, 'ip': ip,
+                'name': self.ip_name(ip), 'country': conn.country,
+                'global': conn.global_ip, 'private': conn.private_ip,
+                'multicast': conn.multicast_ip, 'reserved': conn.reserved_ip,
+                'listed': ip in self.listed_ips,
+                'first': first, 'last': last, 'tx': tx, 'rx': rx, 'tp': tp, 'rp': rp,
+                'protocols': sorted(conn.tx_protocols)})
+            if volumes and conn.tx_min_graph:
+                records[-1]['minutes'] = conn.minute_volumes(since)
+        if not state or new[1] != state[1]:
+            for ip, names in self.dns.ips.items():
+                records.append({'type': 'dns', 'mac': mac, 'ip': ip,
+                    'answers': [{'domain': d, 'time': tm, 'ttl': ttl} for d, (tm, ttl) in names.items()]})
+            for domain, cnames in self.dns.cnames.items():
+                records.append({'type': 'cname', 'mac': mac, 'domain': domain,
+                    'cnames': sorted(cnames)})
+        if not state or new[2] != state[2]:
+            for key, values in self.mdns.items():
+                records.append({'type': 'mdns', 'mac': mac, 'key': key, 'values': sorted(values)})
+        return records, new
+
     def clear_statistics(self):
         self.first_pkt_time = 0
         self.last_pkt_time = 0
         self.packets_count = 0
         self.tx_protocols = set()
         self.connections = {}
+        self.index = None
+        self.history = EventHistory()
+        self.alerts_raised = 0
         self.tx_bytes = 0
         self.rx_bytes = 0
         self.tx_pkts = 0
         self.rx_pkts = 0
+        self.tx_rate = RateMeter()
+        self.rx_rate = RateMeter()
         self.dns_queries = 0
 
-    def connections_list(self, now):
+    def connections_list(self, now, rate_time):
         dct = {}
         for ip in self.connections.keys():
-            dct[ip] = self.connections[ip].ip_statistics(now)
+            dct[ip] = self.connections[ip].ip_statistics(now, rate_time)
+            dct[ip]['lst'] = ip in self.listed_ips
         return dct
 
-# protocol/port for TCP, protocol\port for UDP
+
+
+class DNSMappings():
+    """
+    DNS answers seen by one device: domain names of IP addresses with time and TTL
+    of the answer, CNAMEs of domains and names of SRV targets. Least recently answered
+    IP addresses, domains and SRV targets are forgotten over capacity.
+    """
+    def __init__(self, capacity=DNS_CAPACITY, names_per_ip=DNS_NAMES_PER_IP):
+        self.capacity = capacity        # max. IP addresses
+        self.names_per_ip = names_per_ip  # max. domain names of one IP address (CNAMEs of domain)
+        self.ips = OrderedDict()        # {ip:{domain:(answer time, ttl)}}, oldest answer first
+        self.domains = {}               # {domain:set(ip,ip...)}
+        self.cnames = OrderedDict()     # {domain:{cname:answer time}}, oldest answer first
+        self.srvtargets = OrderedDict() # {SRV target:SRV name}, oldest answer first
+        self.forgotten = 0              # IP addresses dropped over capacity
+
+    def add(self, domain, ips, tm, ttl):
+        domain = intern(domain)
+        for ip in map(intern, ips):
+            names = self.ips.pop(ip, None) or {}
+            names.pop(domain, None)
+            names[domain] = (tm, ttl)
+            # CDN addresses are reused for many names, keep the latest answers
+            while len(names) > self.names_per_ip:
+                oldest = next(iter(names))
+                del names[oldest]
+                self.unlink(oldest, ip)
+            self.ips[ip] = names
+            self.domains.setdefault(domain, set()).add(ip)
+        while len(self.ips) > self.capacity:
+            ip, names = self.ips.popitem(last=False)
+            for name in names:
+                self.unlink(name, ip)
+            self.forgotten += 1
+
+    def add_cnames(self, domain, cnames, tm):
+        domain = intern(domain)
+        names = self.cnames.pop(domain, None) or {}
+        for cname in map(intern, cnames):
+            names.pop(cname, None)
+            names[cname] = tm
+        while len(names) > self.names_per_ip:
+            del names[next(iter(names))]
+        self.cnames[domain] = names
+        while len(self.cnames) > self.capacity:
+            self.cnames.popitem(last=False)
+
+    def add_srv(self, srvname, target, tm):
+        # A/AAAA answers of target are answers of SRV name
+        srvname, target = intern(srvname), intern(target)
+        self.srvtargets.pop(target, None)
+        self.srvtargets[target] = srvname
+        while len(self.srvtargets) > self.capacity:
+            self.srvtargets.popitem(last=False)
+        self.add_cnames(srvname, [target], tm)
+
+    def unlink(self, domain, ip):
+        ips = self.domains.get(domain)
+        if ips:
+            ips.discard(ip)
+            if not ips:
+                del self.domains[domain]
+
+    def names(self, ip, when=None):
+        # latest answer first; with time, only answers valid at that time
+        # (or the latest answer before it, if TTL is not known)
+        names = sorted(self.ips.get(ip, {}).items(), key=lambda n: n[1][0], reverse=True)
+        if when is None:
+            return [name for name, _ in names]
+        before = [(name, (tm, ttl)) for name, (tm, ttl) in names if tm <= when] or names
+        valid = [name for name, (tm, ttl) in before if ttl and tm+ttl >= when]
+        return valid or [before[0][0]]
+
+    def ip2domains(self):
+        return {ip: set(names) for ip, names in self.ips.items()}
+
+    def domain2ips(self):
+        return {domain: set(ips) for domain, ips in self.domains.items()}
+
+    def domain2cnames(self):
+        return {domain: set(names) for domain, names in self.cnames.items()}
+
+
+class EventHistory():
+    """
+    Append-only log of device's events in time order: first packet of connection, DNS answer
+    (domain of IP address) and volume of connection in each minute (updated while the minute
+    lasts). Events are kept in arrays (21 bytes per event plus shared strings), so time ranges
+    are found by binary search; the oldest events are dropped over capacity or retention time.
+    """
+    def __init__(self, capacity=HISTORY_EVENTS, retention=HISTORY_RETENTION):
+        self.capacity = capacity        # max. events
+        self.retention = retention      # max. seconds between the oldest and the newest event
+        self.times = array('d')         # time of event (ascending)
+        self.kinds = array('b')         # E_CONN, E_DNS, E_VOL
+        self.refs = array('l')          # IP address (index to strings)
+        self.values = array('q')        # bytes (E_VOL) or domain (E_DNS, index to strings)
+        self.strings = []               # IP addresses and domains referenced by events
+        self.string_ids = {}            # {string:index to strings}
+        self.minutes = {}               # {IP address index:(minute, event number of its volume)}
+        self.dropped = 0                # events dropped (number of the first event kept)
+        self.compacted = 0              # strings kept by the last compaction
+
+    def ref(self, text):
+        idx = self.string_ids.get(text)
+        if idx is None:
+            idx = self.string_ids[text] = len(self.strings)
+            self.strings.append(text)
+        return idx
+
+    def append(self, tm, kind, ref, value):
+        times = self.times
+        if times and tm < times[-1]:
+            tm = times[-1]  # packets out of order, keep time order
+        times.append(tm)
+        self.kinds.append(kind)
+        self.refs.append(ref)
+        self.values.append(value)
+        if len(times) > self.capacity or tm - times[0] > self.retention:
+            self.trim(tm)
+
+    def trim(self, tm):
+        n = bisect_left(self.times, tm - self.retention)
+        if len(self.times) > self.capacity:
+            n = max(n, len(self.times) - self.capacity*3//4)
+        for arr in (self.times, self.kinds, self.refs, self.values):
+            del arr[:n]
+        self.dropped += n
+        if len(self.strings) > 2*max(self.compacted, HISTORY_STRINGS):
+            self.compact()
+
+    def compact(self):
+        # only strings referenced by events kept (indexes are renumbered),
+        # only minutes whose volume event is kept
+        used = set(self.refs)
+        used.update(v for k, v in zip(self.kinds, self.values) if k == E_DNS)
+        used = sorted(used)
+        new = {old: idx for idx, old in enumerate(used)}
+        self.refs = array('l', map(new.__getitem__, self.refs))
+        self.values = array('q', (new[v] if k == E_DNS else v for k, v in zip(self.kinds, self.values)))
+        self.minutes = {new[ip]: m for ip, m in self.minutes.items() if m[1] >= self.dropped}
+        self.strings = [self.strings[old] for old in used]
+        self.string_ids = {text: idx for idx, text in enumerate(self.strings)}
+        self.compacted = len(self.strings)
+
+    def connection(self, ip, tm):
+        self.append(tm, E_CONN, self.ref(ip), 0)
+
+    def dns(self, domain, ips, tm):
+        domain = self.ref(domain)
+        for ip in ips:
+            self.append(tm, E_DNS, self.ref(ip), domain)
+
+    def volume(self, ip, tm, vol):
+        ip = self.ref(ip)
+        minute = int(tm // 60)
+        last = self.minutes.get(ip)
+        if last and last[0] == minute and last[1] >= self.dropped:
+            self.values[last[1] - self.dropped] += vol
+        else:
+            self.append(tm, E_VOL, ip, vol)
+            self.minutes[ip] = (minute, self.dropped + len(self.times) - 1)
+
+    def replay(self, events):
+        # events [(time, kind, IP address, domain or bytes)] restored from aggregates
+        # (database, offline engine), appended in time order
+        events.sort(key=lambda e: (e[0], e[1]))
+        for tm, kind, ip, value in events:
+            if kind == E_CONN:
+                self.connection(ip, tm)
+            elif kind == E_DNS:
+                self.dns(value, (ip,), tm)
+            else:
+                self.volume(ip, tm, value)
+
+    def summary(self, start, end):
+        # what happened between start and end: {'ips':[(ip, bytes, new, domains, first, last)],
+        # 'span':(first, last) time of events kept, 'events', 'dropped'}; minutes
+        # which started in the range are counted whole
+        times, strings = self.times, self.strings
+        ips = {}
+        for i in range(bisect_left(times, start), bisect_right(times, end)):
+            ip = strings[self.refs[i]]
+            item = ips.get(ip)
+            if item is None:
+                item = ips[ip] = [0, False, set(), times[i], times[i]]
+            kind = self.kinds[i]
+            if kind == E_VOL:
+                item[0] += self.values[i]
+            elif kind == E_CONN:
+                item[1] = True
+            else:
+                item[2].add(strings[self.values[i]])
+            item[4] = times[i]
+        return {'ips': sorted(((ip, v[0], v[1], sorted(v[2]), v[3], v[4]) for ip, v in ips.items()),
+                              key=lambda x: x[1], reverse=True),
+                'span': (times[0], times[-1]) if times else (0, 0),
+                'events': len(times),
+                'dropped': self.dropped}
+
+
+class SearchIndex():
+    """
+    Trigram index of texts (domain names, IP address, country, protocols) of connections,
+    query is looked up by its trigrams and only the candidates are checked for substring
+    """
+    def __init__(self):
+        self.texts = {}                 # {ip:set(lowercase text)}
+        self.grams = {}                 # {trigram:set(ip)}
+
+    def add(self, ip, text):
+        text = text.lower()
+        texts = self.texts.setdefault(ip, set())
+        if text in texts:
+            return
+        texts.add(text)
+        for i in range(len(text)-2):
+            self.grams.setdefault(text[i:i+3], set()).add(ip)
+
+    def search(self, query):
+        query = query.lower()
+        if len(query) < 3:
+            # too short for trigrams (e.g. country code)
+            candidates = self.texts.keys()
+        else:
+            sets = [self.grams.get(query[i:i+3], set()) for i in range(len(query)-2)]
+            sets.sort(key=len)
+            candidates = sets[0].intersection(*sets[1:])
+        return {ip for ip in candidates if any(query in t for t in self.texts[ip])}
+
+
+class Blocklist():
+    """
+    Domains of blocklists (plain lists, hosts files, adblock '||domain^' rules) kept
+    as sorted array of their 64-bit hashes, 8 bytes per domain instead of a string in
+    a set. Domain is listed when it or any of its parent domains is in the array
+    (binary search per label); verdicts are cached, so a domain is looked up once.
+    """
+    def __init__(self, pathnames=()):
+        self.hashes = array('q')        # sorted hashes of listed domains
+        self.verdicts = {}              # {domain:True/False} cache
+        self.lookups = 0                # domains looked up (not cached)
+        self.cached = 0                 # verdicts from cache
+        self.cost = 0.0                 # seconds spent looking up
+        self.status = 0                 # 0-no errors, 1-could not read a file
+        hashes = set()
+        for pathname in pathnames:
+            try:
+                with open(pathname, errors='replace') as f:
+                    for line in f:
+                        for domain in blocklist_domains(line):
+                            hashes.add(hash(domain))
+            except:
+                self.status = 1
+        self.hashes = array('q', sorted(hashes))
+
+    def listed(self, domain):
+        verdict = self.verdicts.get(domain)
+        if verdict is not None:
+            self.cached += 1
+            return verdict
+        tm = perf_counter()
+        hashes = self.hashes
+        name = domain.lower().rstrip('.')
+        verdict = False
+        while name:
+            h = hash(name)
+            i = bisect_left(hashes, h)
+            if i < len(hashes) and hashes[i] == h:
+                verdict = True
+                break
+            name = name.partition('.')[2]
+        if len(self.verdicts) >= BLOCKLIST_CACHE:
+            self.verdicts.clear()
+        self.verdicts[domain] = verdict
+        self.lookups += 1
+        self.cost += perf_counter() - tm
+        return verdict
+
+
+# domains in one line of blocklist file
+#
+def blocklist_domains(line):
+    line = line.split('#', 1)[0].strip()
+    if not line or line[0] in '!@[':  # adblock comments, exceptions, headers
+        return []
+    if line.startswith('||'):
+        names = [line[2:].split('^', 1)[0]]
+    else:
+        names = line.split()
+        # hosts file: address followed by names
+        if len(names) > 1 and (':' in names[0] or names[0].replace('.', '').isdigit()):
+            names = names[1:]
+    names = [n.lower().strip('.') for n in names]
+    return [n for n in names if n and n not in BLOCKLIST_IGNORED]
+
+
+class FlowTable():
+    """
+    TCP/UDP flows by tshark's stream index, least recently active first, so that
+    idle flows expire from the front and the oldest ones are dropped over capacity
+    (constant work per packet, bounded memory)
+    """
+    def __init__(self, capacity=FLOW_CAPACITY, idle=FLOW_IDLE):
+        self.capacity = capacity        # max. flows
+        self.idle = idle                # seconds of inactivity to expire
+        self.flows = OrderedDict()      # {(source, protocol, stream):Flow}
+        self.by_mac = {}                # {mac:{ip:set(flow keys)}} as devices see connections
+        self.relink = set()             # keys of flows of cleared devices, linked again when active
+        self.swept = 0                  # capture time of last expiry sweep
+        self.expired = 0                # flows forgotten after inactivity
+        self.evicted = 0                # flows forgotten over capacity
+
+    def update(self, pkt):
+        cols = pkt.cols
+        # each tshark (interface) numbers its streams from 0
+        if cols[P_TCPSTREAM]:
+            key = (pkt.source, 'TCP', cols[P_TCPSTREAM])
+            sport, dport = cols[P_TCPSRCPORT], cols[P_TCPDSTPORT]
+        elif cols[P_UDPSTREAM]:
+            key = (pkt.source, 'UDP', cols[P_UDPSTREAM])
+            sport, dport = cols[P_UDPSRCPORT], cols[P_UDPDSTPORT]
+        else:
+            return
+        tm = pkt.time
+        src, dst = pkt.ip_src, pkt.ip_dst
+        if not (src and dst):
+            return
+
+        flow = self.flows.get(key)
+        if flow and not flow.matches(src, dst):
+            # stream index reused by the same source (e.g. restarted tshark)
+            self.remove(key)
+            flow = None
+        if flow:
+            self.flows.move_to_end(key)
+            if self.relink and key in self.relink:
+                # continuing flow of a device whose statistics were cleared
+                self.relink.discard(key)
+                self.link(flow.mac_a, flow.ip_b, key)
+                self.link(flow.mac_b, flow.ip_a, key)
+        else:
+            flow = self.flows[key] = Flow(key[1], pkt.eth_src, pkt.eth_dst,
+                                          src, dst, sport, dport, tm)
+            # device sending packet sees connection with destination and vice versa
+            self.link(flow.mac_a, flow.ip_b, key)
+            self.link(flow.mac_b, flow.ip_a, key)
+        flow.update(src == flow.ip_a, tm, pkt.length)
+
+        if tm - self.swept >= 1:
+            self.sweep(tm)
+        while len(self.flows) > self.capacity:
+            self.remove(next(iter(self.flows)))
+            self.evicted += 1
+
+    def sweep(self, now):
+        self.swept = now
+        while self.flows:
+            key, flow = next(iter(self.flows.items()))
+            if flow.last >= now - self.idle:
+                break
+            self.remove(key)
+            self.expired += 1
+
+    def link(self, mac, ip, key):
+        self.by_mac.setdefault(mac, {}).setdefault(ip, set()).add(key)
+
+    def unlink(self, mac, ip, key):
+        conns = self.by_mac.get(mac)
+        if conns and ip in conns:
+            conns[ip].discard(key)
+            if not conns[ip]:
+                del conns[ip]
+                if not conns:
+                    del self.by_mac[mac]
+
+    def remove(self, key):
+        self.relink.discard(key)
+        flow = self.flows.pop(key)
+        self.unlink(flow.mac_a, flow.ip_b, key)
+        self.unlink(flow.mac_b, flow.ip_a, key)
+
+    def forget_device(self, mac):
+        # flows stay for the other side, the device sees them again with their next packet
+        for keys in self.by_mac.pop(mac, {}).values():
+            self.relink.update(keys)
+
+    def memory_estimate(self):
+        # approximate bytes, size of flows is taken from the newest one (flows have slots)
+        ret = getsizeof(self.flows) + getsizeof(self.by_mac) + getsizeof(self.relink) \
+            + sum(getsizeof(v) for v in self.by_mac.values())
+        if self.flows:
+            flow = next(reversed(self.flows.values()))
+            ret += len(self.flows)*(getsizeof(flow) + 6*INT_SIZE)  # with times and counters
+        return ret
+
+    def device_flows(self, mac):
+        return {ip: [self.flows[key] for key in keys] \
+                for ip, keys in self.by_mac.get(mac, {}).items()}
+
+
+class Flow():
+    # one TCP/UDP conversation; side 'a' sent the first packet seen
+    __slots__ = ('proto', 'mac_a', 'mac_b', 'ip_a', 'ip_b', 'port_a', 'port_b',
+                 'first', 'last', 'bytes_ab', 'bytes_ba', 'pkts_ab', 'pkts_ba')
+
+    def __init__(self, proto, mac_a, mac_b, ip_a, ip_b, port_a, port_b, tm):
+        self.proto = proto
+        self.mac_a = intern(mac_a)
+        self.mac_b = intern(mac_b)
+        self.ip_a = intern(ip_a)
+        self.ip_b = intern(ip_b)
+        self.port_a = port_a
+        self.port_b = port_b
+        self.first = tm
+        self.last = tm
+        self.bytes_ab = self.bytes_ba = 0
+        self.pkts_ab = self.pkts_ba = 0
+
+    def matches(self, src, dst):
+        return (src == self.ip_a and dst == self.ip_b) or (src == self.ip_b and dst == self.ip_a)
+
+    def update(self, from_a, tm, vol):
+        self.last = tm
+        if from_a:
+            self.bytes_ab += vol
+            self.pkts_ab += 1
+        else:
+            self.bytes_ba += vol
+            self.pkts_ba += 1
+
+    def flow_statistics(self, mac, now):
+        # from device's point of view
+        mine = mac == self.mac_a
+        return {'prot': self.proto,
+                'lport': self.port_a if mine else self.port_b,
+                'rport': self.port_b if mine else self.port_a,
+                'tx': self.bytes_ab if mine else self.bytes_ba,
+                'rx': self.bytes_ba if mine else self.bytes_ab,
+                'tp': self.pkts_ab if mine else self.pkts_ba,
+                'rp': self.pkts_ba if mine else self.pkts_ab,
+                'fa': self.first,
+                'la': self.last - now}
+
+
+class TopTalkers():
+    """
+    (device, IP address) pairs with the most traffic recently. Volume decays exponentially
+    with time, but instead of decaying all pairs, packets add weight growing with time
+    (forward decay), so scores only grow and their order is the order of recent volumes.
+    Min-heap of the top pairs is then kept exact with O(log n) work per packet.
+    Pairs out of top whose volume has decayed to nothing are forgotten every TOP_SWEEP seconds.
+    """
+    def __init__(self, size=TOP_TALKERS, decay=TOP_DECAY):
+        self.size = size                # pairs in top
+        self.decay = decay              # seconds to decay to 1/e
+        self.landmark = None            # time from which weights grow
+        self.scores = {}                # {(mac, ip):score} of pairs in top or with recent traffic
+        self.members = set()            # pairs in top
+        self.heap = []                  # [(score, (mac, ip))] of members, outdated entries included
+
+    def add(self, mac, ip, tm, vol):
+        if self.landmark is None:
+            self.landmark = tm
+        exponent = (tm - self.landmark) / self.decay
+        if exponent > 500 or tm - self.landmark >= TOP_SWEEP:
+            # rescale everything to new landmark before weights would overflow float,
+            # and periodically to forget pairs without recent traffic
+            self.rescale(tm)
+            exponent = 0
+        key = (mac, ip)
+        score = self.scores[key] = self.scores.get(key, 0) + vol*math.exp(exponent)
+        if key in self.members:
+            heapq.heappush(self.heap, (score, key))
+            if len(self.heap) > 4*self.size:
+                self.rebuild()
+        elif len(self.members) < self.size:
+            self.members.add(key)
+            heapq.heappush(self.heap, (score, key))
+        elif score > self.lowest()[0]:
+            _, lowest = heapq.heapreplace(self.heap, (score, key))
+            self.members.remove(lowest)
+            self.members.add(key)
+
+    def lowest(self):
+        # drop outdated entries from top of heap
+        heap = self.heap
+        while heap[0][1] not in self.members or heap[0][0] != self.scores[heap[0][1]]:
+            heapq.heappop(heap)
+        return heap[0]
+
+    def rebuild(self):
+        self.heap = [(self.scores[key], key) for key in self.members]
+        heapq.heapify(self.heap)
+
+    def rescale(self, tm):
+        # scores become bytes decayed to time tm, pairs out of top are forgotten when their
+        # decayed volume is negligible (they start again from zero with next packet)
+        factor = math.exp(-(tm - self.landmark) / self.decay)
+        self.landmark = tm
+        members = self.members
+        self.scores = {key: score*factor for key, score in self.scores.items() \
+                       if key in members or score*factor >= TOP_FORGET}
+        self.rebuild()
+
+    def forget_device(self, mac):
+        self.scores = {key: score for key, score in self.scores.items() if key[0] != mac}
+        self.members = {key for key in self.members if key[0] != mac}
+        self.rebuild()
+
+    def top(self, now):
+        # [(mac, ip, bytes decayed to time now)], most first
+        if self.landmark is None:
+            return []
+        factor = math.exp(-(now - self.landmark) / self.decay)
+        return [(key[0], key[1], round(self.scores[key]*factor)) \
+                for key in sorted(self.members, key=self.scores.get, reverse=True)]
+
+    def memory_estimate(self):
+        # approximate bytes (scores of pairs out of top are kept until their volume decays)
+        pair = getsizeof((None, None)) + getsizeof(0.0)
+        return getsizeof(self.scores) + getsizeof(self.members) + getsizeof(self.heap) \
+            + pair*len(self.scores) + getsizeof((0.0, None))*len(self.heap)
+
+
+# approximate bytes of dict/set by number of entries
+#
+def dict_size(n):
+    return DICT_SIZE + DICT_ENTRY*n
+
+
+def set_size(n):
+    return SET_SIZE + SET_ENTRY*n
+
+
+# protocol/port for TCP, protocol\port for UDP (one shared string per label)
 #
-def packet_protocol(pkt):
-    ret = pkt[P_PROTOCOL]
-    if pkt[P_UDPDSTPORT]:
-        ret += '\\' + pkt[P_UDPDSTPORT]
-    elif pkt[P_TCPDSTPORT]:
-        ret += '/' + pkt[P_TCPDSTPORT]
+def packet_protocol(cols):
+    key = (cols[P_PROTOCOL], cols[P_UDPDSTPORT], cols[P_TCPDSTPORT])
+    ret = PROTOCOL_LABELS.get(key)
+    if ret is None:
+        ret = cols[P_PROTOCOL]
+        if cols[P_UDPDSTPORT]:
+            ret += '\\' + cols[P_UDPDSTPORT]
+        elif cols[P_TCPDSTPORT]:
+            ret += '/' + cols[P_TCPDSTPORT]
+        if len(PROTOCOL_LABELS) >= PROTOCOL_LABELS_MAX:
+            PROTOCOL_LABELS.clear()  # ephemeral ports of servers' replies
+        ret = PROTOCOL_LABELS[key] = intern(ret)
     return ret
 
 
+# type and country of IP address, shared by all devices (geolocation runs once per address)
+#
+def ip_info(ipaddr):
+    info = IP_INFO.get(ipaddr)
+    if info is None:
+        ip = ipaddress.ip_address(ipaddr)
+        ver = 4 if isinstance(ip, ipaddress.IPv4Address) else 6
+        country = ''
+        tm = perf_counter()
+        try:
+            if GEOIPLOOKUP[ver]:
+                output = subprocess.check_output([GEOIPLOOKUP[ver], ipaddr],
+                    stderr=subprocess.DEVNULL, universal_newlines=True)
+                # 'GeoIP Country Edition: CC, Country name' (V6 Edition for IPv6)
+                word = output.split('\n')[0].split(' ')[3 if ver == 4 else 4]
+                if len(word) == 3 and word[2] == ',':
+                    country = intern(word[:2])
+        except:
+            pass
+        H_GEO.add(perf_counter() - tm)
+        if len(IP_INFO) >= IP_INFO_MAX:
+            IP_INFO.clear()
+        info = IP_INFO[intern(ipaddr)] = \
+            (ip.is_global, ip.is_private, ip.is_multicast, ip.is_reserved, ver, country)
+    return info
+
+
 
 #    #          ### ######
  #    #          #  #     #     ####   ####  #    # #    #
@@ -427,41 +1452,33 @@ class IPConnection():
     """
     def __init__(self, ipaddr):
         self.my_ipaddress = ipaddr   # IP address of the object
+        self.info = ip_info(ipaddr)  # shared type and country of IP address
         self.tx_protocols = set()
 
         self.first_touch = 0
         self.last_touch = 0
 
         self.tx_bytes = 0
+        self.tx_pkts = 0
         self.tx_sec_graph = None
         self.tx_min_graph = None
+        self.tx_rate = RateMeter()
 
         self.rx_bytes = 0
+        self.rx_pkts = 0
         self.rx_sec_graph = None
         self.rx_min_graph = None
+        self.rx_rate = RateMeter()
 
-        ip = ipaddress.ip_address(ipaddr)
-        self.global_ip = ip.is_global
-        self.private_ip = ip.is_private
-        self.multicast_ip = ip.is_multicast
-        self.reserved_ip = ip.is_reserved
-        self.ip_ver = 4 if isinstance(ip, ipaddress.IPv4Address) else 6
-        del ip
-
-        self.country = ''
-        try:
-            if self.ip_ver == 4:
-                cmd = "which geoiplookup > /dev/null && geoiplookup "+ipaddr+" | awk '{print$4}'"
-            else:
-                cmd = "which geoiplookup6 > /dev/null && geoiplookup6 "+ipaddr+" | awk '{print$5}'"
-            output = subprocess.check_output(cmd, shell=True, universal_newlines=True)
-            if output[2:4] == ',\n':   # if found, there is 'CC,\n'
-                self.country = output[0:2]
-        except:
-            pass
+    global_ip = property(lambda self: self.info[0])
+    private_ip = property(lambda self: self.info[1])
+    multicast_ip = property(lambda self: self.info[2])
+    reserved_ip = property(lambda self: self.info[3])
+    ip_ver = property(lambda self: self.info[4])
+    country = property(lambda self: self.info[5])
 
     def inspect_packet_and_update(self, macaddr, pkt):
-        tm = float(pkt[P_TIME])
+        tm = pkt.time
         self.last_touch = tm
 
         # init when never seen before
@@ -472,20 +1489,26 @@ class IPConnection():
             self.rx_sec_graph = GraphTimeLine(tm, 1)
             self.rx_min_graph = GraphTimeLine(tm, 60)
 
-        vol = int(pkt[P_FRAMELEN])
-        if macaddr == pkt[P_ETHSRC]:
+        vol = pkt.length
+        if macaddr == pkt.eth_src:
             self.tx_bytes += vol
+            self.tx_pkts += 1
             self.tx_sec_graph.update(tm, vol)
             self.tx_min_graph.update(tm, vol)
-            self.tx_protocols.add(packet_protocol(pkt))
+            self.tx_rate.add(tm, vol)
+            self.tx_protocols.add(pkt.label)
         else:
             self.rx_bytes += vol
+            self.rx_pkts += 1
             self.rx_sec_graph.update(tm, vol)
             self.rx_min_graph.update(tm, vol)
+            self.rx_rate.add(tm, vol)
 
-    def ip_statistics(self, now):
+    def ip_statistics(self, now, rate_time):
         return {'rx': self.rx_bytes,
                 'tx': self.tx_bytes,
+                'rp': self.rx_pkts,
+                'tp': self.tx_pkts,
                 'glob': self.global_ip,
                 'priv': self.private_ip,
                 'mult': self.multicast_ip,
@@ -493,9 +1516,17 @@ class IPConnection():
                 'cntr': self.country,
                 'fa': self.first_touch,
                 'la': self.last_touch - now,
-                'prot': self.tx_protocols
+                'prot': self.tx_protocols,
+                'txr': self.tx_rate.rates(rate_time),
+                'rxr': self.rx_rate.rates(rate_time)
                }
 
+    def minute_volumes(self, since=None):
+        # [(minute, tx, rx)] from minute of since
+        start = self.tx_min_graph.interval(since) if since else 0
+        tx, rx = self.tx_min_graph.gr, self.rx_min_graph.gr
+        return [(m, tx.get(m, 0), rx.get(m, 0)) for m in sorted(set(tx) | set(rx)) if m >= start]
+
     def tx_sec_graph_data(self, now):
         return self.tx_sec_graph.get_graph()
 
@@ -537,6 +1568,44 @@ class GraphTimeLine():
         return dct
 
 
+class RateMeter():
+    # bytes per second as exponential moving averages over RATE_WINDOWS; volume
+    # of current second is summed and folded into the averages when next second
+    # starts (seconds without traffic only decay them), constant work per packet
+    __slots__ = ('second', 'volume', 'averages')
+
+    def __init__(self):
+        self.second = 0                 # current second
+        self.volume = 0                 # bytes in current second
+        self.averages = [0.0] * len(RATE_WINDOWS)
+
+    def folded(self, second):
+        # averages at the start of second
+        vol = self.volume
+        averages = [avg + alpha*(vol-avg) for avg, alpha in zip(self.averages, RATE_ALPHAS)]
+        gap = second - self.second
+        if gap > 1:
+            averages = [avg * (1-alpha)**(gap-1) for avg, alpha in zip(averages, RATE_ALPHAS)]
+        return averages
+
+    def add(self, tm, vol):
+        second = int(tm)
+        if second > self.second:
+            if self.second:
+                self.averages = self.folded(second)
+            self.second = second
+            self.volume = 0
+        # packets out of order are counted into current second
+        self.volume += vol
+
+    def rates(self, now):
+        # rounded bytes/sec for each window at time now (current second is not
+        # over yet, so it is not counted until then)
+        if self.second and int(now) > self.second:
+            return tuple(round(avg) for avg in self.folded(int(now)))
+        return tuple(round(avg) for avg in self.averages)
+
+
 
 #    #          ######
  #    #         #     # ######   ##   #####  ###### #####
@@ -547,33 +1616,71 @@ class GraphTimeLine():
 #    #          #     # ###### #    # #####  ###### #    #
 
 
+# positions of COLUMNS in exported row according to its header
+# (None when exported row has exactly the layout of COLUMNS)
+#
+def column_mapping(header):
+    if tuple(header) == COLUMNS:
+        return None
+    missing = len(header)  # index of empty value appended to exported row
+    return [header.index(c) if c in header else missing for c in COLUMNS]
+
+
+class Packet():
+    # row parsed once for all consumers (inspector, devices, connections, flows, reader):
+    # values used for every packet are typed, the rest stays in columns as exported
+    __slots__ = ('cols', 'source', 'time', 'length', 'eth_src', 'eth_dst', 'protocol', 'label',
+                 'ip_src', 'ip_dst')
+
+    def __init__(self, cols, source=0):
+        self.cols = cols                        # list of COLUMNS (DNS, mDNS, DHCP, streams)
+        self.source = source                    # number of PacketSource (stream indexes are its own)
+        self.time = float(cols[P_TIME])         # epoch time (ValueError when malformed)
+        self.length = int(cols[P_FRAMELEN])     # frame length
+        self.eth_src = cols[P_ETHSRC]
+        self.eth_dst = cols[P_ETHDST]
+        self.protocol = cols[P_PROTOCOL]
+        self.label = packet_protocol(cols)      # shared protocol/port label
+        # IPv4 or IPv6 address, first one only (tshark sometimes exports both ipdst and
+        # ipsrc in one field, tunnels are exported with more addresses)
+        src = cols[P_IPSRC] or cols[P_IPV6SRC]
+        dst = cols[P_IPDST] or cols[P_IPV6DST]
+        self.ip_src = src.split('|', 1)[0] if '|' in src else src
+        self.ip_dst = dst.split('|', 1)[0] if '|' in dst else dst
+
+
 class PacketReader():
     """
     Reads from file or named pipe tab delimited plain text (output of tshark -T fields ....)
-    There is queue between reader and packet processor (not to block pipe)
+    or runs tshark on network interfaces itself (one process per interface).
+    There is queue between reader and packet processor (not to block pipe), one per source;
+    with more sources, packets are processed in time order of all sources.
     Can simulate speed when reads from file: 0=immediately, 1=simulate realtime, 60=60x faster etc.
     """
-    def __init__(self, read_from, inspector, replay=0, limit=float('inf'), write_to=None):
+    def __init__(self, read_from, inspector, replay=0, limit=float('inf'), write_to=None,
+                 filter_label=''):
 
         self.worker = inspector         # packet processor object
         self.capture_limit = limit      # max number of packets to process
-        self.wf = None                  # write file descriptor
-        self.queue = deque()            # "thread-safe memory efficient queue"
+        self.writer = None              # PreserveWriter of processed rows
         self.pkts_processed = 0
+        self.pkts_dropped = 0           # malformed rows (wrong number of columns)
         self.first_pkt_time = 0
         self.last_pkt_time = 0
         self.last_cpu_time = 0
         self.performance = 0            # pkts per second (computing, not network traffic)
+        self.read_rate = 0              # compressed input bytes per second
+        self.queue_bytes = 0            # approximate bytes of rows in queues (sampled every second)
         self.is_running = False
-        self.is_reading = False
         self.status = 0                 # 0-no errors, otherwise 1,2,3...
         self.speed = replay             # if from file, speed of replay
+        self.filter_label = filter_label  # description of filter applied by tshark
+
+        # path name of file/pipe, or tshark commands (lists of arguments), one per interface
+        inputs = read_from if isinstance(read_from, list) else [read_from]
+        self.sources = [PacketSource(self, i, n) for n, i in enumerate(inputs)]
+        self.header_written = False
 
-        self.reader_thread = threading.Thread(
-                                target=self.stream_reader_daemon,
-                                args=(read_from,),
-                                daemon=True,
-                                name='pipe_reader')
         self.queue_thread = threading.Thread(
                                 target=self.queue_processor,
                                 name='packet_processor')
@@ -582,52 +1689,62 @@ class PacketReader():
                                 name='perf_monitor')
 
         if write_to:
-            try:
-                self.wf = open(write_to, 'w')
-            except:
-                self.status = 11
-
-    def stream_reader_daemon(self, read_from):
-        self.is_reading = True
-        with open(read_from, 'r') as inputstream:
-            # basic format check
-            row = inputstream.readline() # header
-            if self.wf:
-                self.wf.write(row)
-            pkt = row.split('\t')
-            if len(pkt) != COLUMNS_EXPECTED:
-                self.status = 1
+            # path name or already configured writer
+            self.writer = PreserveWriter(write_to) if isinstance(write_to, str) else write_to
+            self.status = self.writer.status
+
+    def header_read(self, source, row):
+        # called by source when its header was read and checked (or when tshark gave up);
+        # failed source ends alone, the reader fails when all its sources have failed
+        if source.status:
+            source.is_reading = False
+            if all(s.status for s in self.sources):
+                self.status = source.status
                 self.capture_limit = -1
-            elif pkt[P_TIME] == 'frame.time_epoch':
-                # read first packet and check format
-                row = inputstream.readline()
-                pkt = row.split('\t')
-                try:
-                    _ = int(pkt[P_FRAMELEN])
-                    self.last_pkt_time = float(pkt[P_TIME])
-                    self.first_pkt_time = float(pkt[P_TIME])
-                except:
-                    self.status = 2
-                    self.capture_limit = -1
-            else:
-                self.status = 3
-                self.capture_limit = -1
-            # loop won't start if errors
-            while row and self.pkts_processed < self.capture_limit:
-                self.queue.append(row)
-                row = inputstream.readline()
-        self.is_reading = False
+        elif self.writer and not self.header_written:
+            self.writer.set_header(row)
+            self.header_written = True
+
+    def next_row(self):
+        # next row and its source; with more sources (interfaces) the one with the oldest
+        # packet, waiting shortly for an empty source which is still capturing
+        if len(self.sources) == 1:
+            source = self.sources[0]
+            return (source, source.queue.popleft()) if source.queue else (None, None)
+        oldest = None
+        waiting = False
+        for source in self.sources:
+            if source.queue:
+                source.empty_since = 0
+                if not oldest or source.head_time() < oldest.head_time():
+                    oldest = source
+            elif source.is_reading and source.waited() < MERGE_WAIT:
+                waiting = True
+        # packet captured more than MERGE_WAIT ago cannot be preceded by a packet
+        # still to arrive from an empty source, so it is not waited for
+        if waiting and oldest and oldest.head_time() >= time.time() - MERGE_WAIT:
+            return None, None
+        return (oldest, oldest.queue.popleft()) if oldest else (None, None)
 
     def queue_processor(self):
         while self.is_running:
-            while len(self.queue) > 0 and self.pkts_processed < self.capture_limit:
-                row = self.queue.popleft()
-                if self.wf:
-                    self.wf.write(row)
-                pkt = row.split('\t')
+            while self.pkts_processed < self.capture_limit:
+                source, row = self.next_row()
+                if not row:
+                    break
+                if self.writer:
+                    self.writer.write(row)
+                tm = perf_counter()
+                pkt = source.parse_row(row)
+                H_PARSE.add(perf_counter() - tm)
+                if not pkt:
+                    self.pkts_dropped += 1
+                    continue
+                if not self.first_pkt_time:
+                    self.first_pkt_time = self.last_pkt_time = pkt.time
                 # packet delay when simulating speed
                 if self.speed > 0:
-                    delay = (float(pkt[P_TIME]) - self.last_pkt_time)/self.speed
+                    delay = (pkt.time - self.last_pkt_time)/self.speed
                     # interruptable sleep for long waits between packets
                     while delay > 3:
                         time.sleep(3)
@@ -636,35 +1753,56 @@ class PacketReader():
                             delay = 0
                     if delay > 0: time.sleep(delay)
                 self.last_cpu_time = time.time()
-                self.last_pkt_time = float(pkt[P_TIME])
+                self.last_pkt_time = pkt.time
                 self.worker.process_packet(pkt)
                 self.pkts_processed += 1
-            time.sleep(0.2)
+            # rows waiting for merge with an empty source are looked at again soon
+            time.sleep(MERGE_POLL if self.queue_length() else 0.2)
             # quit when limit is reached or nothing else will arrive into queue
-            if (not self.is_reading and len(self.queue) == 0) \
+            if (not self.is_reading() and not self.queue_length()) \
                 or (self.pkts_processed >= self.capture_limit):
                 self.is_running = False
 
     def performance_monitor(self):
         while self.is_running:
             previous = self.pkts_processed
+            previous_bytes = self.compressed_bytes()
             time.sleep(1)
             self.performance = self.pkts_processed - previous
+            self.read_rate = self.compressed_bytes() - previous_bytes
+            self.queue_bytes = sum(source.queue_bytes() for source in self.sources)
+            self.worker.update_memory_estimates()
         self.performance = -1
+        self.read_rate = 0
+        self.queue_bytes = 0
+
+    def compressed_bytes(self):
+        return sum(source.decompressor.bytes_read for source in self.sources if source.decompressor)
+
+    def is_reading(self):
+        return any(source.is_reading for source in self.sources)
+
+    def queue_length(self):
+        return sum(len(source.queue) for source in self.sources)
 
     def start(self):
         if not self.status:
             self.is_running = True
-            self.reader_thread.start()
+            for source in self.sources:
+                source.start()
             self.queue_thread.start()
             self.perfmon_thread.start()
+            if self.writer:
+                self.writer.start()
 
     def stop(self):
         self.is_running = False
         self.capture_limit = -1
-        if self.wf:
+        for source in self.sources:
+            source.stop()
+        if self.writer:
             time.sleep(0.1)
-            self.wf.close()
+            self.writer.close()
 
     def get_statuses(self):
         tm = self.last_pkt_time
@@ -675,6 +1813,395 @@ class PacketReader():
                 'snc': self.first_pkt_time,
                 'pkts': self.pkts_processed,
                 'live': self.is_running,
-                'ql': len(self.queue) if isinstance(self.queue, deque) else -1,
+                'ql': self.queue_length(),
                 'perf': self.performance,
-                'err': self.status}
+                'crate': self.read_rate,
+                'qb': self.queue_bytes,
+                'drop': self.pkts_dropped,
+                'flt': self.filter_label,
+                'rst': sum(source.restarts for source in self.sources),
+                'fail': [source.name for source in self.sources if source.status],
+                'pdrop': self.writer.rows_dropped if self.writer else 0,
+                'err': self.status or (self.writer.status if self.writer else 0)}
+
+
+class StaticReader():
+    """
+    Stands in for PacketReader in TUI showing data which are not being captured
+    (loaded from database or by offline engine); statuses not given are zero
+    """
+    def __init__(self, statuses):
+        self.statuses = {'time': 0, 'snc': 0, 'pkts': 0, 'live': False, 'ql': 0, 'perf': 0,
+                         'crate': 0, 'qb': 0, 'drop': 0, 'flt': '', 'rst': 0, 'fail': [],
+                         'pdrop': 0, 'err': 0}
+        self.statuses.update({key: value for key, value in statuses.items() if value is not None})
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def get_statuses(self):
+        return self.statuses
+
+
+# one input of PacketReader
+#
+class PacketSource():
+    # file/named pipe is read once; tshark process is restarted whenever it dies
+    # (until it fails repeatedly without capturing anything)
+    def __init__(self, reader, read_from, number):
+        self.reader = reader
+        self.number = number            # position among reader's sources
+        self.read_from = read_from      # path name or tshark command
+        # interface of tshark command, or path name
+        self.name = read_from[read_from.index('-i')+1] if isinstance(read_from, list) else read_from
+        self.process = None             # running tshark
+        self.decompressor = None        # Decompressor of compressed file
+        self.queue = deque()            # "thread-safe memory efficient queue"
+        self.is_reading = False
+        self.status = 0                 # 0-no errors, otherwise 1,2,3...
+        self.restarts = 0               # how many times tshark was restarted
+        self.columns = 0                # number of columns in exported rows
+        self.mapping = None             # positions of COLUMNS in exported row (or None)
+        self.time_col = 0               # position of time in exported row
+        self.empty_since = 0            # since when queue is empty (for merging sources)
+        self.h_read = PROFILER.histogram_part('read')  # reading line (thread's own histogram)
+        self.thread = threading.Thread(
+                                target=self.stream_reader_daemon,
+                                daemon=True,
+                                name=f'pipe_reader_{number}')
+
+    def start(self):
+        self.is_reading = True
+        self.thread.start()
+
+    def stop(self):
+        self.is_reading = False
+        if self.process:
+            try:
+                self.process.terminate()
+            except:
+                pass
+        if self.decompressor:
+            self.decompressor.stop()
+
+    def stream_reader_daemon(self):
+        if isinstance(self.read_from, list):
+            self.tshark_supervisor()
+        elif compression_of(self.read_from):
+            self.decompressor = Decompressor(self.read_from, compression_of(self.read_from))
+            with self.decompressor.open() as inputstream:
+                self.read_stream(inputstream)
+            self.decompressor.stop()
+        else:
+            with open(self.read_from, 'r') as inputstream:
+                self.read_stream(inputstream)
+        self.is_reading = False
+
+    def tshark_supervisor(self):
+        failures = 0
+        while self.is_reading and self.reader.is_running:
+            try:
+                self.process = subprocess.Popen(self.read_from, stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL, universal_newlines=True, bufsize=1)
+                rows = self.read_stream(self.process.stdout)
+                self.process.wait()
+            except:
+                rows = 0
+            if not (self.is_reading and self.reader.is_running):
+                break
+            # tshark has died; give up when it cannot capture at all
+            failures = 0 if rows else failures+1
+            if failures >= TSHARK_FAILURES:
+                self.status = 4
+                self.reader.header_read(self, '')
+                break
+            self.restarts += 1
+            time.sleep(min(2**failures, 30))
+
+    def read_stream(self, inputstream):
+        # basic format check
+        row = inputstream.readline() # header
+        header = row.rstrip('\n').split('\t')
+        if 'frame.time_epoch' not in header:
+            self.status = 3
+        elif not all(c in header for c in COLUMNS_REQUIRED):
+            self.status = 1
+        else:
+            self.columns = len(header)
+            self.mapping = column_mapping(header)
+            self.time_col = header.index('frame.time_epoch')
+            # check format of first packet
+            row = inputstream.readline()
+            if row and not self.parse_row(row):  # nothing captured is not an error of format
+                self.status = 2
+        if self.status and isinstance(self.read_from, list) and not row:
+            self.status = 0  # tshark has not started, supervisor decides
+            return 0
+        self.reader.header_read(self, '\t'.join(header) + '\n')
+        rows = 0
+        # loop won't start if errors
+        while row and not self.status and self.reader.pkts_processed < self.reader.capture_limit:
+            self.queue.append(row)
+            rows += 1
+            tm = perf_counter()
+            row = inputstream.readline()
+            self.h_read.add(perf_counter() - tm)
+        return rows
+
+    def parse_row(self, row):
+        # exported row -> Packet (None when malformed)
+        cols = row.rstrip('\n').split('\t')
+        if len(cols) != self.columns:
+            return None
+        if self.mapping:
+            cols.append('')  # value of missing columns
+            cols = [cols[i] for i in self.mapping]
+        try:
+            return Packet(cols, self.number)
+        except ValueError:
+            return None
+
+    def head_time(self):
+        # time of the oldest packet in queue
+        try:
+            return float(self.queue[0].split('\t', self.time_col+1)[self.time_col])
+        except:
+            return 0
+
+    def queue_bytes(self):
+        # approximate bytes of queued rows, by size of the oldest and the newest one
+        # (rows are taken by another thread meanwhile)
+        try:
+            length = len(self.queue)
+            return getsizeof(self.queue) + \
+                length*(getsizeof(self.queue[0]) + getsizeof(self.queue[-1]))//2
+        except:
+            return getsizeof(self.queue)
+
+    def waited(self):
+        # how long the empty queue is waited for
+        if not self.empty_since:
+            self.empty_since = time.time()
+        return time.time() - self.empty_since
+
+
+# compression of regular file by its magic bytes (None for plain files and pipes)
+#
+def compression_of(pathname):
+    try:
+        if not os.path.isfile(pathname):
+            return None
+        with open(pathname, 'rb') as f:
+            magic = f.read(6)
+    except:
+        return None
+    for tool, (signature, _) in DECOMPRESSORS.items():
+        if magic.startswith(signature):
+            return tool
+    return None
+
+
+# streaming decompression of input file
+#
+class Decompressor():
+    # file is decompressed by external tool (own process, own CPU core) fed by a thread
+    # which counts compressed bytes; python module in own thread if tool is not installed
+    def __init__(self, path, tool):
+        self.path = path
+        self.tool = tool                # 'gzip', 'xz' or 'bzip2'
+        self.process = None
+        self.bytes_read = 0             # compressed bytes read from file
+        self.is_running = False
+
+    def open(self):
+        # text stream of decompressed data
+        self.is_running = True
+        try:
+            self.process = subprocess.Popen([self.tool, '-dc'], stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            target, output, stream = self.feeder, self.process.stdin, self.process.stdout
+        except:
+            # python modules release GIL while decompressing
+            rfd, wfd = os.pipe()
+            target, output, stream = self.decompressor, open(wfd, 'wb'), open(rfd, 'rb')
+        threading.Thread(target=target, args=(output,), daemon=True,
+                         name=f'{self.tool}_decompressor').start()
+        return io.TextIOWrapper(stream)
+
+    def chunks(self):
+        with open(self.path, 'rb') as f:
+            while self.is_running:
+                chunk = f.read(DECOMPRESS_CHUNK)
+                if not chunk:
+                    break
+                self.bytes_read += len(chunk)
+                yield chunk
+
+    def feeder(self, output):
+        try:
+            for chunk in self.chunks():
+                output.write(chunk)
+        except:
+            pass
+        try:
+            output.close()
+        except:
+            pass
+
+    def decompressor(self, output):
+        new_decompressor = DECOMPRESSORS[self.tool][1]
+        try:
+            dec = new_decompressor()
+            for chunk in self.chunks():
+                output.write(dec.decompress(chunk))
+                # concatenated streams (e.g. appended gzip members)
+                while dec.eof and dec.unused_data:
+                    data = dec.unused_data
+                    dec = new_decompressor()
+                    output.write(dec.decompress(data))
+        except:
+            pass
+        try:
+            output.close()
+        except:
+            pass
+
+    def stop(self):
+        self.is_running = False
+        if self.process:
+            try:
+                self.process.terminate()
+            except:
+                pass
+
+
+
+# writer of --preserve file(s)
+#
+class PreserveWriter():
+    # rows are collected in a bounded buffer and written by own thread in large batches,
+    # so a stalled disk never stalls packet processing (rows are dropped and counted instead);
+    # files may be compressed (gz, xz) and rotated by size or time
+    def __init__(self, path, compress=None, rotate_size=0, rotate_time=0, keep=0,
+                 buffer_size=PRESERVE_BUFFER):
+        self.path = path                # path name, '.csv' is replaced for rotated files
+        self.compress = compress        # None, 'gz' or 'xz'
+        self.rotate_size = rotate_size  # bytes on disk per file (0=no limit)
+        self.rotate_time = rotate_time  # seconds per file (0=no limit)
+        self.keep = keep                # number of rotated files to keep (0=all)
+        self.buffer_size = buffer_size  # max bytes waiting in buffer
+        self.buffer = deque()
+        # bytes in buffer are bytes_added - bytes_taken, each counter is updated by one thread only
+        self.bytes_added = 0            # bytes put into buffer (by packet processor)
+        self.bytes_taken = 0            # bytes taken from buffer (by writer thread)
+        self.header = ''
+        self.wf = None
+        self.filename = None            # current file
+        self.files = []                 # all written files
+        self.file_number = 0
+        self.file_opened = 0            # time when current file was opened
+        self.rows_dropped = 0           # rows not written because of full buffer
+        self.is_running = False
+        self.status = 0                 # 0-no errors, 11-cannot open file, 12-cannot write
+
+        # fail early when file cannot be created
+        self.open_next()
+
+        self.thread = threading.Thread(
+                                target=self.batch_writer,
+                                daemon=True,
+                                name='preserve_writer')
+
+    def set_header(self, row):
+        # header is first row of every file
+        self.header = row
+        self.write(row)
+
+    def write(self, row):
+        if self.bytes_added - self.bytes_taken < self.buffer_size:
+            self.buffer.append(row)
+            self.bytes_added += len(row)
+        else:
+            self.rows_dropped += 1
+
+    def open_next(self):
+        if self.wf:
+            self.wf.close()
+        name = self.path
+        if self.rotate_size or self.rotate_time:
+            self.file_number += 1
+            base = name[:-4] if name.endswith('.csv') else name
+            name = f"{base}-{self.file_number:03}.csv"
+        if self.compress == 'gz':
+            name += '.gz'
+            opener = lambda n: gzip.open(n, 'wt', compresslevel=6)
+        elif self.compress == 'xz':
+            name += '.xz'
+            opener = lambda n: lzma.open(n, 'wt', preset=3)
+        else:
+            opener = lambda n: open(n, 'w')
+        try:
+            self.wf = opener(name)
+        except:
+            self.wf = None
+            self.status = 11
+            return
+        self.filename = name
+        self.files.append(name)
+        self.file_opened = time.time()
+        # remove the oldest rotated files
+        while self.keep and len(self.files) > self.keep:
+            try:
+                os.remove(self.files.pop(0))
+            except:
+                pass
+
+    def needs_rotation(self):
+        if self.rotate_time and time.time() - self.file_opened >= self.rotate_time:
+            return True
+        if self.rotate_size:
+            try:
+                return os.stat(self.filename).st_size >= self.rotate_size
+            except:
+                pass
+        return False
+
+    def flush_buffer(self):
+        rows = []
+        size = 0
+        while self.buffer and size < PRESERVE_BATCH:
+            row = self.buffer.popleft()
+            rows.append(row)
+            size += len(row)
+        self.bytes_taken += size
+        if rows and self.wf:
+            try:
+                self.wf.write(''.join(rows))
+            except:
+                self.status = 12
+        return size
+
+    def batch_writer(self):
+        while self.is_running or self.buffer:
+            if not self.flush_buffer():
+                time.sleep(0.2)
+            elif self.needs_rotation() and self.wf:
+                self.open_next()
+                if self.wf and self.header:
+                    self.wf.write(self.header)
+
+    def start(self):
+        if not self.status:
+            self.is_running = True
+            self.thread.start()
+
+    def close(self):
+        self.is_running = False
+        if self.thread.is_alive():
+            self.thread.join()
+        if self.wf:
+            self.wf.close()
+            self.wf = None
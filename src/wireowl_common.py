@@ -50,3 +50,124 @@ def fmt_time(epoch, variant=1):
         ret = time.strftime("%d.%m.%Y %H:%M:%S", st)
     return ret
 
+
+# duration in seconds as short text, e.g. '12.5us', '3.2ms', '1.05s'
+#
+def fmt_duration(sec):
+    if sec < 0.001:
+        return f"{sec*1000000:.1f}us"
+    if sec < 1:
+        return f"{sec*1000:.1f}ms"
+    return f"{sec:.2f}s"
+
+
+# latency histogram of one processing stage
+#
+class LatencyHistogram():
+    # bucket b holds durations shorter than 2**b microseconds (log2 scale, 1us..~30s),
+    # so one update is an int conversion and a few additions
+    BUCKETS = 26
+
+    def __init__(self, name):
+        self.name = name
+        self.counts = [0]*self.BUCKETS
+        self.n = 0              # number of samples
+        self.total = 0.0        # sum of durations (sec)
+        self.max = 0.0          # longest duration (sec)
+
+    def add(self, duration):
+        b = int(duration*1000000).bit_length()
+        self.counts[b if b < self.BUCKETS else self.BUCKETS-1] += 1
+        self.n += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def percentile(self, pct):
+        # upper bound of the bucket (sec) where percentile falls
+        if not self.n:
+            return 0.0
+        limit = self.n*pct/100
+        cumulative = 0
+        for b, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= limit:
+                return min((1 << b)/1000000, self.max)
+        return self.max
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.n += other.n
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def clear(self):
+        self.counts = [0]*self.BUCKETS
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+# latency histograms for all stages of packet processing and screen rendering
+#
+class Profiler():
+    STAGES = ('read', 'parse', 'lock', 'process', 'geo', 'build', 'draw')
+
+    def __init__(self):
+        self.stages = {}
+        self.parts = {}                 # {stage:[histograms of threads recording the stage]}
+        for stage in self.STAGES:
+            self.histogram(stage)
+
+    def histogram(self, stage):
+        if stage not in self.stages:
+            self.stages[stage] = LatencyHistogram(stage)
+        return self.stages[stage]
+
+    def histogram_part(self, stage):
+        # own histogram of one of more threads recording the same stage (updates of one
+        # histogram by more threads would lose samples), parts are merged in reports
+        self.histogram(stage)
+        h = LatencyHistogram(stage)
+        self.parts.setdefault(stage, []).append(h)
+        return h
+
+    def merged(self):
+        # histogram of each stage with its parts
+        ret = []
+        for stage, h in self.stages.items():
+            if stage in self.parts:
+                h = LatencyHistogram(stage)
+                for part in [self.stages[stage]] + self.parts[stage]:
+                    h.merge(part)
+            ret.append(h)
+        return ret
+
+    def report(self):
+        # one text row per stage: samples, average, percentiles, max
+        rows = [f"{'stage':8}{'samples':>11}{'avg':>10}{'p50':>10}{'p90':>10}"
+                f"{'p99':>10}{'max':>10}"]
+        for h in self.merged():
+            avg = h.total/h.n if h.n else 0
+            rows.append(f"{h.name:8}{h.n:11}{fmt_duration(avg):>10}"
+                        f"{fmt_duration(h.percentile(50)):>10}"
+                        f"{fmt_duration(h.percentile(90)):>10}"
+                        f"{fmt_duration(h.percentile(99)):>10}"
+                        f"{fmt_duration(h.max):>10}")
+        return rows
+
+    def dump(self, filename):
+        try:
+            with open(filename, 'w') as wf:
+                wf.write('\n'.join(self.report()) + '\n\n')
+                # raw buckets for further processing
+                wf.write("stage\t" + '\t'.join(f"<{1 << b}us" for b in range(LatencyHistogram.BUCKETS)) + '\n')
+                for h in self.merged():
+                    wf.write(h.name + '\t' + '\t'.join(str(c) for c in h.counts) + '\n')
+        except:
+            return False
+        return True
+
+
+# shared instance for the whole app
+PROFILER = Profiler()
@@ -0,0 +1,383 @@
+# -*- coding: utf8 -*-
+
+# This file is part of wireowl which is released under GNU GPLv2 license.
+#
+# Copyright 2021, 2022 Jiri Rozvaril <rozvara at vync dot org>
+
+# Headless capture daemon: one PacketReader + TrafficInspector shared by any number
+# of TUI clients attached over a local Unix socket.
+#
+# Protocol is one JSON object per line in both directions:
+#   request  {"m": method, "a": [args...]}
+#   response {"r": result} or {"e": error text}
+# Method 'sync' returns only what has changed for the client's view since its last sync
+# (the server keeps a shadow copy of what was sent to each client); other methods are
+# inspector getters/actions called directly.
+
+import os
+import json
+import time
+import socket
+import threading
+import socketserver
+
+# graph kinds and their inspector methods
+GRAPHS = {'tx_sec': 'get_device_ip_tx_sec_graph',
+          'tx_min': 'get_device_ip_tx_min_graph',
+          'rx_sec': 'get_device_ip_rx_sec_graph',
+          'rx_min': 'get_device_ip_rx_min_graph'}
+
+# inspector methods a client may call
+ALLOWED_PREFIXES = ('get_', 'clear_', 'export_')
+
+# seconds a snapshot of all devices' statistics is shared by sessions (refresh tick of TUI)
+SNAPSHOT_AGE = 0.25
+
+
+
+#    #           #####
+ #    #         #     # ###### #####  #    # ###### #####
+  #    #        #       #      #    # #    # #      #    #
+   #    #        #####  #####  #    # #    # #####  #    #
+  #    #              # #      #####  #    # #      #####
+ #    #         #     # #      #   #   #  #  #      #   #
+#    #           #####  ###### #    #   ##   ###### #    #
+
+
+class StateServer():
+    """
+    Serves state of TrafficInspector and statuses of PacketReader to attached TUI clients
+    """
+    def __init__(self, path, inspector, reader):
+
+        self.worker = inspector
+        self.reader = reader
+        self.path = path
+        self.server = None
+        self.sessions = set()           # ClientSessions of attached clients (set is thread-safe)
+        self.status = 0                 # 0-no errors, 1-could not listen
+        self.snapshot = ([], [], {})    # devices, clients and {mac:stats} shared by sessions
+        self.snapshot_time = 0          # monotonic time of snapshot
+        self.snapshot_lock = threading.Lock()
+
+        server = self                   # for request handler
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                session = ClientSession(server.worker, server.reader, server.get_snapshot)
+                server.sessions.add(session)
+                try:
+                    for line in self.rfile:
+                        self.wfile.write(session.request(line))
+                except:
+                    pass
+                server.sessions.discard(session)
+
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+            umask = os.umask(0o077)  # socket for owner only
+            self.server = ThreadingUnixServer(path, Handler)
+            os.umask(umask)
+        except:
+            self.status = 1
+
+        self.server_thread = threading.Thread(
+                                target=self.server.serve_forever if self.server else None,
+                                daemon=True,
+                                name='state_server')
+
+    def get_snapshot(self):
+        # device lists and statistics of all devices, built once per tick for all sessions
+        # (inspector's lock is taken once, not per device and client)
+        with self.snapshot_lock:
+            if time.monotonic() - self.snapshot_time >= SNAPSHOT_AGE:
+                self.snapshot = (self.worker.get_devices(), self.worker.get_clients(),
+                                 self.worker.get_all_device_statistics(0))
+                self.snapshot_time = time.monotonic()
+            return self.snapshot
+
+    def start(self):
+        if not self.status:
+            self.server_thread.start()
+
+    def stop(self):
+        if self.server and not self.status:
+            self.server.shutdown()
+            self.server.server_close()
+            try:
+                os.remove(self.path)
+            except:
+                pass
+
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ClientSession():
+    """
+    State of one attached client: what has been already sent to it
+    """
+    def __init__(self, inspector, reader, snapshot):
+        self.worker = inspector
+        self.reader = reader
+        self.snapshot = snapshot        # StateServer.get_snapshot
+        self.devices = []               # list of devices sent
+        self.clients = []               # list of clients sent
+        self.stats = {}                 # device statistics sent {mac:stats}
+        self.macaddr = None             # device whose connections are sent
+        self.conns = {}                 # connection statistics sent {ip:stats}
+        self.graphs = {}                # last graph bar sent {(ip,kind):time}
+
+    def request(self, line):
+        try:
+            req = json.loads(line)
+            method = req['m']
+            args = req.get('a', [])
+            if method == 'sync':
+                ret = {'r': self.sync(*args)}
+            elif method.startswith(ALLOWED_PREFIXES) and hasattr(self.worker, method):
+                ret = {'r': getattr(self.worker, method)(*args)}
+            else:
+                ret = {'e': f"unknown method {method}"}
+        except Exception as e:
+            ret = {'e': repr(e)}
+        return (json.dumps(ret, default=jsonable, separators=(',', ':')) + '\n').encode('utf-8')
+
+    def sync(self, macaddr, all_stats, graph_kinds, width):
+        # changes since previous sync for the client's view: statuses, device lists,
+        # statistics of devices (all or one), connections and visible graph bars
+        ret = {'st': self.reader.get_statuses()}
+
+        devices, clients, snapshot = self.snapshot()
+        if devices != self.devices:
+            ret['dv'] = self.devices = devices
+        if clients != self.clients:
+            ret['cl'] = self.clients = clients
+
+        # time of last activity is sent absolute ('la' with now=0);
+        # list view compares shared snapshot, detail view gets its device only
+        stats = {}
+        for mac in (devices if all_stats else [macaddr] if macaddr in devices else []):
+            dct = snapshot.get(mac) if all_stats else self.worker.get_device_statistics(mac, 0)
+            if dct is not None and self.stats.get(mac) != dct:
+                stats[mac] = self.stats[mac] = dct
+        if stats:
+            ret['ds'] = stats
+
+        if macaddr not in devices:
+            return ret
+
+        conns = self.worker.get_device_connections(macaddr, 0, True)
+        if macaddr != self.macaddr or len(conns) < len(self.conns):
+            # another device or its statistics were cleared
+            self.macaddr = macaddr
+            self.conns = {}
+            self.graphs = {}
+            ret['reset'] = True
+        changed = {}
+        for ip, dct in conns.items():
+            if self.conns.get(ip) != dct:
+                changed[ip] = self.conns[ip] = dct
+        if changed:
+            ret['cs'] = changed
+
+        # graph bars of changed connections (and of not yet sent graphs),
+        # only what fits the screen
+        graphs = {}
+        for ip in conns:
+            for kind in graph_kinds:
+                if ip not in changed and (ip, kind) in self.graphs:
+                    continue
+                dct = getattr(self.worker, GRAPHS[kind])(macaddr, ip, 0)
+                first = dct.pop('f')
+                bar_len = dct.pop('l')
+                last = max(dct.keys()) if dct else first
+                since = max(self.graphs.get((ip, kind), first), last-width*bar_len)
+                self.graphs[(ip, kind)] = last
+                graphs.setdefault(ip, {})[kind] = \
+                    [first, bar_len, [(tm, v) for tm, v in dct.items() if tm >= since]]
+        if graphs:
+            ret['gr'] = graphs
+        return ret
+
+
+# sets are sent as sorted lists
+#
+def jsonable(obj):
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+
+#    #           #####
+ #    #         #     # #      # ###### #    # #####
+  #    #        #       #      # #      ##   #   #
+   #    #       #       #      # #####  # #  #   #
+  #    #        #       #      # #      #  # #   #
+ #    #         #     # #      # #      #   ##   #
+#    #           #####  ###### # ###### #    #   #
+
+
+class RemoteInspector():
+    """
+    Stands in for TrafficInspector in TUI attached to wireowl daemon.
+    Data of the current view come with one sync() per screen refresh,
+    everything else is called on the daemon.
+    """
+    is_remote = True
+
+    def __init__(self, path):
+        self.sock = None
+        self.stream = None
+        self.status = 0                 # 0-no errors, 21-not connected/connection lost
+        self.statuses = None            # statuses of daemon's packet reader
+        self.devices = []
+        self.clients = []
+        self.stats = {}                 # {mac:stats} with absolute 'la'
+        self.macaddr = None             # device whose connections are cached
+        self.conns = {}                 # {ip:stats} with absolute 'la'
+        self.graphs = {}                # {ip:{kind:{'f':first,'l':bar_len,time:value...}}}
+        self.width = 0
+        try:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(path)
+            self.stream = self.sock.makefile('rwb')
+        except:
+            self.status = 21
+
+    def call(self, method, *args):
+        if self.status:
+            raise ConnectionError("not connected to wireowl daemon")
+        try:
+            self.stream.write((json.dumps({'m': method, 'a': args}) + '\n').encode('utf-8'))
+            self.stream.flush()
+            ret = json.loads(self.stream.readline())
+        except:
+            self.status = 21
+            raise ConnectionError("connection to wireowl daemon lost")
+        if 'e' in ret:
+            raise RuntimeError(ret['e'])
+        return ret['r']
+
+    def sync(self, macaddr, all_stats, graph_kinds, width):
+        try:
+            ret = self.call('sync', macaddr, all_stats, graph_kinds, width)
+        except ConnectionError:
+            return
+        self.statuses = ret['st']
+        self.devices = ret.get('dv', self.devices)
+        self.clients = ret.get('cl', self.clients)
+        self.stats.update(ret.get('ds', {}))
+        if ret.get('reset'):
+            self.macaddr = macaddr
+            self.conns = {}
+            self.graphs = {}
+        self.conns.update(ret.get('cs', {}))
+        self.width = width
+        for ip, kinds in ret.get('gr', {}).items():
+            for kind, (first, bar_len, bars) in kinds.items():
+                dct = self.graphs.setdefault(ip, {}).setdefault(kind, {})
+                dct.update(bars)
+                dct['f'] = first
+                dct['l'] = bar_len
+                # forget bars which will not fit screen any more
+                if len(dct) > 3*width:
+                    limit = max(dct.keys() - {'f', 'l'}) - width*bar_len
+                    for tm in [tm for tm in dct if tm not in ('f', 'l') and tm < limit]:
+                        del dct[tm]
+
+    def get_devices(self):
+        return self.devices
+
+    def get_clients(self):
+        return self.clients
+
+    def get_device_statistics(self, macaddr, ui_time):
+        if macaddr not in self.stats:
+            self.stats[macaddr] = self.call('get_device_statistics', macaddr, 0)
+        return relative(self.stats[macaddr], ui_time)
+
+    def get_devices_summary(self, ui_time):
+        # statistics of all devices are synced for list view
+        ret = []
+        for mac in self.devices:
+            dct = self.stats.get(mac)
+            if dct:
+                ret.append((mac, dct['fa'], dct['la'] - ui_time, dct['rx'], dct['tx'],
+                            dct['dnsq'], dct['dnsd'], dct['conn'], dct['pkts'], dct['ip'],
+                            dct['txr'][0] + dct['rxr'][0], dct['alrt'], dct['mem']))
+        return ret
+
+    def get_device_connections(self, macaddr, ui_time):
+        if macaddr != self.macaddr:
+            return {ip: relative(dct, ui_time) for ip, dct in \
+                        self.call('get_device_connections', macaddr, 0).items()}
+        return {ip: relative(dct, ui_time) for ip, dct in self.conns.items()}
+
+    def get_device_ip_name(self, macaddr, ip, recent=False):
+        if macaddr == self.macaddr and ip in self.conns:
+            return self.conns[ip]['rname' if recent else 'name']
+        return self.call('get_device_ip_name', macaddr, ip, recent)
+
+    def graph(self, kind, macaddr, ip, ui_time):
+        if macaddr == self.macaddr and kind in self.graphs.get(ip, {}):
+            return dict(self.graphs[ip][kind])
+        dct = self.call(GRAPHS[kind], macaddr, ip, ui_time)
+        # JSON object keys are strings
+        return {k if k in ('f', 'l') else int(k): v for k, v in dct.items()}
+
+    def get_device_ip_tx_sec_graph(self, macaddr, ip, ui_time):
+        return self.graph('tx_sec', macaddr, ip, ui_time)
+
+    def get_device_ip_tx_min_graph(self, macaddr, ip, ui_time):
+        return self.graph('tx_min', macaddr, ip, ui_time)
+
+    def get_device_ip_rx_sec_graph(self, macaddr, ip, ui_time):
+        return self.graph('rx_sec', macaddr, ip, ui_time)
+
+    def get_device_ip_rx_min_graph(self, macaddr, ip, ui_time):
+        return self.graph('rx_min', macaddr, ip, ui_time)
+
+    def __getattr__(self, method):
+        # all other getters and actions are called on the daemon
+        if method.startswith(ALLOWED_PREFIXES):
+            return lambda *args: self.call(method, *args)
+        raise AttributeError(method)
+
+
+class RemoteReader():
+    """
+    Stands in for PacketReader in TUI attached to wireowl daemon
+    """
+    def __init__(self, remote):
+        self.remote = remote
+
+    def start(self):
+        pass
+
+    def stop(self):
+        if self.remote.sock:
+            self.remote.sock.close()
+
+    def get_statuses(self):
+        st = self.remote.statuses
+        if not st or self.remote.status:
+            st = {'time': st['time'] if st else 0, 'snc': st['snc'] if st else 0,
+                  'pkts': st['pkts'] if st else 0, 'live': False, 'ql': -1,
+                  'perf': -1, 'crate': 0, 'qb': 0, 'drop': st['drop'] if st else 0,
+                  'flt': st['flt'] if st else '', 'rst': st['rst'] if st else 0,
+                  'fail': st['fail'] if st else [],
+                  'pdrop': st['pdrop'] if st else 0,
+                  'err': self.remote.status}
+        return st
+
+
+# 'la' (last activity) relative to time shown in UI, as TrafficInspector returns it
+#
+def relative(dct, ui_time):
+    ret = dict(dct)
+    ret['la'] = dct['la'] - ui_time
+    return ret
@@ -0,0 +1,253 @@
+# -*- coding: utf8 -*-
+
+# This file is part of wireowl which is released under GNU GPLv2 license.
+#
+# Copyright 2021, 2022 Jiri Rozvaril <rozvara at vync dot org>
+
+import os
+import time
+import sqlite3
+import threading
+import ipaddress
+from sys import intern
+from wireowl_backend import TrafficInspector, MacAddrDevice, IPConnection, GraphTimeLine, \
+                            StaticReader, IP_INFO, E_CONN, E_DNS, E_VOL
+
+# seconds between flushes into database
+DB_INTERVAL = 10
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+CREATE TABLE IF NOT EXISTS devices (mac TEXT PRIMARY KEY, client INTEGER, ips TEXT,
+    hostnames TEXT, first REAL, last REAL, tx INTEGER, rx INTEGER, tp INTEGER, rp INTEGER,
+    dnsq INTEGER, dnsr INTEGER, packets INTEGER, protocols TEXT, alerts INTEGER);
+CREATE TABLE IF NOT EXISTS connections (mac TEXT, ip TEXT, name TEXT, country TEXT,
+    global INTEGER, private INTEGER, multicast INTEGER, reserved INTEGER, listed INTEGER,
+    first REAL, last REAL, tx INTEGER, rx INTEGER, tp INTEGER, rp INTEGER, protocols TEXT,
+    PRIMARY KEY (mac, ip));
+CREATE TABLE IF NOT EXISTS volumes (mac TEXT, ip TEXT, minute INTEGER, tx INTEGER, rx INTEGER,
+    PRIMARY KEY (mac, ip, minute)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS dns (mac TEXT, ip TEXT, domain TEXT, time REAL, ttl INTEGER,
+    PRIMARY KEY (mac, ip, domain)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS cnames (mac TEXT, domain TEXT, cname TEXT,
+    PRIMARY KEY (mac, domain, cname)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS mdns (mac TEXT, key TEXT, value TEXT,
+    PRIMARY KEY (mac, key, value)) WITHOUT ROWID;
+"""
+
+# tables with rows of devices, deleted when device's statistics are cleared
+DEVICE_TABLES = ('connections', 'volumes', 'dns', 'cnames', 'mdns')
+
+
+class DatabaseWriter():
+    """
+    Keeps aggregates of all devices in SQLite database (WAL mode): devices, connections,
+    volumes of connections per minute, DNS answers, CNAMEs and mDNS. What has changed since
+    the previous flush is taken device by device (each under inspector's lock only for copying
+    its data, as NDJSONExporter does) and written in one transaction by own thread, so
+    packet processing never waits for the disk. A device seen again replaces its stored
+    aggregates, volumes of past minutes are kept.
+    """
+    def __init__(self, pathname, inspector, reader, interval=DB_INTERVAL):
+
+        self.filename = pathname        # database file
+        self.worker = inspector         # TrafficInspector
+        self.reader = reader            # PacketReader (statuses stored as meta)
+        self.interval = interval        # seconds between flushes
+        self.states = {}                # {mac:state of device at previous flush}
+        self.since = None               # capture time of previous flush
+        self.flushes = 0                # flushes done
+        self.rows = 0                   # rows written in total
+        self.is_running = False
+        self.status = 0                 # 0-no errors, 1-could not open/write
+        self.db = None
+        try:
+            self.db = sqlite3.connect(pathname, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(SCHEMA)
+        except:
+            self.status = 1
+        self.thread = threading.Thread(
+                            target=self.periodic_writer,
+                            daemon=True,
+                            name='db_writer')
+
+    def periodic_writer(self):
+        while self.is_running:
+            # interruptable sleep
+            slept = 0
+            while slept < self.interval and self.is_running:
+                time.sleep(0.2)
+                slept += 0.2
+            if self.is_running:
+                self.flush()
+
+    def flush(self):
+        since = self.since
+        now = self.worker.last_pkt_time
+        states = {}  # kept only when flush succeeds
+        rows = {'devices': [], 'connections': [], 'volumes': [], 'dns': [], 'cnames': [],
+                'mdns': []}
+        cleared = []
+        for mac in self.worker.get_devices():
+            old = self.states.get(mac)
+            records, states[mac] = self.worker.get_device_export(mac, old, since, True)
+            if old and states[mac][0] < old[0]:
+                cleared.append((mac,))
+            for r in records:
+                self.add_rows(rows, r)
+        st = self.reader.get_statuses()
+        meta = [('snc', st['snc']), ('time', now), ('pkts', st['pkts']), ('flt', st['flt']),
+                ('flushed', time.time())]
+        try:
+            # one transaction per flush
+            with self.db:
+                for table in DEVICE_TABLES:
+                    self.db.executemany(f"DELETE FROM {table} WHERE mac=?", cleared)
+                # DNS answers, CNAMEs and mDNS are whole sets (answers are forgotten over capacity)
+                for table in ('dns', 'cnames', 'mdns'):
+                    macs = [(mac,) for mac in {row[0] for row in rows[table]}]
+                    self.db.executemany(f"DELETE FROM {table} WHERE mac=?", macs)
+                for table, values in rows.items():
+                    if values:
+                        marks = ','.join('?' * len(values[0]))
+                        self.db.executemany(f"INSERT OR REPLACE INTO {table} VALUES ({marks})",
+                                            values)
+                        self.rows += len(values)
+                self.db.executemany("INSERT OR REPLACE INTO meta VALUES (?,?)", meta)
+        except:
+            self.status = 1
+            return False
+        self.states.update(states)
+        self.since = now
+        self.flushes += 1
+        return True
+
+    def add_rows(self, rows, r):
+        # record of get_device_export() as rows of tables
+        mac = r['mac']
+        if r['type'] == 'device':
+            rows['devices'].append((mac, r['client'], ', '.join(r['ips']), ', '.join(r['hostnames']),
+                r['first'], r['last'], r['tx'], r['rx'], r['tp'], r['rp'], r['dnsq'], r['dnsr'],
+                r['packets'], ', '.join(r['protocols']), r['alerts']))
+        elif r['type'] == 'connection':
+            rows['connections'].append((mac, r['ip'], r['name'], r['country'], r['global'],
+                r['private'], r['multicast'], r['reserved'], r['listed'], r['first'], r['last'],
+                r['tx'], r['rx'], r['tp'], r['rp'], ', '.join(r['protocols'])))
+            rows['volumes'].extend((mac, r['ip'], m, tx, rx) for m, tx, rx in r.get('minutes', ()))
+        elif r['type'] == 'dns':
+            rows['dns'].extend((mac, r['ip'], a['domain'], a['time'], a['ttl']) for a in r['answers'])
+        elif r['type'] == 'cname':
+            rows['cnames'].extend((mac, r['domain'], cname) for cname in r['cnames'])
+        elif r['type'] == 'mdns':
+            rows['mdns'].extend((mac, r['key'], value) for value in r['values'])
+
+    def start(self):
+        if self.db:
+            self.is_running = True
+            self.thread.start()
+
+    def stop(self):
+        # final flush with what has changed since the last one
+        if self.is_running:
+            self.is_running = False
+            self.thread.join()
+        ret = self.db is not None and self.flush()
+        if self.db:
+            self.db.close()
+        return ret
+
+
+# TrafficInspector with devices and connections of database (as they were at its last
+# flush) and StaticReader, or (None, None) when database cannot be read;
+# per second graphs and rates are not stored, event history is rebuilt from stored rows
+#
+def load_database(pathname):
+    if not os.path.isfile(pathname):
+        return None, None
+    try:
+        db = sqlite3.connect(f"file:{pathname}?mode=ro", uri=True)
+        meta = dict(db.execute("SELECT key, value FROM meta"))
+        worker = TrafficInspector()
+        events = {}  # {mac:[(time, kind, IP address, domain or bytes)]} for event history
+
+        for (mac, client, ips, hostnames, first, last, tx, rx, tp, rp, dnsq, dnsr, packets,
+             protocols, alerts) in db.execute("SELECT * FROM devices"):
+            mac = intern(mac)
+            dev = worker.devices[mac] = MacAddrDevice(mac)
+            dev.my_ips = set(map(intern, split_list(ips)))
+            dev.my_ips_text = ips
+            dev.my_hostname = set(split_list(hostnames))
+            dev.first_pkt_time, dev.last_pkt_time = first, last
+            dev.tx_bytes, dev.rx_bytes, dev.tx_pkts, dev.rx_pkts = tx, rx, tp, rp
+            dev.dns_queries, dev.dns_replies = dnsq, dnsr
+            dev.packets_count = packets
+            dev.tx_protocols = set(map(intern, split_list(protocols)))
+            dev.alerts_raised = alerts
+            if client:
+                worker.clients.add(mac)
+            events[mac] = []
+
+        for (mac, ip, name, country, glob, priv, mult, rsrv, listed, first, last, tx, rx, tp, rp,
+             protocols) in db.execute("SELECT * FROM connections"):
+            dev = worker.devices.get(mac)
+            if dev is None:
+                continue
+            ip = intern(ip)
+            if ip not in IP_INFO:
+                # no geolocation of stored addresses
+                IP_INFO[ip] = (bool(glob), bool(priv), bool(mult), bool(rsrv),
+                               ipaddress.ip_address(ip).version, intern(country or ''))
+            conn = dev.connections[ip] = IPConnection(ip)
+            dev.longest_conn = max(dev.longest_conn, len(ip))
+            conn.first_touch, conn.last_touch = first, last
+            conn.tx_bytes, conn.rx_bytes, conn.tx_pkts, conn.rx_pkts = tx, rx, tp, rp
+            conn.tx_protocols = set(map(intern, split_list(protocols)))
+            conn.tx_sec_graph = GraphTimeLine(first, 1)
+            conn.tx_min_graph = GraphTimeLine(first, 60)
+            conn.rx_sec_graph = GraphTimeLine(first, 1)
+            conn.rx_min_graph = GraphTimeLine(first, 60)
+            if listed:
+                dev.listed_ips.add(ip)
+            events[mac].append((first, E_CONN, ip, 0))
+
+        for mac, ip, minute, tx, rx in db.execute("SELECT * FROM volumes ORDER BY minute"):
+            conn = worker.devices[mac].connections.get(ip) if mac in worker.devices else None
+            if conn is None:
+                continue
+            if tx:
+                conn.tx_min_graph.gr[minute] = tx
+            if rx:
+                conn.rx_min_graph.gr[minute] = rx
+            events[mac].append((max(minute, conn.first_touch), E_VOL, conn.my_ipaddress, tx + rx))
+
+        for mac, ip, domain, tm, ttl in db.execute("SELECT * FROM dns ORDER BY time"):
+            dev = worker.devices.get(mac)
+            if dev is not None:
+                dev.dns.add(domain, [ip], tm, ttl)
+                events[mac].append((tm, E_DNS, ip, domain))
+
+        for mac, domain, cname in db.execute("SELECT * FROM cnames"):
+            if mac in worker.devices:
+                worker.devices[mac].dns.add_cnames(domain, [cname], 0)
+
+        for mac, key, value in db.execute("SELECT * FROM mdns"):
+            if mac in worker.devices:
+                worker.devices[mac].mdns.setdefault(key, set()).add(intern(value))
+        db.close()
+    except:
+        return None, None
+
+    for mac, evs in events.items():
+        worker.devices[mac].history.replay(evs)
+
+    worker.sorted_devices = sorted(worker.devices.keys())
+    worker.sorted_clients = sorted(worker.clients)
+    worker.last_pkt_time = meta.get('time') or 0
+    worker.update_memory_estimates()
+    return worker, StaticReader({key: meta.get(key) for key in ('time', 'snc', 'pkts', 'flt')})
+
+
+def split_list(text):
+    return text.split(', ') if text else []
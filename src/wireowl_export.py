@@ -0,0 +1,88 @@
+# -*- coding: utf8 -*-
+
+# This file is part of wireowl which is released under GNU GPLv2 license.
+#
+# Copyright 2021, 2022 Jiri Rozvaril <rozvara at vync dot org>
+
+import json
+import time
+import threading
+
+
+class NDJSONExporter():
+    """
+    Exports data of all devices into a file as newline delimited JSON, one record per line
+    ('export' header, then 'device', 'connection', 'dns', 'cname', 'mdns' records).
+    The first export is full, next ones (every interval, and at stop) only what has changed
+    since the previous one; exports are appended to the same file.
+    Counters of all devices and connections are copied at once under inspector's lock,
+    so volumes and packets of the whole export are of one moment; names, DNS answers and
+    mDNS are then added device by device (each under the lock only for copying its data).
+    Records are serialized and written by own thread, so slow disk never blocks packet
+    processing.
+    """
+    def __init__(self, pathname, inspector, interval=0):
+
+        self.filename = pathname        # file exports are appended to
+        self.worker = inspector         # TrafficInspector
+        self.interval = interval        # seconds between exports (0: only at stop)
+        self.states = {}                # {mac:state of device at previous export}
+        self.since = None               # capture time of previous export
+        self.exports = 0                # exports done
+        self.records = 0                # records written in total
+        self.is_running = False
+        self.status = 0                 # 0-no errors, 1-could not write
+        self.thread = threading.Thread(
+                            target=self.periodic_exporter,
+                            daemon=True,
+                            name='ndjson_exporter')
+
+    def periodic_exporter(self):
+        while self.is_running:
+            # interruptable sleep
+            slept = 0
+            while slept < self.interval and self.is_running:
+                time.sleep(0.2)
+                slept += 0.2
+            if self.is_running:
+                self.export()
+
+    def export(self):
+        since = self.since
+        now, exports = self.worker.get_network_export(self.states, since)
+        states = {}  # kept only when export succeeds
+        try:
+            with open(self.filename, 'a') as f:
+                f.write(dumps({'type': 'export', 'mode': 'delta' if self.exports else 'full',
+                               'time': now, 'since': since, 'exported': time.time(),
+                               'devices': len(exports)}) + '\n')
+                for mac in sorted(exports):
+                    records, states[mac] = exports[mac]
+                    if records:
+                        f.write('\n'.join(dumps(r) for r in records) + '\n')
+                        self.records += len(records)
+        except:
+            self.status = 1
+            return False
+        self.states.update(states)
+        self.since = now
+        self.exports += 1
+        return True
+
+    def start(self):
+        if self.interval:
+            self.is_running = True
+            self.thread.start()
+
+    def stop(self):
+        # final export with what has changed since the last one
+        if self.is_running:
+            self.is_running = False
+            self.thread.join()
+        return self.export()
+
+
+# one record as one line
+#
+def dumps(record):
+    return json.dumps(record, separators=(',', ':'), ensure_ascii=False)
@@ -0,0 +1,171 @@
+# -*- coding: utf8 -*-
+
+# This file is part of wireowl which is released under GNU GPLv2 license.
+#
+# Copyright 2021, 2022 Jiri Rozvaril <rozvara at vync dot org>
+
+import os
+import time
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler
+
+
+class MetricsServer():
+    """
+    Serves per-device counters and reader statistics in Prometheus text exposition format
+    on local HTTP port ('9100', '127.0.0.1:9100') or Unix socket (path name).
+    Text is rendered periodically into a cache, scrapes never touch the inspector.
+    """
+    def __init__(self, address, inspector, reader, interval=5, connections=False):
+
+        self.worker = inspector         # TrafficInspector
+        self.reader = reader            # PacketReader
+        self.interval = interval        # seconds between snapshots
+        self.connections = connections  # export also per-connection counters
+        self.address = address
+        self.cached = b''               # last rendered snapshot
+        self.is_running = False
+        self.server = None
+        self.status = 0                 # 0-no errors, 1-could not listen
+
+        server = self                   # for request handler
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = server.cached
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # screen belongs to curses
+
+        try:
+            if '/' in address:
+                if os.path.exists(address):
+                    os.remove(address)
+                self.server = ThreadingUnixHTTPServer(address, Handler)
+            else:
+                host, _, port = address.rpartition(':')
+                self.server = ThreadingTCPHTTPServer((host or '127.0.0.1', int(port)), Handler)
+        except:
+            self.status = 1
+
+        self.render_thread = threading.Thread(
+                                target=self.snapshot_renderer,
+                                daemon=True,
+                                name='metrics_renderer')
+        self.server_thread = threading.Thread(
+                                target=self.server.serve_forever if self.server else None,
+                                daemon=True,
+                                name='metrics_server')
+
+    def snapshot_renderer(self):
+        while self.is_running:
+            self.cached = self.render().encode('utf-8')
+            # interruptable sleep
+            slept = 0
+            while slept < self.interval and self.is_running:
+                time.sleep(0.2)
+                slept += 0.2
+
+    def render(self):
+        devices = self.worker.get_metrics_snapshot()
+        status = self.reader.get_statuses()
+        out = []
+
+        def metric(name, mtype, help_text, samples):
+            out.append(f"# HELP wireowl_{name} {help_text}")
+            out.append(f"# TYPE wireowl_{name} {mtype}")
+            for labels, value in samples:
+                out.append(f"wireowl_{name}{labels} {value}")
+
+        # per-device counters: (mac, client, tx, rx, tp, rp, dnsq, dnsr, conns)
+        labels = [f'{{mac="{escape(d[0])}",client="{1 if d[1] else 0}"}}' for d in devices]
+        for name, idx, mtype, help_text in (
+                ('device_tx_bytes_total',     2, 'counter', "Bytes sent by the device."),
+                ('device_rx_bytes_total',     3, 'counter', "Bytes received by the device."),
+                ('device_tx_packets_total',   4, 'counter', "Packets sent by the device."),
+                ('device_rx_packets_total',   5, 'counter', "Packets received by the device."),
+                ('device_dns_queries_total',  6, 'counter', "DNS queries sent by the device."),
+                ('device_dns_replies_total',  7, 'counter', "DNS replies received by the device.")):
+            metric(name, mtype, help_text, [(labels[i], d[idx]) for i, d in enumerate(devices)])
+        metric('device_connections', 'gauge', "IP addresses the device communicates with.",
+            [(labels[i], len(d[8])) for i, d in enumerate(devices)])
+
+        # per-connection counters: (ip, tx, rx, tp, rp)
+        if self.connections:
+            conns = []
+            for d in devices:
+                for c in d[8]:
+                    conns.append((f'{{mac="{escape(d[0])}",ip="{escape(c[0])}"}}', c))
+            for name, idx, help_text in (
+                    ('connection_tx_bytes_total',   1, "Bytes sent by the device to IP address."),
+                    ('connection_rx_bytes_total',   2, "Bytes received by the device from IP address."),
+                    ('connection_tx_packets_total', 3, "Packets sent by the device to IP address."),
+                    ('connection_rx_packets_total', 4, "Packets received by the device from IP address.")):
+                metric(name, 'counter', help_text, [(lbl, c[idx]) for lbl, c in conns])
+
+        # totals and packet reader statistics
+        metric('devices', 'gauge', "Devices seen in network traffic.", [('', len(devices))])
+        metric('clients', 'gauge', "Clients (using DNS/DHCP) seen in network traffic.",
+            [('', sum(1 for d in devices if d[1]))])
+        metric('reader_packets_total', 'counter', "Packets processed.", [('', status['pkts'])])
+        metric('reader_dropped_total', 'counter', "Malformed rows dropped.", [('', status['drop'])])
+        metric('reader_preserve_dropped_total', 'counter', "Rows not written to preserved file.",
+            [('', status['pdrop'])])
+        metric('reader_queue_length', 'gauge', "Rows waiting in the queue.", [('', status['ql'])])
+        metric('reader_queue_bytes', 'gauge', "Approximate bytes of rows waiting in the queue.",
+            [('', status['qb'])])
+        memory = self.worker.get_memory_usage()
+        metric('memory_bytes', 'gauge', "Approximate bytes of data structures (estimates).",
+            [(f'{{structure="{key}"}}', value) for key, value in memory.items() if key != 'devices'])
+        metric('reader_packets_per_second', 'gauge', "Processing speed.",
+            [('', max(status['perf'], 0))])
+        metric('reader_compressed_bytes_per_second', 'gauge', "Read speed of compressed input.",
+            [('', status['crate'])])
+        metric('reader_live', 'gauge', "1 if packet reader is running.",
+            [('', 1 if status['live'] else 0)])
+        metric('reader_errors', 'gauge', "Packet reader error code (0 means no error).",
+            [('', status['err'])])
+        metric('reader_sources_failed', 'gauge', "Interfaces tshark could not capture on.",
+            [('', len(status['fail']))])
+        metric('capture_time_seconds', 'gauge', "Time of the last processed packet.",
+            [('', status['time'])])
+        return '\n'.join(out) + '\n'
+
+    def start(self):
+        if not self.status:
+            self.is_running = True
+            self.cached = self.render().encode('utf-8')
+            self.render_thread.start()
+            self.server_thread.start()
+
+    def stop(self):
+        self.is_running = False
+        if self.server and not self.status:
+            self.server.shutdown()
+            self.server.server_close()
+            if '/' in self.address:
+                try:
+                    os.remove(self.address)
+                except:
+                    pass
+
+
+class ThreadingTCPHTTPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+# label value escaping as required by text exposition format
+#
+def escape(txt):
+    return txt.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -12,14 +12,24 @@
 
 import curses
 import time
+from time import perf_counter
 from datetime import date
-from wireowl_common import rel_time, fmt_time
+from wireowl_common import rel_time, fmt_time, fmt_duration, PROFILER
 
 VERSION="0.4.4"
 
 # UI CONST
 HIGHLIGHTTIME = -5  # seconds to highlight active communication (negative value, as to the past)
 
+# adaptive refresh (ms): while visible data change REFRESH_SPEEDUP times faster than refresh
+# set by user (but not faster than REFRESH_FAST), slowest when idle or packets queue up,
+# max. share of time spent by building and drawing screen
+REFRESH_SPEEDUP = 4
+REFRESH_FAST = 100
+REFRESH_SLOW = 5000
+UI_DUTY = 0.2
+QUEUE_HIGH = 1000   # queue length considered as falling behind
+
 # colors
 _, NORMAL, TOPBAR, TABHIGH, TABDIM, GLOBALDOMAIN, LOCALNETWORK, \
 ACTIVEIP, ACTIVEDEVICE, ACTIVERX, ACTIVETX, \
@@ -27,21 +37,29 @@ CONNECTOR, ALERTDOMAIN, CLIENTMARK, MENUKEY, MENUTITLE = range(16)
 
 # some layout constants
 RP, GR = range(2)
+SCROLL_KEYS = (curses.KEY_UP, curses.KEY_DOWN, curses.KEY_HOME, curses.KEY_END, 338, 339)
+H_BUILD = PROFILER.histogram('build')  # making content
+H_DRAW = PROFILER.histogram('draw')    # drawing content (without terminal output)
 curses_MOUSE_WHEEL_DOWN = 2097152
 curses_MOUSE_WHEEL_UP = curses.BUTTON4_PRESSED
 MOUSEMASK = curses.BUTTON1_CLICKED \
             + curses_MOUSE_WHEEL_DOWN \
             + curses_MOUSE_WHEEL_UP
 
-# key_label, mouse_click_key, switch_type, label_false, label_true
+# key_label, mouse_click_key, switch_type, label_false, label_true (labels of sort
+# switch are in order of SORT_ORDERS, showing what pressing the key switches to)
 MENU = [['F1',  curses.KEY_F1,  None, 'Help'],
         ['F3',  curses.KEY_F3,  'h',  'Hi Off',  'Hi On '],
         ['F4',  curses.KEY_F4,  'd',  'Clients', 'Devices'],
         ['F5',  curses.KEY_F5,  'l',  'List  ',  'Detail'],
-        ['F6',  curses.KEY_F6,  's',  'Chrono',  'Active'],
+        ['F6',  curses.KEY_F6,  's',  'Chrono',  'Rate  ', 'Memory', 'Active'],
+        ['F7',  curses.KEY_F7,  't',  'Top ',    'Back'],
         ['F8',  curses.KEY_F8,  None, 'Clear'],
         ['F10', curses.KEY_F10, None, 'Quit']]
 
+# sort orders of devices and connections (F6 switches to the next one)
+SORT_ORDERS = ('active', 'chrono', 'rate', 'memory')
+
 
 # app state singleton
 #
@@ -54,12 +72,19 @@ class UI():
         self.all_devices = True     # show all devices(T) or filter to clients only(F)
         self.detail = True          # detail(T) or list of devices(F)
         self.show_more = None       # type of additional details shown (or None)
-        self.active_first = True    # sort by activity(T) or chronologically(F)
+        self.overview = None        # network-wide view instead of list/detail: 'top', 'alerts' (or None)
+        self.sort_by = 'active'     # sort by last activity, first appearance, current rate or memory
         self.show_local = True      # show/hide local network devices
         self.show_tx_graph = True   # show/hide graph of traffic sent
         self.show_rx_graph = False  # show/hide graph of traffic received
         self.show_ip_stat = True    # show/hide IP statistics in list
         self.show_cnames = False    # show/hide CNAME records for domains
+        self.recent_names = True    # names valid at last activity(T) or all answered names(F)
+        self.search = ''            # connections are filtered by this text (if any)
+        self.search_input = False   # search text is being typed
+        self.history = '15m'        # time range of history: last '15m', '2h'... or '10:00-10:15'
+        self.range_input = False    # time range of history is being typed
+        self.range_text = ''        # typed time range (applied by Enter)
         self.sec_graph = True       # show graph in seconds(T) or minutes(F)
         self.abs_time = True        # absolute(T) or relative time(F)
         self.dark_theme = True      # dark(T) or light theme(F)
@@ -73,7 +98,13 @@ class UI():
         self.reserved_top = 0       # rows above content
         self.neth = 0               # net rows for content
         self.scroll = 0             # position of scrolling up/down
-        self.refresh = 10           # screen refresh in 1/10s
+        self.refresh = 10           # screen refresh in 1/10s (when data are not changing fast)
+        self.delay = 1000           # current adaptive refresh (ms)
+        self.stamp = None           # what visible data depend on, at last refresh
+        self.view_stamp = None      # volume/count of data shown by current view (set by make_*)
+        self.queue = 0              # packet reader's queue length at last refresh
+        self.frame_time = 0         # time of building and drawing last screen (sec)
+        self.draw_methods = ()      # methods which have drawn last screen
         self.key = curses.ERR       # last key pressed
         self.running = True         # quit app when false
         self.debug = ''             # development helper
@@ -85,6 +116,7 @@ class UI():
         self.selected = None        # selected device
         self.device = None          # details/stats of selected device
         self.conns = None           # connections of selected device
+        self.graphs = {}            # graph rows drawn in the last frame {key:(time_pos, bar_len, parts)}
 
         self.timezone_correction = time.timezone - 3600*time.localtime().tm_isdst
 
@@ -173,10 +205,13 @@ def main_app_loop(stdscr):
     ui.scr = stdscr
     curses.noecho()
     curses.cbreak()
-    curses.halfdelay(ui.refresh)
     curses.curs_set(0)
     curses.mousemask(MOUSEMASK)  # curses.ALL_MOUSE_EVENTS for no mask
     ui.scr.keypad(True)
+    try:
+        curses.set_escdelay(25)  # Esc cancels search without a delay (python 3.9+)
+    except:
+        pass
     set_curses_colors()
     ui.scr.clear()
     ui.scr.refresh()
@@ -184,6 +219,7 @@ def main_app_loop(stdscr):
     while ui.running:
         refresh_data_and_screen()
         if ui.running:  # quit immediately both from keyboard and mouse
+            ui.scr.timeout(ui.delay)  # key press ends waiting immediately
             try:
                 ui.key = ui.scr.getch()
             except:
@@ -212,13 +248,36 @@ def refresh_data_and_screen():
 
     ui.debug += f" k={ui.key} "
 
-    handle_key_press()
+    if ui.search_input:
+        handle_search_input()
+    elif ui.range_input:
+        handle_range_input()
+    else:
+        handle_key_press()
 
     if not ui.running:  # quit
         return
     if not screen_check():  # resize
         return
 
+    # scrolling only moves over content already made
+    if ui.key in SCROLL_KEYS and ui.content and ui.draw_methods:
+        for m in ui.draw_methods:
+            m()
+        ui.scr.move(ui.h-1, ui.w-1)
+        return
+
+    tmf = perf_counter()
+
+    # attached to wireowl daemon: get at once what has changed for the current view
+    if getattr(backend, 'is_remote', False):
+        kinds = []
+        if ui.detail and not ui.show_more:
+            unit = 'sec' if ui.sec_graph else 'min'
+            kinds += [f'tx_{unit}'] if ui.show_tx_graph else []
+            kinds += [f'rx_{unit}'] if ui.show_rx_graph else []
+        backend.sync(ui.selected, not ui.detail, kinds, ui.w)
+
     ui.devices = backend.get_devices()
     ui.clients = backend.get_clients()
     ui.statuses = reader.get_statuses()
@@ -231,32 +290,91 @@ def refresh_data_and_screen():
     ui.content = []  # rows with content
     draw_methods = (draw_content, draw_menu_status_bar)
 
-    #tms = time.time()
+    tms = perf_counter()
+    ui.view_stamp = None
     if not ui.selected:  # no data yet
         make_no_content()
+    elif ui.overview == 'top':  # (device, IP address) pairs of the whole network
+        make_top_content()
+        draw_methods += (draw_top_top_bar, draw_top_title)
+    elif ui.overview == 'alerts':  # alerts raised by all devices
+        make_alerts_content()
+        draw_methods += (draw_alerts_top_bar, draw_alerts_title)
     elif ui.detail:  # detail of device
         make_detail_content()
         draw_methods += (draw_detail_top_bar, draw_detail_title)
     else:  # list of devices/clients
         make_list_content()
         draw_methods += (draw_list_top_bar, draw_list_title)
-    #ui.debug += f" make={round((time.time()-tms)*1000,3)}ms "
+    H_BUILD.add(perf_counter() - tms)
 
     #ui.debug += f" h={ui.neth} rows={ui.rows()} scr-bef={ui.scroll} "
-    #tms = time.time()
+    tms = perf_counter()
     for m in draw_methods:
         m()
-    #ui.debug += f" draw={round((time.time()-tms)*1000,3)}ms "
+    H_DRAW.add(perf_counter() - tms)
+    ui.draw_methods = draw_methods
+    ui.frame_time = perf_counter() - tmf
+    adapt_refresh()
     #ui.debug += f" scr-aft={ui.scroll} "
-    ui.debug += f" queue={ui.statuses['ql']} "
+    ui.debug += f" queue={ui.statuses['ql']} refresh={ui.delay}ms "
+    if ui.show_debug:
+        ui.debug += memory_debug()
 
     # developer's helper
     if ui.show_debug and ui.debug:
-        ui.scr.addnstr(ui.h-3, 3, ui.debug, ui.w-6, curses.color_pair(MENUTITLE))
+        draw_debug_overlay()
 
     ui.scr.move(ui.h-1, ui.w-1)  # some terminals have cursor always on
 
 
+# time until next refresh: fast while data of current view change, slowing down when idle,
+# slow when packet processing falls behind; UI never takes more than UI_DUTY of time
+#
+def adapt_refresh():
+    global ui
+
+    base = ui.refresh*100
+    stamp = (ui.overview, ui.detail, ui.show_more, ui.selected, ui.view_stamp)
+    if ui.statuses['ql'] > QUEUE_HIGH and ui.statuses['ql'] >= ui.queue:
+        ui.delay = REFRESH_SLOW
+    elif stamp != ui.stamp:
+        ui.delay = max(base // REFRESH_SPEEDUP, REFRESH_FAST)
+    else:
+        ui.delay = min(max(ui.delay*2, base), REFRESH_SLOW)
+    ui.delay = max(ui.delay, int(ui.frame_time*1000*(1-UI_DUTY)/UI_DUTY))
+    ui.stamp = stamp
+    ui.queue = ui.statuses['ql']
+
+
+# debug line and latency histograms over the content
+#
+def draw_debug_overlay():
+    global ui
+
+    rows = PROFILER.report()
+    y = ui.h-3-len(rows)
+    if y > 0:
+        for txt in rows:
+            ui.scr.addnstr(y, 3, ljust(txt, ui.w-6), ui.w-6, curses.color_pair(MENUTITLE))
+            y += 1
+    ui.scr.addnstr(ui.h-3, 3, ui.debug, ui.w-6, curses.color_pair(MENUTITLE))
+
+
+# approximate memory of data structures (all devices) and of reader's queue
+#
+def memory_debug():
+    global backend
+
+    mem = backend.get_memory_usage()
+    txt = " mem:"
+    for key, value in mem.items():
+        if key != 'devices':
+            txt += f" {key}={fmt_volume(value).strip()}"
+    txt += f" queue={fmt_volume(ui.statuses['qb']).strip()} "
+    return txt
+
+
 # draw content prepared in ui.content
 #
 def draw_content():
@@ -267,13 +385,15 @@ def draw_content():
     # draw content row by row, part by part; getch() in main loop refreshes screen
     firstrow = min(ui.scroll, len(ui.content))
     lastrow = min(ui.scroll+ui.neth, len(ui.content))
+    # only graphs of visible rows are kept for the next frame
+    cached, ui.graphs = ui.graphs, {}
     for y, row in enumerate(ui.content[firstrow:lastrow]):
         if row[0] == RP:
             # row parts
             draw_row_parts(ui.reserved_top+y, row[1:])
         elif row[0] == GR:
             # graph
-            draw_graph(ui.reserved_top+y, row[1], row[2], row[3], row[4], row[5])
+            draw_graph(ui.reserved_top+y, row[1], row[2], row[3], row[4], row[5], row[6], cached)
     # clear rest of the screen
     if lastrow-firstrow < ui.neth:
         row = [['', NORMAL]]
@@ -287,28 +407,40 @@ def draw_row_parts(y, row):
     # row = [part, part, part, ...]
     # part = [text, opt-colorpair, opt-attron]
     # if no color or attr, then uses previous one until another is given
+    # (attributes are passed with text, one curses call per part)
     global ui
     x = 0
     lastchar = 1 if y == ui.h-1 else 0
+    attr = curses.color_pair(NORMAL)
     for part in row:
         if len(part) > 1:
-            ui.scr.attrset(curses.color_pair(part[1]))
+            attr = curses.color_pair(part[1])
         if len(part) > 2:
-            ui.scr.attron(part[2])
-        ui.scr.addnstr(y, x, part[0], ui.w-x-lastchar)
+            attr |= part[2]
+        if x < ui.w-lastchar:
+            ui.scr.addnstr(y, x, part[0], ui.w-x-lastchar, attr)
         x += len(part[0])
-    # clear the rest of row with the last attrset+attron
-    if x < ui.w:
-        ui.scr.addstr(y, x, ' '*(ui.w-x-lastchar))
+    # clear the rest of row with the last attributes
+    if x < ui.w-lastchar:
+        ui.scr.addstr(y, x, ' '*(ui.w-x-lastchar), attr)
     if lastchar:
-        ui.scr.insch(ui.h-1,ui.w-1,' ')
+        ui.scr.insch(ui.h-1, ui.w-1, ' ', attr)
 
 
-# get data and draw graph
+# get data and draw graph; graph row is rendered into runs of the same attributes
+# and reused while connection's volume (stamp) and time of the last bar are the same
 #
-def draw_graph(y, get_graph_method, macaddr, ip, tm, color):
+def draw_graph(y, get_graph_method, macaddr, ip, tm, color, stamp, cached):
     global ui
 
+    connector = '├ ' if ui.show_ip_stat else \
+        ('└ ' if color == ACTIVERX or (color == ACTIVETX and not ui.show_rx_graph) else '├ ')
+    key = (get_graph_method, macaddr, ip, color, stamp, connector, ui.w)
+    if key in cached and cached[key][0] == int(tm/cached[key][1])*cached[key][1]:
+        ui.graphs[key] = cached[key]
+        draw_row_parts(y, cached[key][2])
+        return
+
     dct = get_graph_method(macaddr, ip, tm)
 
     first_time = dct.pop('f')
@@ -318,21 +450,31 @@ def draw_graph(y, get_graph_method, macaddr, ip, tm, color):
 
     # empty line of correct length as there are no zero values in data
     bars = int((time_pos - start_time)/bar_len)+1  # time diff / bar_len
-    draw_row_parts(y, [[rjust(GRAPH[0]*bars, ui.w), NORMAL, curses.A_DIM]])
+    chars = list(rjust(GRAPH[0]*bars, ui.w))
+    bold = [False]*ui.w
 
     if dct:
-        ui.scr.attrset(curses.color_pair(color))
-        ui.scr.attron(curses.A_BOLD)
         max_val = max(dct.values())  # max value = 100 % in graph (last char of GRAPH)
         for tm in dct.keys():
             x = ui.w - int((time_pos-tm)/bar_len) - 1  # position according to time
             if 1 < x < ui.w:
                 symbol = int(dct[tm]/max_val*(len(GRAPH)-2))  # % value -> corresponding symbol
-                ui.scr.addstr(y, x, GRAPH[symbol+1])
+                chars[x] = GRAPH[symbol+1]
+                bold[x] = True
+
+    # runs of baseline (dim) and bars (bold)
+    parts = [[connector, CONNECTOR]]
+    start = 2
+    for x in range(3, ui.w+1):
+        if x == ui.w or bold[x] != bold[start]:
+            if bold[start]:
+                parts.append([''.join(chars[start:x]), color, curses.A_BOLD])
+            else:
+                parts.append([''.join(chars[start:x]), NORMAL, curses.A_DIM])
+            start = x
 
-    ui.scr.attrset(curses.color_pair(CONNECTOR))
-    ui.scr.addstr(y, 0, '├ ' if ui.show_ip_stat else \
-        ('└ ' if color == ACTIVERX or (color == ACTIVETX and not ui.show_rx_graph) else '├ '))
+    ui.graphs[key] = (time_pos, bar_len, parts)
+    draw_row_parts(y, parts)
 
 
 # terminal emulators may change screen size
@@ -378,7 +520,7 @@ def handle_key_press():
         # no key
         return
 
-    if ui.detail and ui.selected:
+    if ui.detail and ui.selected and not ui.overview:
         # keys in detail view and only when not empty
         if ui.key == curses.KEY_LEFT or ui.key == 353: # Shift-Tab
             if ui.selected in ui.devmenu:
@@ -415,6 +557,9 @@ def handle_key_press():
         elif ui.key == ord('l'):
             ui.show_local = not ui.show_local
 
+        elif ui.key == ord('n'):
+            ui.recent_names = not ui.recent_names
+
         # elif ui.key == ord('c'):
         #     ui.show_cnames = not ui.show_cnames
 
@@ -426,6 +571,29 @@ def handle_key_press():
             ui.show_more = None if ui.show_more == 'bdns' else 'bdns' # blocked dns
             ui.scroll = 0
 
+        elif ui.key == ord('f'):
+            ui.show_more = None if ui.show_more == 'flows' else 'flows' # tcp/udp flows
+            ui.scroll = 0
+
+        elif ui.key == ord('e'):
+            ui.show_more = 'history' # event history
+            ui.range_input = True
+            ui.range_text = ''
+            ui.scroll = 0
+
+        elif ui.key == 27 and ui.show_more == 'history' and not ui.search:  # Esc
+            ui.show_more = None
+            ui.scroll = 0
+
+        elif ui.key == ord('/'):
+            ui.show_more = None
+            ui.search_input = True
+            ui.scroll = 0
+
+        elif ui.key == 27 and ui.search:  # Esc
+            ui.search = ''
+            ui.scroll = 0
+
     # global keys
     if ui.key == curses.KEY_UP:
         ui.scroll = max(0, ui.scroll-1)
@@ -452,11 +620,22 @@ def handle_key_press():
         ui.all_devices = not ui.all_devices
 
     elif ui.key == curses.KEY_F5:
-        ui.detail = not ui.detail
+        if ui.overview:
+            ui.overview = None
+        else:
+            ui.detail = not ui.detail
         ui.scroll = 0
 
     elif ui.key == curses.KEY_F6:
-        ui.active_first = not ui.active_first
+        ui.sort_by = SORT_ORDERS[(SORT_ORDERS.index(ui.sort_by)+1) % len(SORT_ORDERS)]
+        ui.scroll = 0
+
+    elif ui.key == curses.KEY_F7:
+        ui.overview = None if ui.overview == 'top' else 'top'
+        ui.scroll = 0
+
+    elif ui.key == ord('a'):
+        ui.overview = None if ui.overview == 'alerts' else 'alerts'
         ui.scroll = 0
 
     elif ui.key == ord('t'):
@@ -468,11 +647,9 @@ def handle_key_press():
 
     elif ui.key == ord('+'):
         ui.refresh = min(ui.refresh+5, 50)
-        curses.halfdelay(ui.refresh)
 
     elif ui.key == ord('-'):
         ui.refresh = max(ui.refresh-5, 5)
-        curses.halfdelay(ui.refresh)
 
     elif ui.key == ord('p'):
         ui.debug += " paused "
@@ -513,6 +690,71 @@ def wait_for_any_key():
             answer = 42  # The Answer not only to curses Ctrl-C
 
 
+# typing of search text; connections are filtered while typing
+#
+def handle_search_input():
+    global ui
+
+    if ui.key in (10, 13, curses.KEY_ENTER):  # keep filter
+        ui.search_input = False
+    elif ui.key == 27:  # Esc
+        ui.search_input = False
+        ui.search = ''
+    elif ui.key in (curses.KEY_BACKSPACE, 127, 8):
+        ui.search = ui.search[:-1]
+    elif 32 <= ui.key < 127:
+        ui.search += chr(ui.key)
+    if ui.key != curses.ERR:
+        ui.scroll = 0
+
+
+# typing time range of history
+#
+def handle_range_input():
+    global ui
+
+    if ui.key in (10, 13, curses.KEY_ENTER):
+        ui.range_input = False
+        if ui.range_text:
+            ui.history = ui.range_text
+    elif ui.key == 27:  # Esc
+        ui.range_input = False
+    elif ui.key in (curses.KEY_BACKSPACE, 127, 8):
+        ui.range_text = ui.range_text[:-1]
+    elif 32 <= ui.key < 127:
+        ui.range_text += chr(ui.key)
+    if ui.key != curses.ERR:
+        ui.scroll = 0
+
+
+# time range (start, end) of history as typed: last '30s', '15m', '2h', '1d' of capture,
+# or 'HH:MM[:SS]-HH:MM[:SS]' on the day of the last packet (None if not valid)
+#
+def history_range(txt, now):
+    txt = txt.strip()
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    try:
+        if txt and txt[-1] in units and '-' not in txt:
+            return (now - float(txt[:-1])*units[txt[-1]], now)
+        day = now - ui.timezone_correction
+        day -= day % 86400
+        times = []
+        for part in txt.split('-'):
+            hms = [int(x) for x in part.strip().split(':')]
+            if not 2 <= len(hms) <= 3:
+                return None
+            times.append(day + hms[0]*3600 + hms[1]*60 + (hms[2] if len(hms) == 3 else 0) \
+                         + ui.timezone_correction)
+        start, end = times
+        if end < start:
+            start -= 86400  # over midnight
+        elif start > now:
+            start, end = start-86400, end-86400  # on previous day
+        return (start, end)
+    except:
+        return None
+
+
 # mouse actions
 #
 def handle_mouse(mx, my, me):
@@ -535,6 +777,7 @@ def handle_mouse(mx, my, me):
             if clicked_on in ui.devmenu:
                 ui.selected = clicked_on
                 ui.detail = True
+                ui.overview = None
 
     elif me == curses_MOUSE_WHEEL_UP:
         wheelstep = min(10, ui.neth)
@@ -589,7 +832,8 @@ def devices_or_clients():
 
 def stats_labels():
     txt = ''
-    for label in ("Active", "Sent", "Received", "Queries", "Domains", "Servers", "Packets"):
+    for label in ("Active", "Sent", "Received", "Rate/s", "Queries", "Domains", "Servers", "Packets",
+                  "Memory"):
         txt += rjust(label,9)
     txt += '  ' + "IP addresses"
     return txt
@@ -619,11 +863,55 @@ def draw_list_title():
     global ui
 
     txt = '  ' if ui.all_devices else ''  # 'C' mark for clients
+    txt += '  '                           # '!' mark for alerts
     txt += ljust("MAC address",17)
     txt += stats_labels()
     draw_row_parts(1, [[txt, TABDIM]])
 
 
+# top bar for top talkers
+#
+def draw_top_top_bar():
+    global ui
+
+    part1 = "Top talkers"
+    part2 = " (connections of all devices with most traffic recently)"
+    spacer = ' '*((ui.w-len(part1)-len(part2))//2)  # center row
+    draw_row_parts(0, [[spacer, TABDIM], [part1, TABHIGH, curses.A_BOLD], [part2, TABDIM]])
+
+
+# column titles above top talkers
+#
+def draw_top_title():
+    global ui
+
+    txt = ljust("MAC address",17)
+    for label in ("Recent", "Sent", "Received", "Active"):
+        txt += rjust(label,9)
+    txt += '  ' + "IP address, name"
+    draw_row_parts(1, [[txt, TABDIM]])
+
+
+# top bar for alerts
+#
+def draw_alerts_top_bar():
+    global ui
+
+    part1 = "Alerts"
+    part2 = " (raised by rules while packets are processed, newest first)"
+    spacer = ' '*((ui.w-len(part1)-len(part2))//2)  # center row
+    draw_row_parts(0, [[spacer, TABDIM], [part1, TABHIGH, curses.A_BOLD], [part2, TABDIM]])
+
+
+# column titles above alerts
+#
+def draw_alerts_title():
+    global ui
+
+    txt = rjust("Time",9) + '  ' + ljust("MAC address",17) + ' ' + ljust("Rule",8) + "Alert"
+    draw_row_parts(1, [[txt, TABDIM]])
+
+
 # top menu (tabs with devices) for detail
 #
 def draw_detail_top_bar():
@@ -668,6 +956,9 @@ def draw_detail_title():
     txt = "IP: " + (ui.device['ip'] if ui.device['ip'] else "--")
     if ui.device['hn']:
         txt += "  Hostname: " + ui.device['hn']
+    # sent+received bytes/sec averaged over 10s, 1m, 5m
+    rates = [fmt_volume(tx+rx).strip() for tx, rx in zip(ui.device['txr'], ui.device['rxr'])]
+    txt += "  Rate: " + ' / '.join(rates) + " B/s"
 
     draw_row_parts(1, [[center(txt, ui.w), TABHIGH, curses.A_BOLD]])
 
@@ -704,6 +995,9 @@ def draw_detail_title():
     row.append(spacer)
     row.append([fmt_volume(ui.device['pkts'], base=1000)])
     row.append([" total pkts"])
+    row.append(spacer)
+    row.append([fmt_volume(ui.device['mem'])])
+    row.append([" Memory"])
     draw_row_parts(3, row)
 
     # protocols/ports the device communicate to
@@ -715,7 +1009,7 @@ def draw_detail_title():
         if ui.show_ip_stat:
             txt = '  ' \
                 + rjust("IP address", ui.device['colw'] if ui.conns else 10) \
-                + " Loc  Active     Sent Received  Protocols"
+                + " Loc  Active     Sent Received   Rate/s  Protocols"
         # column label for graph
         if ui.show_rx_graph or ui.show_tx_graph:
             txt += rjust( f"Last {ui.w-2} " + ("sec" if ui.sec_graph else "min"), ui.w-len(txt))
@@ -749,8 +1043,10 @@ def draw_menu_status_bar():
             txt = mi[4]
         elif mi[2] == 'l' and not ui.detail:
             txt = mi[4]
-        elif mi[2] == 's' and not ui.active_first:
+        elif mi[2] == 't' and ui.overview == 'top':
             txt = mi[4]
+        elif mi[2] == 's':
+            txt = mi[3+SORT_ORDERS.index(ui.sort_by)]
         row.append([txt, MENUTITLE])
         x += len(txt)
 
@@ -775,6 +1071,43 @@ def draw_menu_status_bar():
         if x+len(txt)+len(part)+3 < ui.w-1:
             txt = part + ' | ' + txt
 
+    if ui.statuses['crate']:
+        part = f"{fmt_volume(ui.statuses['crate']).strip()}B/s read"
+        if x+len(txt)+len(part)+3 < ui.w-1:
+            txt = part + ' | ' + txt
+
+    if ui.statuses['rst']:
+        part = f"tshark restarted {ui.statuses['rst']}x"
+        if x+len(txt)+len(part)+3 < ui.w-1:
+            txt = part + ' | ' + txt
+
+    if ui.statuses['fail'] and not ui.statuses['err']:
+        part = "tshark failed on " + ', '.join(ui.statuses['fail'])
+        if x+len(txt)+len(part)+3 < ui.w-1:
+            txt = part + ' | ' + txt
+
+    if ui.statuses['pdrop']:
+        part = f"not preserved {ui.statuses['pdrop']}"
+        if x+len(txt)+len(part)+3 < ui.w-1:
+            txt = part + ' | ' + txt
+
+    if ui.range_input:
+        part = f"Range: {ui.range_text}_ (now {ui.history})"
+        if x+len(txt)+len(part)+3 < ui.w-1:
+            txt = part + ' | ' + txt
+
+    if ui.search or ui.search_input:
+        part = f"Search: {ui.search}" + ('_' if ui.search_input else '')
+        if x+len(txt)+len(part)+3 < ui.w-1:
+            txt = part + ' | ' + txt
+
+    if ui.statuses['flt']:
+        part = "Filter: " + ui.statuses['flt']
+        if len(part) > 40:
+            part = part[:37] + '...'
+        if x+len(txt)+len(part)+3 < ui.w-1:
+            txt = part + ' | ' + txt
+
     row.append([rjust(txt, ui.w-1-x), MENUTITLE])
     draw_row_parts(ui.h-1, row)
 
@@ -802,7 +1135,9 @@ def make_no_content():
     if ui.statuses['live']:
         ui.content.append([RP, [center(f"Packet reader is live.", ui.w)]])
     else:
-        if ui.statuses['err']:
+        if ui.statuses['err'] == 4:
+            ui.content.append([RP, [center(f"tshark could not capture, check interface and permissions.", ui.w)]])
+        elif ui.statuses['err']:
             ui.content.append([RP, [center(f"Packet reader has finished with errors.", ui.w)]])
         else:
             ui.content.append([RP, [center(f"Packet reader has finished.", ui.w)]])
@@ -819,13 +1154,20 @@ def make_list_content():
 
     ui.set_layout(2, 1)
     lst = []
-    sortkey = 'la' if ui.active_first else 'fa'
-    for macaddr in ui.devmenu:
-        devstat = backend.get_device_statistics(macaddr, ui.statuses['time'])
-        lst.append([devstat[sortkey], macaddr, \
-            devstat['rx'], devstat['tx'], devstat['dnsq'], devstat['dnsd'], \
-            devstat['conn'], devstat['pkts'], devstat['la'], devstat['ip']])
+    clients = None if ui.all_devices else set(ui.clients)
+    # (mac, fa, la, rx, tx, dnsq, dnsd, conn, pkts, ip, rate, alerts, memory)
+    for d in backend.get_devices_summary(ui.statuses['time']):
+        if clients is None or d[0] in clients:
+            if ui.sort_by == 'rate':
+                sortval = (d[10], d[2])
+            elif ui.sort_by == 'memory':
+                sortval = (d[12], d[2])
+            else:
+                sortval = d[2] if ui.sort_by == 'active' else d[1]  # la or fa
+            lst.append((sortval, d[0], d[3], d[4], d[5], d[6], d[7], d[8], d[2], d[9], d[10], d[11],
+                        d[12]))
     lst.sort(reverse=True)
+    ui.view_stamp = (len(lst), sum(d[2] + d[3] for d in lst))
 
     for d in lst:
         cols = [RP]
@@ -835,19 +1177,87 @@ def make_list_content():
         # mark clients
         txt = ('C ' if d[1] in ui.clients else '  ') if ui.all_devices else ''
         cols.append([txt, CLIENTMARK, ATTR])
+        # mark devices with alerts
+        cols.append(['! ' if d[11] else '  ', ALERTDOMAIN, curses.A_BOLD])
         # time
         txt = d[1] + rjust("now" if is_highlighted else rel_time(d[8],variant=1), 9)
         cols.append([txt, COLOR, ATTR])
         # colored columns with data volume
         cols.append([rjust(fmt_volume(d[3]),9), ACTIVETX if is_highlighted else COLOR, ATTR])
         cols.append([rjust(fmt_volume(d[2]),9), ACTIVERX if is_highlighted else COLOR, ATTR])
+        cols.append([rjust(fmt_volume(d[10]),9), COLOR, ATTR])
         # the rest
         txt = rjust(str(d[4]), 9) + rjust(str(d[5]), 9) \
-            + rjust(str(d[6]), 9) + rjust(str(d[7]), 9) + '  ' + d[9]
+            + rjust(str(d[6]), 9) + rjust(str(d[7]), 9) + rjust(fmt_volume(d[12]), 9) + '  ' + d[9]
         cols.append([txt, COLOR, ATTR])
         ui.content.append(cols)
 
 
+# content for top talkers of the whole network (kept sorted by backend)
+#
+def make_top_content():
+    global ui, backend
+
+    ui.device = None
+    ui.conns = None
+
+    ui.set_layout(2, 1)
+    clients = None if ui.all_devices else set(ui.clients)
+    # (mac, ip, recent, name, tx, rx, la)
+    ui.view_stamp = 0
+    for d in backend.get_top_talkers(ui.statuses['time']):
+        if clients is not None and d[0] not in clients:
+            continue
+        ui.view_stamp += d[4] + d[5]
+        cols = [RP]
+        is_highlighted = ui.highlight and d[6] > HIGHLIGHTTIME
+        COLOR, ATTR = (ACTIVEDEVICE, curses.A_BOLD) if is_highlighted else (NORMAL, curses.A_DIM)
+        cols.append([d[0] + rjust(fmt_volume(d[2]),9), COLOR, ATTR])
+        cols.append([rjust(fmt_volume(d[4]),9), ACTIVETX if is_highlighted else COLOR, ATTR])
+        cols.append([rjust(fmt_volume(d[5]),9), ACTIVERX if is_highlighted else COLOR, ATTR])
+        txt = rjust("now" if is_highlighted else rel_time(d[6],variant=1), 9)
+        cols.append([txt + '  ' + d[1] + '  ' + d[3], COLOR, ATTR])
+        ui.content.append(cols)
+
+    if not ui.content:
+        ui.content.append([RP, ['', NORMAL]])
+        ui.content.append([RP, [center("No data transmitted over IP so far.", ui.w), NORMAL]])
+
+
+# content for alerts: rules with their hits and cost, then log of alerts
+#
+def make_alerts_content():
+    global ui, backend
+
+    ui.device = None
+    ui.conns = None
+
+    ui.set_layout(2, 1)
+    # (rule, description, hits, checks, seconds spent)
+    ui.view_stamp = 0
+    for r in backend.get_alert_rules():
+        ui.view_stamp += r[2]
+        cost = fmt_duration(r[4]/r[3]) if r[3] else '-'
+        ui.content.append([RP,
+            [rjust(fmt(r[2]),9) + '  ' + ljust(r[0],8), ALERTDOMAIN if r[2] else NORMAL],
+            [ljust(r[1],40) + f"{fmt(r[3])} checks, {cost} each", NORMAL, curses.A_DIM]])
+    ui.content.append([RP])
+
+    clients = None if ui.all_devices else set(ui.clients)
+    # (time, mac, ip, rule, text)
+    for a in backend.get_alerts():
+        if clients is not None and a[1] not in clients:
+            continue
+        if ui.abs_time:
+            tm = fmt_time(a[0]-ui.timezone_correction)
+        else:
+            tm = rel_time(ui.statuses['time']-a[0], variant=1)
+        ui.content.append([RP,
+            [rjust(tm,9) + '  ' + a[1] + ' ', NORMAL],
+            [ljust(a[3],8), ALERTDOMAIN],
+            [a[4] + '  ' + a[2], NORMAL]])
+
+
 # additional informations from multicast dns querries
 #
 def make_multicast_content():
@@ -871,6 +1281,80 @@ def make_multicast_content():
     ui.content.append([RP, [center("Press 'm' to show/hide this multicast info...", ui.w)]])
 
 
+# tcp/udp flows of device's connections, most recently active first
+#
+def make_flows_content():
+    global ui
+    flows = backend.get_device_flows(ui.selected, ui.statuses['time'])
+    if flows:
+        lst = [(max(f['la'] for f in flows[ip]), ip) for ip in flows.keys()]
+        lst.sort(reverse=True)
+        for _, ip in lst:
+            name = backend.get_device_ip_name(ui.selected, ip, ui.recent_names)
+            ui.content.append([RP, [ip+'  ', ACTIVEDEVICE], [name, NORMAL]])
+            flows[ip].sort(key=lambda f: f['la'], reverse=True)
+            for f in flows[ip]:
+                ports = f"{f['lport']} > {f['rport']}"
+                # start (time or how long ago) and duration of flow
+                if ui.abs_time:
+                    since = fmt_time(f['fa']-ui.timezone_correction)
+                else:
+                    since = rel_time(ui.statuses['time']-f['fa'], variant=1)
+                duration = rel_time(ui.statuses['time']+f['la']-f['fa'], variant=1)
+                ui.content.append([RP,
+                    ['    '+ljust(f['prot'], 5)+ljust(ports, 14), NORMAL],
+                    [rjust(since, 8)+'  '+rjust(duration, 7), LOCALNETWORK],
+                    [f"  tx {fmt_volume(f['tx'])}  rx {fmt_volume(f['rx'])}", NORMAL],
+                    [f"  {f['tp']}/{f['rp']} pkts", LOCALNETWORK]])
+            ui.content.append([RP, ['', NORMAL]])
+    else:
+        ui.content.append([RP, ["", NORMAL]])
+        ui.content.append([RP, [center("No active TCP/UDP flows of this device.", ui.w)]])
+        ui.content.append([RP, ["", NORMAL]])
+    ui.content.append([RP, ["", NORMAL]])
+    ui.content.append([RP, [center("Press 'f' to show/hide flows of connections...", ui.w)]])
+
+
+# connections of device in a time range, from event history kept by backend
+#
+def make_history_content():
+    global ui
+
+    def when(tm):
+        if ui.abs_time:
+            return fmt_time(tm-ui.timezone_correction)
+        return rel_time(ui.statuses['time']-tm, variant=1)
+
+    rng = history_range(ui.history, ui.statuses['time'])
+    if not rng:
+        ui.content.append([RP, ["", NORMAL]])
+        ui.content.append([RP, [center(f"Time range '{ui.history}' is not valid.", ui.w)]])
+        ui.content.append([RP, [center("Use e.g. 15m, 2h, 1d (last minutes/hours/days) "
+                                       "or 10:00-10:15.", ui.w)]])
+    else:
+        history = backend.get_device_history(ui.selected, rng[0], rng[1])
+        ui.content.append([RP,
+            [f"{when(rng[0])} - {when(rng[1])}: ", ACTIVEDEVICE],
+            [f"{len(history['ips'])} IP addresses", NORMAL],
+            [f"  (history since {when(history['span'][0])}, {fmt(history['events'])} events"
+             + (f", {fmt(history['dropped'])} dropped)" if history['dropped'] else ")"),
+             LOCALNETWORK]])
+        ui.content.append([RP, ["", NORMAL]])
+        # (ip, bytes, new, domains, first, last)
+        for ip, vol, new, domains, first, last in history['ips']:
+            name = ', '.join(domains) if domains else \
+                backend.get_device_ip_name(ui.selected, ip, ui.recent_names)
+            ui.content.append([RP,
+                [rjust(fmt_volume(vol), 9) + '  ', NORMAL],
+                [ljust(when(first), 8) + ' ' + ljust(when(last), 8), LOCALNETWORK],
+                [' new ' if new else '     ', ACTIVETX],
+                [ip + '  ', ACTIVEDEVICE],
+                [name, NORMAL]])
+    ui.content.append([RP, ["", NORMAL]])
+    ui.content.append([RP, [center("Press 'e' to change time range, Esc to hide history...",
+                                   ui.w)]])
+
+
 # information about dns querries blocked by dns server
 #
 def make_blocked_dns_content():
@@ -905,6 +1389,7 @@ def make_detail_content():
     ui.set_layout(6, 1)
 
     ui.device = backend.get_device_statistics(ui.selected, ui.statuses['time'])
+    ui.view_stamp = ui.device['pkts']
 
     # additional info with separate view
     if ui.show_more == 'mdns':
@@ -913,19 +1398,34 @@ def make_detail_content():
     if ui.show_more == 'bdns':
         make_blocked_dns_content()
         return
+    if ui.show_more == 'flows':
+        make_flows_content()
+        return
+    if ui.show_more == 'history':
+        make_history_content()
+        return
 
     # details - list of connections
     ui.conns = backend.get_device_connections(ui.selected, ui.statuses['time'])
     if ui.conns:
         ip2dns = backend.get_device_dnsreplies(ui.selected)
 
+        # search in names, IP addresses, countries and protocols (indexed by backend)
+        found = set(backend.get_device_search(ui.selected, ui.search)) if ui.search else None
+
         # sort
         lst = []
-        sortkey = 'la' if ui.active_first else 'fa'
         for ip in ui.conns.keys():
+            if found is not None and ip not in found:
+                continue
             # uncoment, if only transmitting IPs are interesting, e.g. hide incoming broadcasts
             ##### if ui.conns[ip]['tx'] > 0:
-            lst.append([ui.conns[ip][sortkey], ip])
+            if ui.sort_by == 'rate':
+                sortval = (ui.conns[ip]['txr'][0] + ui.conns[ip]['rxr'][0], ui.conns[ip]['la'])
+            else:
+                # connections have no own memory estimate, they are sorted by activity then
+                sortval = ui.conns[ip]['fa' if ui.sort_by == 'chrono' else 'la']
+            lst.append([sortval, ip])
 
         lst.sort(reverse=True)
 
@@ -939,7 +1439,7 @@ def make_detail_content():
             # backend.get_device_dnscnames(ui.selected)
 
             # name of IP connection based on DNS querries and IP address type
-            txt = backend.get_device_ip_name(ui.selected, ip)
+            txt = backend.get_device_ip_name(ui.selected, ip, ui.recent_names)
             if not ui.show_ip_stat:
                 txt += ' '+ip
             # color of the name
@@ -961,6 +1461,10 @@ def make_detail_content():
                         (ALERTDOMAIN, curses.A_BOLD) if is_highlighted else (ALERTDOMAIN, NORMAL)
                 else:
                     COLOR, ATTR = (NORMAL, curses.A_BOLD) if is_highlighted else (NORMAL, NORMAL)
+            # domain of the IP address is on a blocklist
+            if ui.conns[ip].get('lst'):
+                txt += " (blocklisted)"
+                COLOR, ATTR = ALERTDOMAIN, ATTR | curses.A_REVERSE
 
             if is_listed:
                 ui.content.append([RP, [txt, COLOR, ATTR]])
@@ -971,14 +1475,16 @@ def make_detail_content():
                         method = backend.get_device_ip_tx_sec_graph
                     else:
                         method = backend.get_device_ip_tx_min_graph
-                    ui.content.append([GR, method, ui.selected, ip, ui.statuses['time'], ACTIVETX])
+                    ui.content.append([GR, method, ui.selected, ip, ui.statuses['time'], ACTIVETX,
+                                       ui.conns[ip]['tx']])
 
                 if ui.show_rx_graph:
                     if ui.sec_graph:
                         method = backend.get_device_ip_rx_sec_graph
                     else:
                         method = backend.get_device_ip_rx_min_graph
-                    ui.content.append([GR, method, ui.selected, ip, ui.statuses['time'], ACTIVERX])
+                    ui.content.append([GR, method, ui.selected, ip, ui.statuses['time'], ACTIVERX,
+                                       ui.conns[ip]['rx']])
 
                 # statistics for an IP address (cols = columns, then store them into row content)
                 if ui.show_ip_stat:
@@ -1000,6 +1506,8 @@ def make_detail_content():
                         ACTIVETX if is_highlighted else COLOR, ATTR])
                     cols.append([rjust(fmt_volume(ui.conns[ip]['rx']), 9),
                         ACTIVERX if is_highlighted else COLOR, ATTR])
+                    cols.append([rjust(fmt_volume(ui.conns[ip]['txr'][0] + ui.conns[ip]['rxr'][0]), 9),
+                        COLOR, ATTR])
                     cols.append(['  ' + ' '.join(list(ui.conns[ip]['prot'])), COLOR, ATTR])
                     ui.content.append(cols)
 
@@ -1100,7 +1608,13 @@ def show_help():
         ["toggle list/detail", NORMAL]])
     ui.content.append([RP,
         [rjust("F6: ",colw), LOCALNETWORK],
-        ["toggle sort order by last activity/first appearance", NORMAL]])
+        ["switch sort order by last activity/first appearance/current rate/memory", NORMAL]])
+    ui.content.append([RP,
+        [rjust("F7: ",colw), LOCALNETWORK],
+        ["show/hide top talkers of the whole network", NORMAL]])
+    ui.content.append([RP,
+        [rjust("a: ",colw), LOCALNETWORK],
+        ["show/hide alerts and alert rules", NORMAL]])
     ui.content.append([RP,
         [rjust("t: ",colw), LOCALNETWORK],
         ["toggle absolute/relative time", NORMAL]])
@@ -1109,7 +1623,7 @@ def show_help():
         ["toggle dark/light theme", NORMAL]])
     ui.content.append([RP,
         [rjust("+ -: ",colw), LOCALNETWORK],
-        [f"adjust refresh speed (now {ui.refresh/10:,}s)", NORMAL]])
+        [f"adjust refresh speed (now {ui.refresh/10:,}s, faster while data change)", NORMAL]])
     ui.content.append([RP,
         [rjust("p: ",colw), LOCALNETWORK],
         ["pause", NORMAL]])
@@ -1132,6 +1646,9 @@ def show_help():
     ui.content.append([RP,
         [rjust("l: ",colw), LOCALNETWORK],
         ["show/hide local network addresses", NORMAL]])
+    ui.content.append([RP,
+        [rjust("n: ",colw), LOCALNETWORK],
+        ["toggle recent/all domain names of IP address", NORMAL]])
     # TODO: CNAMES
     # ui.content.append([RP,
     #     [rjust("c: ",colw), LOCALNETWORK],
@@ -1139,6 +1656,15 @@ def show_help():
     ui.content.append([RP,
         [rjust("m b: ",colw), LOCALNETWORK],
         ["show/hide device's multicast/blocked querries", NORMAL]])
+    ui.content.append([RP,
+        [rjust("f: ",colw), LOCALNETWORK],
+        ["show/hide TCP/UDP flows of connections", NORMAL]])
+    ui.content.append([RP,
+        [rjust("e: ",colw), LOCALNETWORK],
+        ["history in time range (15m, 2h, 10:00-10:15...), Esc hides", NORMAL]])
+    ui.content.append([RP,
+        [rjust("/: ",colw), LOCALNETWORK],
+        ["search domain/IP/country/protocol (Enter keeps, Esc clears)", NORMAL]])
     ui.content.append([RP,
         [rjust("F8: ",colw), LOCALNETWORK],
         ["clear connections  ", NORMAL],
@@ -0,0 +1,42 @@
+# -*- coding: utf8 -*-
+# Packets for unit tests: rows as PacketSource parses them, fields given by
+# column names with dots written as underscores (tcp_stream, dns_qry_name...).
+#
+# This file is part of wireowl which is released under GNU GPLv2 license.
+#
+# Copyright 2021, 2022 Jiri Rozvaril <rozvara at vync dot org>
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from wireowl_backend import Packet, COLUMNS, P_TIME, P_ETHSRC, P_ETHDST, P_PROTOCOL, P_FRAMELEN
+
+FIELDS = {c.replace('.', '_'): i for i, c in enumerate(COLUMNS)}
+
+
+def packet(tm, eth_src, eth_dst, protocol='TCP', length=100, source=0, **fields):
+    cols = [''] * len(COLUMNS)
+    cols[P_TIME] = repr(float(tm))
+    cols[P_ETHSRC] = eth_src
+    cols[P_ETHDST] = eth_dst
+    cols[P_PROTOCOL] = protocol
+    cols[P_FRAMELEN] = str(length)
+    for name, value in fields.items():
+        cols[FIELDS[name]] = str(value)
+    return Packet(cols, source)
+
+
+# TCP packet of a stream between two devices
+#
+def tcp(tm, eth_src, eth_dst, ip_src, ip_dst, stream, length=100, source=0):
+    return packet(tm, eth_src, eth_dst, length=length, source=source, ip_src=ip_src,
+                  ip_dst=ip_dst, tcp_srcport=50000, tcp_dstport=443, tcp_stream=stream)
+
+
+# DNS answer from resolver to client
+#
+def dns_answer(tm, eth_src, eth_dst, ip_src, ip_dst, domain, ips, ttl=300, cnames=()):
+    return packet(tm, eth_src, eth_dst, protocol='DNS', length=120, ip_src=ip_src,
+                  ip_dst=ip_dst, udp_srcport=53, udp_dstport=50000, dns_flags_response=1,
+                  dns_qry_name=domain, dns_a='|'.join(ips), dns_resp_ttl=ttl,
+                  dns_cname='|'.join(cnames))
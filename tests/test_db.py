@@ -0,0 +1,103 @@
+# -*- coding: utf8 -*-
+# Unit test of database round trip: aggregates written by DatabaseWriter in
+# full and delta flushes are loaded back by load_database.
+#
+#   python3 -m unittest discover tests
+#
+# This file is part of wireowl which is released under GNU GPLv2 license.
+#
+# Copyright 2021, 2022 Jiri Rozvaril <rozvara at vync dot org>
+
+import os
+import tempfile
+import unittest
+from packets import tcp, dns_answer
+from wireowl_backend import TrafficInspector, StaticReader
+from wireowl_db import DatabaseWriter, load_database
+
+A, B, C = 'aa:00:00:00:00:01', 'aa:00:00:00:00:02', 'aa:00:00:00:00:03'
+
+
+class DatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.pathname = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.pathname + suffix):
+                os.remove(self.pathname + suffix)
+
+    def traffic(self, worker, start, count):
+        for i in range(count):
+            tm = start + i
+            worker.process_packet(tcp(tm, A, B, '192.168.1.10', '1.1.1.1', 0, length=100 + i))
+            worker.process_packet(tcp(tm + 0.5, B, A, '1.1.1.1', '192.168.1.10', 0, length=1500))
+            if i % 20 == 0:
+                worker.process_packet(tcp(tm, C, B, '192.168.1.20', '8.8.4.4', 1 + i))
+
+    def compare(self, worker, loaded):
+        ui_time = worker.last_pkt_time
+        self.assertEqual(sorted(loaded.devices), sorted(worker.devices))
+        for mac in worker.devices:
+            old, new = worker.devices[mac], loaded.devices[mac]
+            self.assertEqual((new.tx_bytes, new.rx_bytes, new.tx_pkts, new.rx_pkts),
+                             (old.tx_bytes, old.rx_bytes, old.tx_pkts, old.rx_pkts))
+            conns = worker.get_device_connections(mac, ui_time, True)
+            loaded_conns = loaded.get_device_connections(mac, ui_time, True)
+            self.assertEqual(sorted(loaded_conns), sorted(conns))
+            for ip in conns:
+                for key in ('tx', 'rx', 'tp', 'rp', 'fa', 'la', 'prot', 'name'):
+                    self.assertEqual(loaded_conns[ip][key], conns[ip][key], (mac, ip, key))
+                self.assertEqual(loaded.get_device_ip_tx_min_graph(mac, ip, ui_time),
+                                 worker.get_device_ip_tx_min_graph(mac, ip, ui_time))
+            self.assertEqual(loaded.get_device_dnsreplies(mac), worker.get_device_dnsreplies(mac))
+            self.assertEqual(loaded.get_device_dnscnames(mac), worker.get_device_dnscnames(mac))
+            history = worker.get_device_history(mac, 0, 1e12)['ips']
+            loaded_history = loaded.get_device_history(mac, 0, 1e12)['ips']
+            self.assertEqual([item[:3] for item in loaded_history], [item[:3] for item in history])
+
+    def test_full_and_delta_flush_loaded(self):
+        worker = TrafficInspector()
+        reader = StaticReader({'snc': 1, 'pkts': 0, 'flt': 'tcp'})
+        self.traffic(worker, 1000, 150)
+        worker.process_packet(dns_answer(1150, B, A, '192.168.1.1', '192.168.1.10', 'one.one',
+                                         ['1.1.1.1'], cnames=['cdn.one.one']))
+        self.assertTrue(worker.get_device_dnsreplies(A))
+        writer = DatabaseWriter(self.pathname, worker, reader)
+        self.assertEqual(writer.status, 0)
+        self.assertTrue(writer.flush())
+        rows = writer.rows
+        # delta writes changed aggregates only, minutes already written are kept
+        self.traffic(worker, 1200, 90)
+        self.assertTrue(writer.flush())
+        self.assertLess(writer.rows - rows, rows)
+        self.assertTrue(writer.flush())
+        writer.db.close()
+
+        loaded, loaded_reader = load_database(self.pathname)
+        self.assertIsNotNone(loaded)
+        self.assertEqual(loaded.last_pkt_time, worker.last_pkt_time)
+        self.assertEqual(loaded_reader.get_statuses()['flt'], 'tcp')
+        self.compare(worker, loaded)
+
+    def test_cleared_device_replaced(self):
+        worker = TrafficInspector()
+        reader = StaticReader({'snc': 1, 'pkts': 0, 'flt': ''})
+        self.traffic(worker, 1000, 150)
+        writer = DatabaseWriter(self.pathname, worker, reader)
+        self.assertTrue(writer.flush())
+        worker.clear_device_stats(A)
+        self.traffic(worker, 1300, 30)
+        self.assertTrue(writer.flush())
+        writer.db.close()
+        loaded, _ = load_database(self.pathname)
+        self.compare(worker, loaded)
+
+    def test_missing_database(self):
+        self.assertEqual(load_database(self.pathname + '.missing'), (None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
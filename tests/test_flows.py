@@ -0,0 +1,76 @@
+# -*- coding: utf8 -*-
+# Unit tests of FlowTable: streams of more sources, reuse of stream index,
+# expiry, eviction and flows of devices whose statistics were cleared.
+#
+#   python3 -m unittest discover tests
+#
+# This file is part of wireowl which is released under GNU GPLv2 license.
+#
+# Copyright 2021, 2022 Jiri Rozvaril <rozvara at vync dot org>
+
+import unittest
+from packets import tcp
+from wireowl_backend import FlowTable
+
+A, B, C, D = 'aa:00:00:00:00:01', 'aa:00:00:00:00:02', 'aa:00:00:00:00:03', 'aa:00:00:00:00:04'
+
+
+class FlowTableTest(unittest.TestCase):
+
+    def test_sources_keep_own_streams(self):
+        # each tshark numbers its streams from 0
+        flows = FlowTable()
+        for i in range(10):
+            flows.update(tcp(100+i, A, B, '10.0.0.1', '1.1.1.1', 0, source=0))
+            flows.update(tcp(100+i, C, D, '10.0.1.1', '2.2.2.2', 0, source=1, length=200))
+        self.assertEqual(len(flows.flows), 2)
+        first, second = flows.flows[(0, 'TCP', '0')], flows.flows[(1, 'TCP', '0')]
+        self.assertEqual((first.pkts_ab, first.bytes_ab, first.first), (10, 1000, 100.0))
+        self.assertEqual((second.pkts_ab, second.bytes_ab, second.first), (10, 2000, 100.0))
+        self.assertEqual(list(flows.device_flows(A)), ['1.1.1.1'])
+        self.assertEqual(list(flows.device_flows(C)), ['2.2.2.2'])
+
+    def test_stream_reused_within_source(self):
+        flows = FlowTable()
+        flows.update(tcp(100, A, B, '10.0.0.1', '1.1.1.1', 0))
+        flows.update(tcp(101, B, A, '1.1.1.1', '10.0.0.1', 0))
+        flows.update(tcp(200, A, B, '10.0.0.1', '3.3.3.3', 0))
+        flow = flows.flows[(0, 'TCP', '0')]
+        self.assertEqual((flow.ip_b, flow.pkts_ab, flow.pkts_ba, flow.first), ('3.3.3.3', 1, 0, 200.0))
+        self.assertEqual(list(flows.device_flows(A)), ['3.3.3.3'])
+
+    def test_idle_flows_expire(self):
+        flows = FlowTable(idle=10)
+        flows.update(tcp(100, A, B, '10.0.0.1', '1.1.1.1', 0))
+        flows.update(tcp(105, A, B, '10.0.0.1', '2.2.2.2', 1))
+        flows.update(tcp(112, A, B, '10.0.0.1', '2.2.2.2', 1))
+        self.assertEqual(list(flows.flows), [(0, 'TCP', '1')])
+        self.assertEqual(flows.expired, 1)
+        self.assertEqual(list(flows.device_flows(A)), ['2.2.2.2'])
+        self.assertEqual(list(flows.device_flows(B)), ['10.0.0.1'])
+
+    def test_capacity_evicts_least_recently_active(self):
+        flows = FlowTable(capacity=2)
+        flows.update(tcp(100, A, B, '10.0.0.1', '1.1.1.1', 0))
+        flows.update(tcp(100.1, A, B, '10.0.0.1', '2.2.2.2', 1))
+        flows.update(tcp(100.2, A, B, '10.0.0.1', '1.1.1.1', 0))
+        flows.update(tcp(100.3, A, B, '10.0.0.1', '3.3.3.3', 2))
+        self.assertEqual(list(flows.flows), [(0, 'TCP', '0'), (0, 'TCP', '2')])
+        self.assertEqual(flows.evicted, 1)
+        self.assertEqual(sorted(flows.device_flows(A)), ['1.1.1.1', '3.3.3.3'])
+
+    def test_cleared_device_sees_continuing_flow(self):
+        flows = FlowTable()
+        flows.update(tcp(100, A, B, '10.0.0.1', '1.1.1.1', 0))
+        flows.forget_device(A)
+        self.assertEqual(flows.device_flows(A), {})
+        self.assertEqual(list(flows.device_flows(B)), ['10.0.0.1'])
+        flows.update(tcp(101, B, A, '1.1.1.1', '10.0.0.1', 0))
+        self.assertEqual(list(flows.device_flows(A)), ['1.1.1.1'])
+        self.assertFalse(flows.relink)
+        flow = flows.flows[(0, 'TCP', '0')]
+        self.assertEqual((flow.pkts_ab, flow.pkts_ba), (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
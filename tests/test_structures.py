@@ -0,0 +1,144 @@
+# -*- coding: utf8 -*-
+# Unit tests of bounded per-device structures and lookups: DNS answers,
+# event history, search index, blocklist and rate meters.
+#
+#   python3 -m unittest discover tests
+#
+# This file is part of wireowl which is released under GNU GPLv2 license.
+#
+# Copyright 2021, 2022 Jiri Rozvaril <rozvara at vync dot org>
+
+import os
+import tempfile
+import unittest
+import packets  # noqa: F401 (path of backend)
+from wireowl_backend import DNSMappings, EventHistory, SearchIndex, Blocklist, RateMeter, \
+                            HISTORY_STRINGS, RATE_WINDOWS
+
+
+class DNSMappingsTest(unittest.TestCase):
+
+    def test_names_valid_at_time(self):
+        dns = DNSMappings()
+        dns.add('old.example.com', ['1.1.1.1'], 100, 60)
+        dns.add('new.example.com', ['1.1.1.1'], 200, 60)
+        self.assertEqual(dns.names('1.1.1.1'), ['new.example.com', 'old.example.com'])
+        self.assertEqual(dns.names('1.1.1.1', 150), ['old.example.com'])
+        self.assertEqual(dns.names('1.1.1.1', 230), ['new.example.com'])
+        # expired answer is still the best guess
+        self.assertEqual(dns.names('1.1.1.1', 1000), ['new.example.com'])
+
+    def test_oldest_addresses_forgotten_over_capacity(self):
+        dns = DNSMappings(capacity=2)
+        dns.add('a.com', ['1.1.1.1'], 100, 0)
+        dns.add('b.com', ['2.2.2.2'], 101, 0)
+        dns.add('a.com', ['1.1.1.1'], 102, 0)  # answered again, the newest now
+        dns.add('c.com', ['3.3.3.3'], 103, 0)
+        self.assertEqual(list(dns.ips), ['1.1.1.1', '3.3.3.3'])
+        self.assertNotIn('b.com', dns.domains)
+        self.assertEqual(dns.forgotten, 1)
+
+    def test_names_of_address_and_cnames_bounded(self):
+        dns = DNSMappings(names_per_ip=2)
+        for i in range(5):
+            dns.add(f'd{i}.cdn.com', ['1.1.1.1'], 100 + i, 0)
+            dns.add_cnames('www.example.com', [f'c{i}.cdn.com'], 100 + i)
+        self.assertEqual(dns.names('1.1.1.1'), ['d4.cdn.com', 'd3.cdn.com'])
+        self.assertEqual(set(dns.domains), {'d3.cdn.com', 'd4.cdn.com'})
+        self.assertEqual(dns.domain2cnames(), {'www.example.com': {'c3.cdn.com', 'c4.cdn.com'}})
+
+
+class EventHistoryTest(unittest.TestCase):
+
+    def test_volume_of_minute_in_one_event(self):
+        history = EventHistory()
+        history.connection('1.1.1.1', 60)
+        for tm in range(60, 180, 10):
+            history.volume('1.1.1.1', tm, 100)
+        self.assertEqual(len(history.times), 3)  # connection and two minutes
+        self.assertEqual(history.summary(0, 1000)['ips'][0][:3], ('1.1.1.1', 1200, True))
+        self.assertEqual(history.summary(120, 1000)['ips'][0][:3], ('1.1.1.1', 600, False))
+
+    def test_trimmed_by_capacity_and_retention(self):
+        history = EventHistory(capacity=100, retention=3600)
+        for i in range(1000):
+            history.connection(f'10.0.{i//250}.{i%250}', i)
+        self.assertLessEqual(len(history.times), 100)
+        self.assertEqual(history.dropped + len(history.times), 1000)
+        history.connection('1.1.1.1', 10000)
+        self.assertEqual(history.summary(0, 1e12)['ips'][0][0], '1.1.1.1')
+        self.assertEqual(len(history.times), 1)
+
+    def test_compaction_keeps_strings_of_kept_events(self):
+        history = EventHistory(capacity=100)
+        for i in range(10000):
+            ip = f'10.{i//65536}.{i//256%256}.{i%256}'
+            history.dns(f'd{i}.example.com', [ip], i)
+            history.volume(ip, i, 100)
+        self.assertLessEqual(len(history.strings), 2*HISTORY_STRINGS + 2)
+        self.assertLessEqual(len(history.minutes), len(history.strings))
+        summary = history.summary(0, 1e12)
+        expected = {f'10.0.{i//256%256}.{i%256}' for i in range(10000 - 40, 10000)}
+        self.assertTrue(expected <= {item[0] for item in summary['ips']})
+        last = [item for item in summary['ips'] if item[0] == '10.0.39.15'][0]
+        self.assertEqual((last[1], last[3]), (100, ['d9999.example.com']))
+
+
+class SearchIndexTest(unittest.TestCase):
+
+    def test_substrings_of_texts(self):
+        index = SearchIndex()
+        index.add('1.1.1.1', 'cloudflare-dns.com')
+        index.add('1.1.1.1', 'US')
+        index.add('8.8.8.8', 'dns.google')
+        self.assertEqual(index.search('DNS'), {'1.1.1.1', '8.8.8.8'})
+        self.assertEqual(index.search('flare'), {'1.1.1.1'})
+        self.assertEqual(index.search('us'), {'1.1.1.1'})
+        self.assertEqual(index.search('goo.gle'), set())
+
+
+class BlocklistTest(unittest.TestCase):
+
+    def test_domains_and_parents_listed(self):
+        fd, pathname = tempfile.mkstemp(suffix='.hosts')
+        with os.fdopen(fd, 'w') as f:
+            f.write("# comment\n0.0.0.0 tracker.example.com\n||ads.example.org^\n"
+                    "plain.example.net\nlocalhost\n! adblock comment\n")
+        try:
+            blocklist = Blocklist([pathname])
+        finally:
+            os.remove(pathname)
+        self.assertEqual(blocklist.status, 0)
+        self.assertEqual(len(blocklist.hashes), 3)
+        self.assertTrue(blocklist.listed('tracker.example.com'))
+        self.assertTrue(blocklist.listed('a.b.ADS.example.org.'))
+        self.assertTrue(blocklist.listed('plain.example.net'))
+        self.assertFalse(blocklist.listed('example.com'))
+        self.assertFalse(blocklist.listed('localhost'))
+        self.assertTrue(blocklist.listed('tracker.example.com'))
+        self.assertEqual((blocklist.lookups, blocklist.cached), (5, 1))
+
+    def test_unreadable_file(self):
+        self.assertEqual(Blocklist(['/nonexistent/blocklist']).status, 1)
+
+
+class RateMeterTest(unittest.TestCase):
+
+    def test_steady_traffic(self):
+        meter = RateMeter()
+        for second in range(1000, 6000):
+            meter.add(second + 0.5, 1000)
+        self.assertEqual(meter.rates(6000), (1000,) * len(RATE_WINDOWS))
+
+    def test_silence_decays_rates(self):
+        meter = RateMeter()
+        for second in range(1000, 3000):
+            meter.add(second + 0.5, 1000)
+        rates = meter.rates(3000 + RATE_WINDOWS[0])
+        self.assertAlmostEqual(rates[0], 1000/2.718, delta=5)  # 1/e after the window
+        self.assertTrue(rates[0] < rates[1] < rates[2] < 1000)
+        self.assertEqual(meter.rates(3000 + 100*RATE_WINDOWS[-1])[-1], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
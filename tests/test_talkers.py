@@ -0,0 +1,88 @@
+# -*- coding: utf8 -*-
+# Unit tests of TopTalkers: order by decayed volume, rescaling to a new
+# landmark and forgetting pairs without recent traffic.
+#
+#   python3 -m unittest discover tests
+#
+# This file is part of wireowl which is released under GNU GPLv2 license.
+#
+# Copyright 2021, 2022 Jiri Rozvaril <rozvara at vync dot org>
+
+import math
+import random
+import unittest
+import packets  # noqa: F401 (path of backend)
+from wireowl_backend import TopTalkers, TOP_SWEEP
+
+
+# volumes decayed to time now, counted packet by packet
+#
+def decayed(sent, now, decay):
+    ret = {}
+    for key, tm, vol in sent:
+        ret[key] = ret.get(key, 0) + vol*math.exp(-(now - tm)/decay)
+    return ret
+
+
+class TopTalkersTest(unittest.TestCase):
+
+    def test_order_of_recent_volume(self):
+        talkers = TopTalkers(size=2, decay=60)
+        talkers.add('a', '1.1.1.1', 100, 1000)
+        talkers.add('b', '2.2.2.2', 100, 3000)
+        talkers.add('c', '3.3.3.3', 160, 2000)
+        top = talkers.top(160)
+        self.assertEqual([(mac, ip) for mac, ip, _ in top], [('c', '3.3.3.3'), ('b', '2.2.2.2')])
+        self.assertEqual(top[1][2], round(3000*math.exp(-1)))
+
+    def test_rescale_keeps_decayed_volumes(self):
+        rnd = random.Random(1)
+        talkers = TopTalkers(size=5, decay=30)
+        sent = []
+        tm = 1000.0
+        for _ in range(5000):
+            tm += rnd.random()
+            key = ('m%d' % rnd.randrange(3), '10.0.0.%d' % rnd.randrange(8))
+            vol = rnd.randint(60, 1500)
+            talkers.add(key[0], key[1], tm, vol)
+            sent.append((key, tm, vol))
+        self.assertGreater(talkers.landmark, 1000 + TOP_SWEEP)  # rescaled meanwhile
+        expected = decayed(sent, tm, 30)
+        best = sorted(expected, key=expected.get, reverse=True)[:5]
+        top = talkers.top(tm)
+        self.assertEqual([(mac, ip) for mac, ip, _ in top], best)
+        for mac, ip, volume in top:
+            self.assertAlmostEqual(volume, expected[(mac, ip)], delta=1)
+
+    def test_forgets_pairs_without_recent_traffic(self):
+        talkers = TopTalkers(size=2, decay=10)
+        for i in range(1000):
+            talkers.add('m', '10.0.%d.%d' % (i//250, i%250), 100 + i, 1000)
+        # pairs out of top decay under a byte within ~70 seconds
+        self.assertLess(len(talkers.scores), 150)
+        self.assertTrue(talkers.members <= set(talkers.scores))
+        self.assertEqual([ip for _, ip, _ in talkers.top(1099)], ['10.0.3.249', '10.0.3.248'])
+
+    def test_members_kept_while_decayed(self):
+        talkers = TopTalkers(size=2, decay=1)
+        talkers.add('a', '1.1.1.1', 100, 1000)
+        talkers.add('b', '2.2.2.2', 100, 1000)
+        talkers.add('c', '3.3.3.3', 10000, 1)
+        # decayed members were kept by rescale, the one replaced goes with next sweep
+        self.assertIn(('c', '3.3.3.3'), talkers.members)
+        self.assertEqual(len(talkers.members), 2)
+        talkers.add('c', '3.3.3.3', 10000 + TOP_SWEEP, 1)
+        self.assertEqual(set(talkers.scores), talkers.members)
+
+    def test_forget_device(self):
+        talkers = TopTalkers(size=2)
+        talkers.add('a', '1.1.1.1', 100, 1000)
+        talkers.add('b', '2.2.2.2', 100, 500)
+        talkers.forget_device('a')
+        self.assertEqual([(mac, ip) for mac, ip, _ in talkers.top(100)], [('b', '2.2.2.2')])
+        talkers.add('c', '3.3.3.3', 101, 100)
+        self.assertEqual(len(talkers.top(101)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()